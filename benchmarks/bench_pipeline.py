@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+メンション処理全体のオフラインベンチマーク
+
+Mastodonクライアントとollamaクライアントをプロセス内で動作する偽物に置き換え、
+合成した通知を MentionBot.on_notification に流して、メンション1件の処理時間
+（p50/p95/p99）、1秒あたりの処理数、データベースの処理時間などを計測する。
+実際のインスタンスやGPUは必要ない（Mastodon.py はインポートのために必要）。
+
+各会話は、既存のスレッド（--depth 件の投稿）へのメンションから始まり、
+ボットの最後の返信へのメンションを --turns 回繰り返す。会話は --rate 件/秒で
+開始する（0の場合はすべて同時に開始するバースト）。
+
+使用方法:
+    python3 benchmarks/bench_pipeline.py [--conversations 20] [--turns 3] [--depth 5]
+        [--rate 0] [--custom-prompt-ratio 0.2] [--token-latency 0.002] [--stream]
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 計測結果に表示する処理段階
+STAGES = (
+    'wait_save', 'fetch_thread', 'db_lookup', 'prompt_build', 'response_cache', 'llm', 'llm_prefill',
+    'llm_generate', 'markdown', 'post', 'llm_stream_post', 'summary', 'save', 'favourite'
+)
+
+# 偽のLLMが返す文
+REPLY_SENTENCES = [
+    'それはいいですね！',
+    '今日はとてもいい天気なので、散歩に行くのもおすすめです。',
+    '**カフェ**に寄るなら、静かなお店がいいかもしれません。',
+    'なるほど、そういうことだったんですね。',
+    '無理せず、ゆっくり休んでくださいね。',
+    'ちなみに、最近は新しい本を読み始めました。',
+]
+
+# 合成するメンションの本文
+MENTION_TEXTS = [
+    'こんにちは！今日は何してた？',
+    'おすすめのカフェを教えて',
+    '最近忙しくて疲れたよ',
+    'それってどういうこと？もう少し詳しく教えて',
+]
+
+CUSTOM_PROMPTS = [
+    '関西弁で話してください。明るい性格で！',
+    '丁寧な敬語を使う執事として振る舞ってください。',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark for MentionBot')
+    parser.add_argument('--conversations', type=int, default=20, help='number of conversations')
+    parser.add_argument('--turns', type=int, default=3, help='mentions per conversation')
+    parser.add_argument('--depth', type=int, default=5, help='existing posts in each thread')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='conversations started per second (0: all at once)')
+    parser.add_argument('--custom-prompt-ratio', type=float, default=0.2,
+                        help='fraction of mentions with a /*custom prompt*/')
+    parser.add_argument('--reply-tokens', type=int, default=120, help='tokens generated per reply')
+    parser.add_argument('--token-latency', type=float, default=0.002,
+                        help='seconds per generated token')
+    parser.add_argument('--prefill-latency', type=float, default=0.0001,
+                        help='seconds per prompt token')
+    parser.add_argument('--api-latency', type=float, default=0.005,
+                        help='seconds per Mastodon API call')
+    parser.add_argument('--fallback-models', default='',
+                        help='comma separated fallback models (each 4x faster than the previous)')
+    parser.add_argument('--latency-slo', type=float, default=0.0, help='OLLAMA_LATENCY_SLO')
+    parser.add_argument('--workers', type=int, default=2, help='KEIBOT_WORKERS')
+    parser.add_argument('--llm-concurrency', type=int, default=1, help='OLLAMA_MAX_CONCURRENCY')
+    parser.add_argument('--stream', action='store_true', help='enable KEIBOT_STREAM_REPLIES')
+    parser.add_argument('--summary', action='store_true', help='enable KEIBOT_SUMMARY_ENABLED')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--verbose', action='store_true', help='show INFO logs')
+    return parser.parse_args()
+
+
+class FakeStatus(dict):
+    """Mastodon.py の AttribAccessDict と同様に属性でも参照できるdict"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeMastodon:
+    """プロセス内で動作するMastodonクライアントの代わり（ボットが使うAPIのみ）"""
+
+    def __init__(self, bot_acct: str = 'keibot', api_latency: float = 0.0):
+        self.bot_acct = bot_acct
+        self.api_latency = api_latency
+        self.ratelimit_remaining = 300
+        self.ratelimit_reset = time.time()
+        self.api_calls = Counter()
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(110000000000000000)
+        self._statuses: dict[str, FakeStatus] = {}
+        self._replies: dict[str, list] = {}
+
+    def _call(self, name: str):
+        """API呼び出しを記録し、通信の待ち時間を再現"""
+        with self._lock:
+            self.api_calls[name] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def create_status(self, acct: str, text: str, in_reply_to_id=None, visibility: str = 'public') -> FakeStatus:
+        """ステータスを作成（ベンチマークの入力用、API呼び出しとして数えない）"""
+        with self._lock:
+            status_id = next(self._ids)
+            status = FakeStatus(
+                id=status_id,
+                account=FakeStatus(acct=acct, id=hash(acct) & 0xffffff),
+                content=f'<p>{text}</p>',
+                url=f'https://bench.example/@{acct}/{status_id}',
+                created_at=datetime.now(timezone.utc),
+                in_reply_to_id=in_reply_to_id,
+                visibility=visibility
+            )
+            self._statuses[str(status_id)] = status
+            if in_reply_to_id is not None:
+                self._replies.setdefault(str(in_reply_to_id), []).append(status)
+            return status
+
+    def last_bot_reply(self, status_id):
+        """ステータスに続くボットの返信の連なりの最後を取得"""
+        last = None
+        current = str(status_id)
+        while True:
+            with self._lock:
+                replies = [s for s in self._replies.get(current, []) if s.account.acct == self.bot_acct]
+            if not replies:
+                return last
+            last = replies[-1]
+            current = str(last.id)
+
+    def me(self):
+        self._call('me')
+        return FakeStatus(acct=self.bot_acct, id=1)
+
+    def status(self, status_id):
+        self._call('status')
+        return self._statuses[str(status_id)]
+
+    def status_context(self, status_id):
+        self._call('status_context')
+        ancestors = []
+        with self._lock:
+            status = self._statuses[str(status_id)]
+            while status.in_reply_to_id is not None:
+                status = self._statuses[str(status.in_reply_to_id)]
+                ancestors.append(status)
+        return FakeStatus(ancestors=list(reversed(ancestors)), descendants=[])
+
+    def status_post(self, status, in_reply_to_id=None, visibility='public', idempotency_key=None, **kwargs):
+        self._call('status_post')
+        return self.create_status(self.bot_acct, status, in_reply_to_id, visibility)
+
+    def status_favourite(self, status_id):
+        self._call('status_favourite')
+        return self._statuses[str(status_id)]
+
+    def status_reblog(self, status_id, **kwargs):
+        self._call('status_reblog')
+        return self._statuses[str(status_id)]
+
+    def notifications(self, **kwargs):
+        self._call('notifications')
+        return []
+
+
+class FakeOllama:
+    """
+    ollama.Client の代わり
+
+    プロンプトの長さに比例したプリフィル時間と、トークンごとの生成時間を再現する
+    （日本語1トークンをおよそ2文字として数える）。
+    """
+
+    def __init__(self, reply_tokens: int, token_latency: float, prefill_latency: float, seed: int = 0):
+        self.reply_tokens = reply_tokens
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _reply_text(self) -> str:
+        with self._lock:
+            sentences = []
+            while sum(len(s) for s in sentences) < self.reply_tokens * 2:
+                sentences.append(self._rng.choice(REPLY_SENTENCES))
+        return ''.join(sentences)
+
+    def chat(self, model, messages, stream=False, keep_alive=None, **kwargs):
+        prompt_tokens = max(1, sum(len(m['content']) for m in messages) // 2)
+        prefill = prompt_tokens * self.prefill_latency
+        time.sleep(prefill)
+
+        text = self._reply_text()
+        stats = {
+            'done': True,
+            'prompt_eval_count': prompt_tokens,
+            'eval_count': self.reply_tokens,
+            'prompt_eval_duration': int(prefill * 1e9),
+            'eval_duration': int(self.reply_tokens * self.token_latency * 1e9),
+        }
+        if stream:
+            return self._stream(text, stats)
+
+        time.sleep(self.reply_tokens * self.token_latency)
+        return {'message': {'role': 'assistant', 'content': text}, **stats}
+
+    def _stream(self, text: str, stats: dict):
+        chunk_chars = max(1, len(text) // self.reply_tokens)
+        for i in range(0, len(text), chunk_chars):
+            time.sleep(self.token_latency)
+            yield {'message': {'role': 'assistant', 'content': text[i:i + chunk_chars]}, 'done': False}
+        yield {'message': {'role': 'assistant', 'content': ''}, **stats}
+
+
+def percentile(values: list, p: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def main():
+    args = parse_args()
+
+    # 設定はインポート時に読み込まれるため、先に環境変数を設定する
+    data_dir = tempfile.mkdtemp(prefix='keibot-bench-')
+    os.environ['KEIBOT_DATA_DIR'] = data_dir
+    os.environ['KEIBOT_WORKERS'] = str(args.workers)
+    os.environ['KEIBOT_QUEUE_SIZE'] = str(max(100, args.conversations * args.turns))
+    os.environ['OLLAMA_MAX_CONCURRENCY'] = str(args.llm_concurrency)
+    os.environ['KEIBOT_STREAM_REPLIES'] = 'true' if args.stream else 'false'
+    os.environ['KEIBOT_SUMMARY_ENABLED'] = 'true' if args.summary else 'false'
+
+    import logging
+    from src import llm_interface, router
+    from src.bot import MentionBot
+    from src.llm_interface import OllamaInterface
+    from src.router import ModelRouter
+    from src.metrics import STAGE_SECONDS, LLM_TOKENS_TOTAL
+    from src.storage import get_storage
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    client = FakeMastodon(api_latency=args.api_latency)
+    llm_interface._llm = OllamaInterface(
+        client=FakeOllama(args.reply_tokens, args.token_latency, args.prefill_latency, args.seed)
+    )
+    models = [llm_interface._llm]
+    for index, model in enumerate(m.strip() for m in args.fallback_models.split(',') if m.strip()):
+        speedup = 4 ** (index + 1)
+        models.append(OllamaInterface(model, client=FakeOllama(
+            args.reply_tokens, args.token_latency / speedup, args.prefill_latency / speedup, args.seed
+        )))
+    router._router = ModelRouter(models, latency_slo=args.latency_slo)
+
+    latencies: list[float] = []
+    sent_at: dict[str, float] = {}
+    done_events: dict[str, threading.Event] = {}
+    results_lock = threading.Lock()
+
+    class BenchBot(MentionBot):
+        """処理の完了時刻を記録するボット"""
+
+        def _process_mention(self, key, status, author_acct, text, notification_ids, superseded_ids):
+            super()._process_mention(key, status, author_acct, text, notification_ids, superseded_ids)
+            finished = time.perf_counter()
+            for status_id in (status.id,) + tuple(superseded_ids):
+                with results_lock:
+                    latencies.append(finished - sent_at[str(status_id)])
+                    event = done_events[str(status_id)]
+                event.set()
+
+    bot = BenchBot(client)
+    bot.start()
+
+    notification_ids = itertools.count(1)
+    ids_lock = threading.Lock()
+    rng = random.Random(args.seed)
+    plans = [
+        [rng.random() < args.custom_prompt_ratio for _ in range(args.turns)]
+        for _ in range(args.conversations)
+    ]
+
+    def run_conversation(index: int):
+        """1つの会話のメンションを順番に送る（ボットの返信を待ってから次を送る）"""
+        acct = f'user{index}'
+        parent = None
+        for depth in range(args.depth):
+            parent = client.create_status(
+                f'friend{depth % 3}', f'スレッドの投稿{depth}です。' * 3, parent.id if parent else None
+            )
+
+        for turn, with_custom in enumerate(plans[index]):
+            text = f'@{client.bot_acct} {MENTION_TEXTS[(index + turn) % len(MENTION_TEXTS)]}'
+            if with_custom:
+                text += f' /*{CUSTOM_PROMPTS[(index + turn) % len(CUSTOM_PROMPTS)]}*/'
+            status = client.create_status(acct, text, parent.id if parent else None)
+            event = threading.Event()
+            with ids_lock:
+                notification_id = next(notification_ids)
+            with results_lock:
+                done_events[str(status.id)] = event
+                sent_at[str(status.id)] = time.perf_counter()
+            bot.on_notification(FakeStatus(id=notification_id, type='mention', status=status))
+
+            event.wait()
+            parent = client.last_bot_reply(status.id) or status
+
+    started = time.perf_counter()
+    drivers = []
+    for index in range(args.conversations):
+        driver = threading.Thread(target=run_conversation, args=(index,), daemon=True)
+        driver.start()
+        drivers.append(driver)
+        if args.rate > 0:
+            time.sleep(1 / args.rate)
+    for driver in drivers:
+        driver.join()
+    elapsed = time.perf_counter() - started
+
+    bot.stop()
+    get_storage().close()
+
+    # 結果を表示
+    count = len(latencies)
+    print(f"conversations={args.conversations} turns={args.turns} depth={args.depth} "
+          f"rate={args.rate or 'burst'} workers={args.workers} stream={args.stream}")
+    print(f"mentions:     {count} in {elapsed:.2f}s ({count / elapsed:.2f} mentions/sec)")
+    print(f"latency:      p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"max={max(latencies, default=0) * 1000:.1f}ms")
+
+    print('stages (total / mean per call):')
+    for stage in STAGES:
+        total, calls = STAGE_SECONDS.get(stage=stage)
+        if calls:
+            print(f"  {stage:16s} {total:8.3f}s  {total / calls * 1000:8.2f}ms  x{calls}")
+
+    db_total = sum(STAGE_SECONDS.get(stage=stage)[0] for stage in ('db_lookup', 'save'))
+    print(f"db time:      {db_total:.3f}s ({db_total / max(count, 1) * 1000:.2f}ms per mention)")
+
+    for llm in models:
+        print(f"llm tokens:   {llm.model} "
+              f"prompt={LLM_TOKENS_TOTAL.get(model=llm.model, kind='prompt'):.0f} "
+              f"completion={LLM_TOKENS_TOTAL.get(model=llm.model, kind='completion'):.0f}")
+    print('api calls:    ' + ' '.join(f'{name}={n}' for name, n in sorted(client.api_calls.items())))
+    print(f"database:     {os.path.join(data_dir, 'conversations.db')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+テキスト整形関数のマイクロベンチマーク
+
+現在の strip_html / remove_markdown / 会話ログ用のクリーンアップを、
+以前の実装（毎回 re.sub にパターン文字列を渡す方式）と比較する。
+
+使用方法:
+    python3 benchmarks/bench_sanitize.py [繰り返し回数]
+"""
+import os
+import re
+import sys
+import timeit
+from html import unescape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils import strip_html, remove_markdown
+from src.processor import clean_stored_content, clean_content_for_log, remove_custom_prompt
+
+
+# Mastodonの投稿に近いHTML
+MASTODON_HTML = [
+    '<p><span class="h-card" translate="no"><a href="https://example.social/@keibot" '
+    'class="u-url mention">@<span>keibot</span></a></span> こんにちは！今日はいい天気だね。'
+    '散歩に行こうかな &amp; カフェにも寄りたい</p>',
+    '<p><span class="h-card" translate="no"><a href="https://example.social/@keibot" '
+    'class="u-url mention">@<span>keibot</span></a></span> /*<br />関西弁で話してください。<br />'
+    '明るい性格で！<br />*/ 調子どう？</p><p>最近&quot;忙しい&quot;んだよね</p>',
+    '<p><span class="h-card" translate="no"><a href="https://example.social/@alice" '
+    'class="u-url mention">@<span>alice</span></a></span> 1/2:<br />それは大変だったね。'
+    'ゆっくり休んでね！&lt;3</p>',
+    '<p>長い投稿のテスト。' + 'これは本文です。' * 40 + '</p><p><a href="https://example.com/'
+    'page" rel="nofollow noopener" target="_blank"><span class="invisible">https://</span>'
+    '<span class="">example.com/page</span></a></p>',
+]
+
+# LLMの応答に近いテキスト
+LLM_RESPONSES = [
+    'こんにちは！今日もいい天気ですね。散歩に行くのはとてもいいと思います！' * 3,
+    '## おすすめ\n\n**カフェ**に行くなら、*静かな*お店がいいかも！\n\n'
+    '- [お店A](https://example.com/a)\n- `お店B`\n\n---\n\n> 楽しんでね！',
+    '{"reply": "テスト"}\nそれはね、' + 'とても面白い話なんだけど。' * 10 + '\n\n\n\n以上！',
+]
+
+
+def legacy_strip_html(html: str) -> str:
+    """以前の strip_html（タグの除去のみ）"""
+    return re.sub(r'<[^>]+>', '', html)
+
+
+def legacy_html_to_text(html: str) -> str:
+    """以前の方式で現在の strip_html と同じ変換をしたもの（比較用）"""
+    html = re.sub(r'<br\s*/?>', '\n', html, flags=re.IGNORECASE)
+    html = re.sub(r'</p>\s*<p[^>]*>', '\n\n', html, flags=re.IGNORECASE)
+    html = re.sub(r'<[^>]+>', '', html)
+    return unescape(html)
+
+
+def legacy_remove_markdown(text: str) -> str:
+    plain_text = text
+    plain_text = re.sub(r'\[WebFetchTool\].*?(?=\n[^\[\s]|\Z)', '', plain_text, flags=re.DOTALL)
+    plain_text = re.sub(r'Loaded cached credentials\..*?\n?', '', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'\{.*?\}', '', plain_text, flags=re.DOTALL)
+    plain_text = re.sub(r'^[}\]\s]*$', '', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'^\s*[":,\[\]{}]\s*$', '', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'^\s*":\s*', '', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'```.*?```', '', plain_text, flags=re.DOTALL)
+    plain_text = re.sub(r'^#+\s*(.*)$', r'\1', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'\*\*([^\*]+)\*\*', r'\1', plain_text)
+    plain_text = re.sub(r'__([^_]+)__', r'\1', plain_text)
+    plain_text = re.sub(r'\*([^\*]+)\*', r'\1', plain_text)
+    plain_text = re.sub(r'_([^_]+)_', r'\1', plain_text)
+    plain_text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', plain_text)
+    plain_text = re.sub(r'^>\s*', '', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'`([^`]+)`', r'\1', plain_text)
+    plain_text = re.sub(r'^[-\*_]{3,}\s*$', '', plain_text, flags=re.MULTILINE)
+    plain_text = re.sub(r'\n\n+', '\n\n', plain_text).strip()
+    return plain_text
+
+
+def legacy_clean_stored_content(content: str) -> str:
+    content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL).strip()
+    content = re.sub(r'^@\S+\s+\d+/\d+:\s*', '', content)
+    content = re.sub(r'^(@\S+\s*)+', '', content)
+    return content.strip()
+
+
+def bench(name: str, legacy, current, inputs: list, number: int):
+    """2つの実装の実行時間を比較して表示"""
+    def run(func):
+        return min(timeit.repeat(lambda: [func(x) for x in inputs], number=number, repeat=5))
+
+    legacy_time = run(legacy)
+    current_time = run(current)
+    per_call = len(inputs) * number
+    print(
+        f"{name:<22} legacy {legacy_time / per_call * 1e6:8.2f} us/call"
+        f"   current {current_time / per_call * 1e6:8.2f} us/call"
+        f"   speedup x{legacy_time / current_time:.2f}"
+    )
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    # 保存済みの投稿は strip_html 済みのテキスト
+    stored = [strip_html(html) for html in MASTODON_HTML]
+
+    # 以前の strip_html はタグを除去するだけなので、同じ変換をする実装とも比較する
+    bench('strip_html (tags only)', legacy_strip_html, strip_html, MASTODON_HTML, number)
+    bench('strip_html', legacy_html_to_text, strip_html, MASTODON_HTML, number)
+    bench('remove_markdown', legacy_remove_markdown, remove_markdown, LLM_RESPONSES, number)
+    bench(
+        'clean (uncached)',
+        legacy_clean_stored_content,
+        lambda c: clean_content_for_log(remove_custom_prompt(c)),
+        stored,
+        number
+    )
+    bench('clean (cached)', legacy_clean_stored_content, clean_stored_content, stored, number)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ from .bot import MentionBot, create_client
 from .storage import get_storage, ConversationStorage
 from .processor import get_processor, PromptProcessor
 from .llm_interface import get_llm, OllamaInterface
+from .router import get_router, ModelRouter
 from .poster import MastodonPoster
 from .fetcher import get_thread_context, get_full_thread
 
@@ -19,6 +20,8 @@ __all__ = [
     'PromptProcessor',
     'get_llm',
     'OllamaInterface',
+    'get_router',
+    'ModelRouter',
     'MastodonPoster',
     'get_thread_context',
     'get_full_thread',
@@ -1,95 +1,495 @@
 """Mastodonボットのメインロジック"""
 import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
 from mastodon import Mastodon, StreamListener
 
-from .config import API_BASE_URL, ACCESS_TOKEN, DEFAULT_VISIBILITY
-from .utils import strip_html, snowflake_gen
-from .fetcher import get_full_thread
+from .config import (
+    API_BASE_URL, ACCESS_TOKEN, DEFAULT_VISIBILITY, STREAM_REPLIES, SUMMARY_ENABLED,
+    CATCH_UP_MAX_PAGES, CATCH_UP_PAGE_SIZE, COALESCE_MENTIONS
+)
+from .utils import strip_html, remove_markdown, snowflake_gen
+from .fetcher import get_full_thread, get_account_info, remember_replies
 from .processor import get_processor
-from .llm_interface import get_llm
+from .router import get_router
+from .response_cache import get_response_cache, persona_id
 from .poster import MastodonPoster
 from .storage import get_storage
+from .worker import MentionWorkerPool
+from .side_effects import SideEffectExecutor
+from .scheduler import get_scheduler, PRIORITY_FETCH
+from .metrics import (
+    StageTimer, SEGMENTS_POSTED_TOTAL, MENTIONS_COALESCED_TOTAL, QUEUE_SIZE, track, timed
+)
+
+# ステータスID→処理キーの対応を保持する最大件数
+MAX_STATUS_KEYS = 10000
+
+# 処理済みの通知IDを保存するキー
+NOTIFICATION_CURSOR_KEY = 'notification_cursor'
 
 
 class MentionBot(StreamListener):
     """メンションを処理するボット"""
 
-    def __init__(self, client: Mastodon):
+    def __init__(self, client: Mastodon, num_workers: Optional[int] = None):
         super().__init__()
         self.client = client
         self.poster = MastodonPoster(client)
         self.processor = get_processor()
-        self.llm = get_llm()
+        self.llm = get_router()
         self.storage = get_storage()
+        self.response_cache = get_response_cache()
+        self.workers = MentionWorkerPool(
+            self._process_mention,
+            num_workers,
+            merge=self._merge_mentions if COALESCE_MENTIONS else None
+        )
+        # お気に入りなどのAPI呼び出しと、ストレージへの書き込みは別のスレッドで実行
+        # （レート制限で待機中のお気に入りが保存を遅らせないように）
+        self.api_effects = SideEffectExecutor('api-effects')
+        self.storage_writes = SideEffectExecutor('storage-writes')
+        # 要約の更新はLLMの生成を待つため、保存とは別のスレッドで実行
+        # （返信の投稿後にワーカーを待たせず、他の会話の保存も遅らせないように）
+        self.summaries = SideEffectExecutor('summaries', max_retries=0)
+
+        # ボット自身のアカウント名（スレッド内のボットの投稿を判定するため）
+        account = get_account_info(client)
+        self.bot_acct = account.acct if account else None
+
+        # ステータスID→処理キー（同じ会話のメンションを順番に処理するため）
+        self._status_keys: OrderedDict[str, str] = OrderedDict()
+        self._status_keys_lock = threading.Lock()
+
+        # 通知カーソル（処理済みの通知ID）の管理
+        self._cursor_lock = threading.Lock()
+        self._inflight_notifications: set[int] = set()
+        self._max_done_notification: Optional[int] = None
+        self._last_swept: Optional[int] = None  # catch_up() で最後に確認した通知ID
+        self._resweep_from: Optional[int] = None  # ストリームの接続後に再確認する通知ID
+        self._cursor_hold: Optional[int] = None  # 再確認が終わるまでカーソルを止める通知ID
+
+        # ストリームと再確認のスレッドから同じメンションを二重に受け付けないようにする
+        self._accept_lock = threading.Lock()
+
+    def start(self):
+        """ワーカーとバックグラウンド処理を起動"""
+        self.api_effects.start()
+        self.storage_writes.start()
+        self.summaries.start()
+        self.workers.start()
+        QUEUE_SIZE.set_function(self.workers.qsize)
+
+    def stop(self, timeout: Optional[float] = None):
+        """ワーカーを停止し、残りのバックグラウンド処理を実行"""
+        self.workers.shutdown(timeout)
+        self.summaries.shutdown(timeout)
+        self.storage_writes.shutdown(timeout)
+        self.api_effects.shutdown(timeout)
 
     def on_notification(self, notification):
-        """通知を処理"""
+        """通知を処理（ストリームのスレッドではキューに積むだけ）"""
         if notification.type != 'mention':
             return
+        with self._accept_lock:
+            self._accept_mention(notification)
 
+    def _accept_mention(self, notification):
+        """メンションの通知を受け付けてキューに積む"""
         status = notification.status
         author_acct = status.account.acct
+
+        # 重複して届いた通知や、処理済みのメンションは無視
+        if self._is_known_mention(status):
+            logging.info(f"Skipping already handled mention {status.id} from @{author_acct}")
+            self._notification_done(int(notification.id))
+            return
+
         text = strip_html(status.content)
         logging.info(f"Mention from @{author_acct}: {text}")
 
+        notification_id = int(notification.id)
+        queued = False
         try:
-            self._handle_mention(status, author_acct, text)
+            key = self._conversation_key(status)
+            with self._cursor_lock:
+                self._inflight_notifications.add(notification_id)
+            queued = self.workers.submit(key, status, author_acct, text, (notification_id,), ())
         except Exception as e:
-            logging.error(f"Error handling mention: {e}", exc_info=True)
+            logging.error(f"Error queueing mention: {e}", exc_info=True)
+        if not queued:
+            # 処理中として残すとカーソルが止まるため取り除き、次の取りこぼしの確認で
+            # 再度受け付けられるようにする（処理済みとしては記録しない）
+            with self._cursor_lock:
+                self._inflight_notifications.discard(notification_id)
+            with self._status_keys_lock:
+                self._status_keys.pop(str(status.id), None)
+            logging.warning(f"Mention {status.id} was not queued (notification {notification_id})")
 
-    def _handle_mention(self, status, author_acct: str, text: str):
-        """メンションを処理"""
-        # スレッド全体を取得
-        convo = get_full_thread(self.client, status)
+    def _is_known_mention(self, status) -> bool:
+        """
+        メンションが受付済みか判定
+
+        このプロセスで受け付けたもの（メモリ上の対応表）と、
+        保存済みのもの（messages.status_id のインデックス）を確認する。
+        """
+        with self._status_keys_lock:
+            if str(status.id) in self._status_keys:
+                return True
+        return self.storage.is_status_known(str(status.id))
+
+    def catch_up(self, max_pages: Optional[int] = None, since: Optional[int] = None) -> int:
+        """
+        取りこぼしたメンションを通知APIから取得して処理
 
-        # 既存の会話IDを検索、なければ新規作成
-        conversation_id = self.storage.find_existing_conversation(convo)
-        if conversation_id:
-            logging.info(f"Found existing conversation ID: {conversation_id}")
+        起動時とストリームの再接続時に呼ぶ。保存済みの通知カーソル以降の
+        メンション通知を古い順にたどり、通常の処理に流す（処理済みのものは
+        on_notification で除外される）。カーソルがない初回起動時は、
+        過去の通知には返信せず、最新の通知IDをカーソルとして保存する。
+
+        Args:
+            max_pages: 取得する最大ページ数
+            since: この通知IDより後から取得（省略時は保存済みの通知カーソル）
+
+        Returns:
+            処理に回した通知の数
+        """
+        max_pages = CATCH_UP_MAX_PAGES if max_pages is None else max_pages
+        api = get_scheduler(self.client)
+        cursor = since if since is not None else self.storage.get_state(NOTIFICATION_CURSOR_KEY)
+
+        if cursor is None:
+            latest = api.call(PRIORITY_FETCH, self.client.notifications, limit=1)
+            if latest:
+                self.storage.set_state(NOTIFICATION_CURSOR_KEY, str(latest[0].id))
+            with self._cursor_lock:
+                self._last_swept = int(latest[0].id) if latest else 0
+            logging.info("No notification cursor yet, starting from the latest notification")
+            return 0
+
+        queued = 0
+        min_id = int(cursor)
+        for _ in range(max_pages):
+            page = api.call(
+                PRIORITY_FETCH,
+                self.client.notifications,
+                min_id=min_id,
+                types=['mention'],
+                limit=CATCH_UP_PAGE_SIZE
+            )
+            if not page:
+                break
+            for notification in sorted(page, key=lambda n: int(n.id)):
+                self.on_notification(notification)
+                queued += 1
+            min_id = max(int(n.id) for n in page)
         else:
-            conversation_id = snowflake_gen.generate()
-            logging.info(f"Generated new conversation ID: {conversation_id}")
+            logging.warning(f"Catch-up stopped after {max_pages} pages")
+
+        with self._cursor_lock:
+            self._last_swept = min_id
+        logging.info(f"Catch-up finished: {queued} notifications since {cursor}")
+        return queued
+
+    def expect_stream(self):
+        """
+        ストリームに接続する直前に呼び、接続後の取りこぼしの再確認を予約
+
+        catch_up() で最後に確認した通知より後で、ストリームが接続されるまでに
+        届いたメンションはどちらでも受け取れないため、接続後（最初のハートビート）に
+        その通知から再確認する。再確認が終わるまでは、後から届いたメンションの
+        処理が完了しても通知カーソルをその通知より先に進めない。
+        """
+        with self._cursor_lock:
+            if self._last_swept is None:
+                return
+            self._resweep_from = self._last_swept
+            self._cursor_hold = self._last_swept
+
+    def handle_heartbeat(self):
+        """ストリームのハートビート（接続の直後にも届く）で、予約した再確認を始める"""
+        with self._cursor_lock:
+            since, self._resweep_from = self._resweep_from, None
+        if since is not None:
+            threading.Thread(
+                target=self._resweep, args=(since,), name='catch-up', daemon=True
+            ).start()
+
+    def _resweep(self, since: int):
+        """ストリームの接続までに届いたメンションを処理し、通知カーソルの停止を解除"""
+        try:
+            self.catch_up(since=since)
+        except Exception as e:
+            logging.error(f"Failed to catch up mentions after connecting: {e}")
+            with self._cursor_lock:
+                # 次のハートビートで再試行
+                if self._resweep_from is None:
+                    self._resweep_from = since
+            return
+
+        with self._cursor_lock:
+            if self._cursor_hold == since:
+                self._cursor_hold = None
+            cursor = self._cursor_position()
+        if cursor is not None:
+            self.storage.advance_state(NOTIFICATION_CURSOR_KEY, cursor)
+
+    def _notification_done(self, notification_id: int):
+        """
+        通知の処理完了を記録し、通知カーソルを進める
 
-        # アクティブなプロンプトを決定
-        active_prompt, new_custom_prompt = self.processor.determine_active_prompt(
-            text, conversation_id
+        並列に処理中の通知を取りこぼさないよう、カーソルは処理中の最も古い
+        通知より前までしか進めない（ストリームの接続後の再確認が終わるまでは、
+        再確認を始める通知までしか進めない）。
+        """
+        with self._cursor_lock:
+            self._inflight_notifications.discard(notification_id)
+            if self._max_done_notification is None or notification_id > self._max_done_notification:
+                self._max_done_notification = notification_id
+            cursor = self._cursor_position()
+        self.storage.advance_state(NOTIFICATION_CURSOR_KEY, cursor)
+
+    def _cursor_position(self) -> Optional[int]:
+        """保存できる通知カーソル（_cursor_lock を取得して呼ぶ）"""
+        cursor = self._max_done_notification
+        if cursor is None:
+            return None
+        if self._inflight_notifications:
+            cursor = min(cursor, min(self._inflight_notifications) - 1)
+        if self._cursor_hold is not None:
+            cursor = min(cursor, self._cursor_hold)
+        return cursor
+
+    def _conversation_key(self, status) -> str:
+        """
+        メンションの処理キーを決定
+
+        同じ会話に属するメンションが同じキーになるように、
+        返信先の処理キー → 返信先の保存済み会話ID → 返信先（なければ自身）のIDの順で決める。
+
+        ストリームのスレッドでAPIを呼ばないよう、スレッドの起点は取得しない。
+        そのため、まだ受け付けも保存もしていない別々の投稿への返信は、同じ会話でも
+        別のキーになり、並列に処理されることがある。
+        """
+        key = None
+        parent_id = str(status.in_reply_to_id) if status.in_reply_to_id else None
+
+        if parent_id:
+            with self._status_keys_lock:
+                key = self._status_keys.get(parent_id)
+            if key is None:
+                conversation_id = self.storage.find_conversation_by_status(parent_id)
+                if conversation_id:
+                    key = f"conversation:{conversation_id}"
+
+        if key is None:
+            key = f"status:{parent_id or status.id}"
+
+        self._remember_keys([status.id], key)
+        return key
+
+    def _remember_keys(self, status_ids, key: str):
+        """ステータスIDと処理キーの対応を記録"""
+        with self._status_keys_lock:
+            for status_id in status_ids:
+                self._status_keys[str(status_id)] = key
+                self._status_keys.move_to_end(str(status_id))
+            while len(self._status_keys) > MAX_STATUS_KEYS:
+                self._status_keys.popitem(last=False)
+
+    def _merge_mentions(self, queued: tuple, new: tuple) -> Optional[tuple]:
+        """
+        同じ会話で待機中のメンションと新しいメンションをまとめる
+
+        同じ相手が待機中のメンションに続けて返信した場合は、最新のメンションに
+        だけ返信する（待機中のメンションは返信先の祖先としてスレッドの文脈に
+        含まれる）。同じ投稿への別の返信（兄弟）や、異なる相手からのメンションは
+        スレッドに含まれないため、まとめずに順番に返信する。
+
+        Args:
+            queued: 待機中のタスクの引数 (status, author_acct, text, 通知ID, まとめたステータスID)
+            new: 新しいタスクの引数
+
+        Returns:
+            まとめたタスクの引数（まとめない場合はNone）
+        """
+        queued_status, queued_acct, _, queued_notifications, queued_superseded = queued
+        status, author_acct, text, notifications, _ = new
+        if queued_acct != author_acct:
+            return None
+        if not status.in_reply_to_id or str(status.in_reply_to_id) != str(queued_status.id):
+            return None
+
+        MENTIONS_COALESCED_TOTAL.inc()
+        logging.info(f"Mention {queued_status.id} superseded by {status.id} from @{author_acct}")
+        return (
+            status,
+            author_acct,
+            text,
+            queued_notifications + notifications,
+            queued_superseded + (queued_status.id,)
         )
 
-        # システムプロンプトを更新
-        system_prompt = self.processor.build_system_prompt(active_prompt)
-        self.llm.update_system_prompt(system_prompt)
+    def _process_mention(
+        self,
+        key: str,
+        status,
+        author_acct: str,
+        text: str,
+        notification_ids: tuple,
+        superseded_ids: tuple
+    ):
+        """ワーカースレッドでメンションを処理"""
+        timer = StageTimer()
+        result = 'error'
+        posted_replies = []
+        try:
+            # まとめたメンションにも、受け付けたことが分かるようにお気に入りをつける
+            for status_id in superseded_ids:
+                self.api_effects.submit(
+                    'favourite', timed('favourite', self.poster.favourite_status), status_id
+                )
+            with track(timer):
+                # 同じ会話の前回の保存が終わってから処理する
+                with timer.stage('wait_save'):
+                    self.storage_writes.wait_for(key)
+                posted_replies = self._handle_mention(key, status, author_acct, text, timer)
+            if posted_replies:
+                # ボットの返信へのリプライも同じキーで処理する
+                self._remember_keys([s['id'] for s in posted_replies], key)
+            result = 'ok'
+        except Exception as e:
+            logging.error(f"Error handling mention: {e}", exc_info=True)
+        finally:
+            for notification_id in notification_ids:
+                self._notification_done(notification_id)
+            timer.finish(
+                result,
+                status_id=str(status.id),
+                key=key,
+                coalesced=len(superseded_ids),
+                segments=len(posted_replies) if posted_replies else 0
+            )
 
-        # メンション投稿にお気に入りをつける
-        self.poster.favourite_status(status.id)
+    def _handle_mention(self, key: str, status, author_acct: str, text: str, timer: StageTimer) -> list:
+        """メンションを処理"""
+        # 同じ会話の読み込みは1リクエスト内で1回だけにする
+        with self.storage.request_scope():
+            return self._handle_mention_in_scope(key, status, author_acct, text, timer)
 
-        # 会話プロンプトを構築
-        llm_prompt = self.processor.build_conversation_prompt(
-            convo,
-            conversation_id,
-            new_custom_prompt
+    def _handle_mention_in_scope(
+        self,
+        key: str,
+        status,
+        author_acct: str,
+        text: str,
+        timer: StageTimer
+    ) -> list:
+        """リクエストスコープ内でメンションを処理"""
+        # メンション投稿にお気に入りをつける（バックグラウンドで実行）
+        self.api_effects.submit(
+            'favourite', timed('favourite', self.poster.favourite_status), status.id
         )
 
-        # AIレスポンスを生成
-        response = self.llm.generate(llm_prompt)
-        logging.info(f"AI response: {response[:50]}...")
+        # 返信先が保存済みなら、スレッドを取得する前に会話が決まる
+        with timer.stage('db_lookup'):
+            conversation_id = self.storage.resolve_conversation(status)
+
+        # スレッド全体を取得
+        with timer.stage('fetch_thread'):
+            convo = get_full_thread(self.client, status)
+
+        with timer.stage('db_lookup'):
+            # 既存の会話IDを検索、なければ新規作成
+            if conversation_id is None:
+                conversation_id = self.storage.find_existing_conversation(convo)
+            if conversation_id:
+                logging.info(f"Found existing conversation ID: {conversation_id}")
+            else:
+                conversation_id = snowflake_gen.generate()
+                logging.info(f"Generated new conversation ID: {conversation_id}")
+
+            # 保存済みの会話データを1度だけ読み込む
+            context = self.storage.load_context(conversation_id, convo, self.bot_acct)
+
+        with timer.stage('prompt_build'):
+            # アクティブなプロンプトを決定
+            active_prompt, new_custom_prompt = self.processor.determine_active_prompt(
+                text, context
+            )
+            logging.info(f"Active persona: {persona_id(active_prompt)}")
+
+            # システムプロンプトを構築（リクエストごとにLLMへ渡す）
+            system_prompt = self.processor.build_system_prompt(active_prompt)
 
-        # Markdownを除去してクリーンな応答を取得
-        from .utils import remove_markdown
-        clean_response = remove_markdown(response)
+            # 会話のメッセージリストを構築（履歴はuser/assistantのターンとして前方一致を保つ）
+            messages = self.processor.build_chat_messages(
+                context,
+                system_prompt,
+                new_custom_prompt
+            )
 
         # visibilityを決定
         visibility = self._determine_visibility(status)
 
-        # 返信を投稿
-        posted_replies = self.poster.post_reply(
-            clean_response,
-            original_acct=author_acct,
-            reply_to_id=status.id,
-            visibility=visibility
-        )
+        # 同じプロンプトへの応答はキャッシュから返す（キャラクター設定ごとに有効化）
+        cache_key = None
+        cached_response = None
+        if self.response_cache.enabled_for(active_prompt):
+            with timer.stage('response_cache'):
+                cache_key = self.response_cache.make_key(self.llm.model, messages)
+                cached_response = self.response_cache.get(cache_key)
+
+        if STREAM_REPLIES:
+            chunks = self.llm.chat_stream(messages) if cached_response is None else iter([cached_response])
+            # 生成しながら、確定したセグメントから順に返信を投稿
+            # （生成と投稿が交互に進むため、まとめて1つの段階として計測する）
+            with timer.stage('llm_stream_post'):
+                posted_replies, response, completed = self.poster.post_reply_stream(
+                    chunks,
+                    original_acct=author_acct,
+                    reply_to_id=status.id,
+                    visibility=visibility
+                )
+            logging.info(f"AI response: {response[:50]}...")
+        else:
+            completed = True
+            # AIレスポンスを生成
+            if cached_response is not None:
+                response = cached_response
+            else:
+                with timer.stage('llm'):
+                    response = self.llm.chat(messages)
+            logging.info(f"AI response: {response[:50]}...")
+
+            # Markdownを除去してクリーンな応答を取得
+            with timer.stage('markdown'):
+                clean_response = remove_markdown(response)
+
+            # 返信を投稿
+            with timer.stage('post'):
+                posted_replies = self.poster.post_reply(
+                    clean_response,
+                    original_acct=author_acct,
+                    reply_to_id=status.id,
+                    visibility=visibility
+                )
 
-        # 投稿後のデータを更新
-        current_llm_content = self.llm.read_system_prompt() or active_prompt
+        if posted_replies:
+            SEGMENTS_POSTED_TOTAL.inc(len(posted_replies))
+
+        # 優先するモデルが最後まで応答し、すべて投稿できた場合だけキャッシュする
+        # （参照するキーは優先するモデルのため、フォールバックしたモデルの応答は保存しない）
+        if (cache_key and cached_response is None and completed
+                and self.llm.answered_model == self.llm.model):
+            self.storage_writes.submit(
+                'cache_response', self.response_cache.put, cache_key, self.llm.model, response
+            )
+
+        # 次の返信でスレッド取得を省略できるよう、投稿した返信をキャッシュ
+        if posted_replies:
+            remember_replies(posted_replies)
 
         # ボットの返信IDを記録
         bot_reply_ids = {str(s['id']) for s in posted_replies} if posted_replies else set()
@@ -98,19 +498,39 @@ class MentionBot(StreamListener):
         updated_convo = convo + posted_replies if posted_replies else convo
 
         # 既存データのカスタムプロンプトを取得
-        existing_data = self.storage.load_conversation(conversation_id)
-        existing_custom_prompt = existing_data.get("custom_prompt") if existing_data else None
+        existing_custom_prompt = context.custom_prompt
 
-        self.storage.save_conversation(
+        # 会話データを保存（バックグラウンドで実行し、同じ会話の次のメンションは完了を待つ）
+        self.storage_writes.submit(
+            'save_conversation',
+            timed('save', self.storage.save_conversation),
+            key=key,
             conversation_id=conversation_id,
             mention_status=status,
             thread_data=updated_convo,
-            ai_prompt=current_llm_content,
+            ai_prompt=system_prompt,
             ai_response=response,
             custom_prompt=new_custom_prompt if new_custom_prompt else existing_custom_prompt,
-            bot_reply_ids=bot_reply_ids
+            bot_reply_ids=bot_reply_ids,
+            known_status_ids=context.known_status_ids
         )
 
+        # プロンプトから省略された投稿を要約に追加（返信の投稿後にバックグラウンドで実行）
+        if SUMMARY_ENABLED:
+            self.summaries.submit(
+                'update_summary',
+                timed('summary', self._update_summary),
+                key, context, new_custom_prompt,
+                key=key
+            )
+
+        return posted_replies
+
+    def _update_summary(self, key: str, context, custom_prompt: Optional[str]):
+        """会話の保存を待ってから要約を更新（要約のスレッドで実行）"""
+        self.storage_writes.wait_for(key)
+        self.processor.update_summary(context, self.llm, custom_prompt)
+
     def _determine_visibility(self, status) -> str:
         """
         返信の公開設定を決定
@@ -142,7 +562,7 @@ def create_client() -> Mastodon:
         access_token=ACCESS_TOKEN,
         api_base_url=API_BASE_URL,
         request_timeout=60,
-        ratelimit_method='throw',
+        ratelimit_method='throw',  # レート制限はApiSchedulerで待機・再試行する
     )
     client.session.verify = False  # Disable SSL verification if needed
     return client
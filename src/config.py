@@ -24,6 +24,14 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
+# メトリクス・ログの設定
+# KEIBOT_METRICS_PORT: メトリクス（Prometheusテキスト形式）を公開するポート（0で無効）
+# KEIBOT_METRICS_HOST: メトリクスを公開するアドレス
+# KEIBOT_LOG_FORMAT: ログの形式（text: 通常, json: 1行ごとのJSON）
+METRICS_PORT = int(os.environ.get('KEIBOT_METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('KEIBOT_METRICS_HOST', '127.0.0.1')
+LOG_FORMAT = os.environ.get('KEIBOT_LOG_FORMAT', 'text').lower()
+
 # Environment variables
 API_BASE_URL = os.environ.get('MASTODON_API_BASE_URL', '')
 ACCESS_TOKEN = os.environ.get('MASTODON_ACCESS_TOKEN', '')
@@ -34,14 +42,115 @@ DATA_DIR = os.environ.get(
     os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
 )
 
+# スレッドキャッシュ設定
+# KEIBOT_THREAD_CACHE_TTL: 取得済みステータスを再利用する秒数（0で無効）
+# KEIBOT_THREAD_CACHE_SIZE: キャッシュするステータスの最大数
+THREAD_CACHE_TTL = float(os.environ.get('KEIBOT_THREAD_CACHE_TTL', '600'))
+THREAD_CACHE_SIZE = int(os.environ.get('KEIBOT_THREAD_CACHE_SIZE', '4096'))
+
+# SQLite設定
+# KEIBOT_SQLITE_CACHE_SIZE_KB: 接続ごとのページキャッシュサイズ（KB）
+# KEIBOT_SQLITE_MMAP_SIZE: メモリマップするデータベースのサイズ（バイト）
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('KEIBOT_SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_MMAP_SIZE = int(os.environ.get('KEIBOT_SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# エクスポート・インポートで1度に読み書きする行数（インポートはこの単位で1トランザクション）
+EXPORT_BATCH_SIZE = 5000
+
+# 会話データの保持設定
+# KEIBOT_RETENTION_DAYS: 最後の更新からこの日数が経った会話をアーカイブに移す（0で無効）
+# KEIBOT_RETENTION_INTERVAL: アーカイブとデータベースの最適化を実行する間隔（秒）
+# KEIBOT_ARCHIVE_PATH: アーカイブのデータベースのパス
+RETENTION_DAYS = float(os.environ.get('KEIBOT_RETENTION_DAYS', '0'))
+RETENTION_INTERVAL = float(os.environ.get('KEIBOT_RETENTION_INTERVAL', '3600'))
+ARCHIVE_PATH = os.environ.get('KEIBOT_ARCHIVE_PATH', os.path.join(DATA_DIR, 'archive.db'))
+# 1トランザクションでアーカイブする会話数
+RETENTION_BATCH_SIZE = 200
+
 # Ollama設定
 OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'gemma3:27b')
+# Ollamaへの同時リクエスト数の上限（Ollama側のOLLAMA_NUM_PARALLELに合わせる）
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get('OLLAMA_MAX_CONCURRENCY', '1'))
+# モデルをメモリに保持する時間（同じ会話の次の返信でKVキャッシュを再利用するため）
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')
+# ウォームアップと死活監視
+# OLLAMA_WARMUP: 起動時にすべてのモデルを、OLLAMA_MODEL が解放されたときはそのモデルを読み込むか
+# OLLAMA_HEALTH_INTERVAL: Ollamaの死活監視の間隔（秒、0で無効）
+OLLAMA_WARMUP = os.environ.get('OLLAMA_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get('OLLAMA_HEALTH_INTERVAL', '60'))
+# モデルの振り分けとフォールバック
+# OLLAMA_FALLBACK_MODELS: 混雑時・失敗時に使うモデル（カンマ区切り、優先順）
+# OLLAMA_LATENCY_SLO: 応答までの目標秒数（見込みがこれを超えるモデルは避ける、0で無効）
+# OLLAMA_TIMEOUT: 枠待ち・応答待ちのタイムアウト秒数（超えたら次のモデルを使う、0で無制限）
+OLLAMA_FALLBACK_MODELS = [
+    m.strip() for m in os.environ.get('OLLAMA_FALLBACK_MODELS', '').split(',') if m.strip()
+]
+OLLAMA_LATENCY_SLO = float(os.environ.get('OLLAMA_LATENCY_SLO', '0'))
+OLLAMA_TIMEOUT = float(os.environ.get('OLLAMA_TIMEOUT', '0'))
+# 処理時間の移動平均の重み（新しい計測値の割合）
+LLM_LATENCY_EWMA_ALPHA = 0.2
+# 生成中に確定したセグメントから順に返信を投稿するか
+STREAM_REPLIES = os.environ.get('KEIBOT_STREAM_REPLIES', 'false').lower() in ('1', 'true', 'yes')
 
 # 返信の公開設定
 # public: 公開, unlisted: 未収載, private: フォロワー限定, direct: ダイレクト
 # follow: 相手の投稿の公開設定に合わせる
 DEFAULT_VISIBILITY = os.environ.get('KEIBOT_VISIBILITY', 'follow')
 
+# Mastodon API呼び出しの設定
+# KEIBOT_API_MAX_RETRIES: レート制限・ネットワークエラー時の再試行回数
+# KEIBOT_API_BACKOFF_BASE: 再試行の待ち時間の基準秒数（再試行ごとに2倍）
+# KEIBOT_API_RATELIMIT_RESERVE: 返信の投稿のために残しておくAPI呼び出し回数
+API_MAX_RETRIES = int(os.environ.get('KEIBOT_API_MAX_RETRIES', '5'))
+API_BACKOFF_BASE = float(os.environ.get('KEIBOT_API_BACKOFF_BASE', '1.0'))
+API_RATELIMIT_RESERVE = int(os.environ.get('KEIBOT_API_RATELIMIT_RESERVE', '10'))
+
+# バックグラウンド処理（お気に入り・保存）の再試行回数
+SIDE_EFFECT_MAX_RETRIES = int(os.environ.get('KEIBOT_SIDE_EFFECT_MAX_RETRIES', '5'))
+
+# 取りこぼしたメンションの取得設定
+# KEIBOT_CATCH_UP_MAX_PAGES: 起動時・再接続時に取得する通知の最大ページ数
+# KEIBOT_STREAM_RECONNECT_DELAY: ストリームが切断されたときの再接続までの秒数
+CATCH_UP_MAX_PAGES = int(os.environ.get('KEIBOT_CATCH_UP_MAX_PAGES', '10'))
+CATCH_UP_PAGE_SIZE = 40
+STREAM_RECONNECT_DELAY = float(os.environ.get('KEIBOT_STREAM_RECONNECT_DELAY', '5'))
+
+# ワーカープール設定
+# KEIBOT_WORKERS: メンションを並列処理するワーカー数
+# KEIBOT_QUEUE_SIZE: 待機できるメンションの最大数
+WORKER_COUNT = int(os.environ.get('KEIBOT_WORKERS', '2'))
+WORKER_QUEUE_SIZE = int(os.environ.get('KEIBOT_QUEUE_SIZE', '100'))
+# KEIBOT_COALESCE_MENTIONS: 同じ相手が待機中のメンションに続けて返信したらまとめて最新の投稿にだけ返信するか
+# KEIBOT_COALESCE_WINDOW: まとめるために最後のメンションから待つ秒数（0で待たない）
+COALESCE_MENTIONS = os.environ.get('KEIBOT_COALESCE_MENTIONS', 'true').lower() in ('1', 'true', 'yes')
+COALESCE_WINDOW = float(os.environ.get('KEIBOT_COALESCE_WINDOW', '0'))
+
+# 会話プロンプトの設定
+# KEIBOT_PROMPT_MAX_CHARS: 会話ログの最大文字数
+# KEIBOT_PROMPT_HEAD_MESSAGES: 常に残す会話の先頭の投稿数
+# KEIBOT_PROMPT_TAIL_MESSAGES: 残す直近の投稿数の上限
+PROMPT_MAX_CHARS = int(os.environ.get('KEIBOT_PROMPT_MAX_CHARS', '6000'))
+PROMPT_HEAD_MESSAGES = int(os.environ.get('KEIBOT_PROMPT_HEAD_MESSAGES', '2'))
+PROMPT_TAIL_MESSAGES = int(os.environ.get('KEIBOT_PROMPT_TAIL_MESSAGES', '30'))
+# KEIBOT_PROMPT_WINDOW_STRIDE: 古い投稿を省略するときの単位（前方一致を保つため）
+PROMPT_WINDOW_STRIDE = int(os.environ.get('KEIBOT_PROMPT_WINDOW_STRIDE', '10'))
+
+# 応答キャッシュの設定
+# KEIBOT_RESPONSE_CACHE_PERSONAS: 応答キャッシュを使うキャラクター設定（カンマ区切り、空で無効）
+#   default: デフォルトのキャラクター, all: すべて, それ以外: ログに出力されるペルソナID
+# KEIBOT_RESPONSE_CACHE_TTL: キャッシュの有効期間（秒、0で無期限）
+# KEIBOT_RESPONSE_CACHE_SIZE: キャッシュする応答の最大数
+RESPONSE_CACHE_PERSONAS = [
+    p.strip() for p in os.environ.get('KEIBOT_RESPONSE_CACHE_PERSONAS', '').split(',') if p.strip()
+]
+RESPONSE_CACHE_TTL = float(os.environ.get('KEIBOT_RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('KEIBOT_RESPONSE_CACHE_SIZE', '1000'))
+
+# ローリング要約の設定
+# KEIBOT_SUMMARY_ENABLED: 省略した投稿を要約してプロンプトに含めるか
+# KEIBOT_SUMMARY_BATCH: 要約を更新する未要約の投稿数
+SUMMARY_ENABLED = os.environ.get('KEIBOT_SUMMARY_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+SUMMARY_BATCH = int(os.environ.get('KEIBOT_SUMMARY_BATCH', '10'))
+
 # Default character prompt
 DEFAULT_CHARACTER_PROMPT = """通常"""
 
@@ -53,6 +162,17 @@ SYSTEM_PROMPT_TEMPLATE = """あなたは指定されたキャラクターとし
 【キャラクター設定】
 """
 
+# Reply instruction for multi-turn chat messages
+CHAT_REPLY_INSTRUCTION = """【重要】以降のメッセージは会話ログです。
+ユーザーの投稿は「アカウント名: 内容」の形式で、あなたの過去の返信はアシスタントのメッセージです。
+会話の最後の投稿に対して、キャラクターとして自然に返信してください。"""
+
+# Summary prompt
+SUMMARY_SYSTEM_PROMPT = """あなたは会話の要約を作成するアシスタントです。
+これまでの要約と追加の会話ログをもとに、会話全体の要約を更新してください。
+登場人物、話題、約束や決定事項など、今後の返信に必要な情報を残し、400文字以内の日本語の文章で出力してください。
+要約以外の文章は出力しないでください。"""
+
 def validate_config():
     """設定を検証"""
     if not ACCESS_TOKEN:
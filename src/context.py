@@ -0,0 +1,67 @@
+"""メンション1件分の会話コンテキスト"""
+from typing import Optional
+
+
+class ConversationContext:
+    """
+    メンション1件の処理で使う会話コンテキスト
+
+    保存済みの会話データを1度だけ読み込み、プロンプト決定・
+    プロンプト構築・保存の各段階で共有する。
+    """
+
+    def __init__(
+        self,
+        conversation_id: int,
+        thread_data: list,
+        existing_data: Optional[dict] = None,
+        bot_acct: Optional[str] = None
+    ):
+        """
+        Args:
+            conversation_id: 会話ID
+            thread_data: APIから取得した現在のスレッド
+            existing_data: 保存済みの会話データ（新規会話ならNone）
+            bot_acct: ボット自身のアカウント名（未保存の投稿がボットの返信か判定するため）
+        """
+        self.conversation_id = conversation_id
+        self.thread_data = thread_data
+        self.existing_data = existing_data
+        self.bot_acct = bot_acct
+
+    @property
+    def is_new(self) -> bool:
+        """保存済みの会話データがないか"""
+        return self.existing_data is None
+
+    @property
+    def custom_prompt(self) -> Optional[str]:
+        """保存済みのカスタムプロンプト"""
+        return self.existing_data.get("custom_prompt") if self.existing_data else None
+
+    @property
+    def ai_prompt(self) -> Optional[str]:
+        """保存済みのAIプロンプト"""
+        return self.existing_data.get("ai_prompt") if self.existing_data else None
+
+    @property
+    def summary(self) -> Optional[str]:
+        """保存済みの会話の要約"""
+        return self.existing_data.get("summary") if self.existing_data else None
+
+    @property
+    def summary_message_count(self) -> int:
+        """要約に含まれている投稿数"""
+        return self.existing_data.get("summary_message_count", 0) if self.existing_data else 0
+
+    @property
+    def history(self) -> list[dict]:
+        """保存済みのメッセージ履歴"""
+        if self.existing_data and self.existing_data.get("thread_data"):
+            return self.existing_data["thread_data"]
+        return []
+
+    @property
+    def known_status_ids(self) -> set[str]:
+        """保存済みのステータスID"""
+        return {str(msg["id"]) for msg in self.history}
@@ -0,0 +1,231 @@
+"""会話データのエクスポートとインポート（JSONL / CSV / Parquet）"""
+import csv
+import gzip
+import json
+import logging
+import os
+import sys
+from typing import Iterator, Optional
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+from .config import EXPORT_BATCH_SIZE
+from .storage import ConversationStorage, EXPORT_COLUMNS, get_storage
+
+EXPORT_FORMATS = ('jsonl', 'csv', 'parquet')
+
+# 会話を先に書き出す（インポート時に会話の集計をトリガーで更新するため）
+TABLES = ('conversations', 'messages')
+
+# 整数のカラム（それ以外は文字列）
+INTEGER_COLUMNS = {'id', 'conversation_id', 'summary_message_count', 'is_bot_reply'}
+
+# NOT NULL のテキストのカラム（CSVの空の値を空文字列として読む）
+_NOT_NULL_TEXT_COLUMNS = {'account', 'content'}
+
+# JSONLの各行の種類
+_RECORD_TYPES = {'conversations': 'conversation', 'messages': 'message'}
+_RECORD_TABLES = {record_type: table for table, record_type in _RECORD_TYPES.items()}
+
+
+def _open_text(path: str, mode: str):
+    """テキストファイルを開く（拡張子が .gz ならgzip圧縮）"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _table_path(path: str, table: str, fmt: str) -> str:
+    """CSV・Parquetのテーブルごとのファイル（path はディレクトリ）"""
+    return os.path.join(path, f'{table}.{fmt}')
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError('Parquet requires pyarrow (pip install pyarrow)')
+
+
+def detect_format(path: str) -> str:
+    """インポートするファイルの形式を判定（ディレクトリならCSVまたはParquet）"""
+    if os.path.isdir(path):
+        for fmt in ('csv', 'parquet'):
+            if os.path.exists(_table_path(path, 'conversations', fmt)):
+                return fmt
+        raise ValueError(f'No conversations.csv or conversations.parquet in {path}')
+    return 'jsonl'
+
+
+def export_data(
+    path: str,
+    fmt: str = 'jsonl',
+    storage: Optional[ConversationStorage] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> dict[str, int]:
+    """
+    会話とメッセージをエクスポート
+
+    データベースはキーセットでバッチ単位に読み、読んだ分から書き出すため、
+    履歴の大きさによらずメモリ使用量は一定。読み込みは1つのスナップショットで行う。
+
+    Args:
+        path: JSONLはファイル（.gz でgzip圧縮）、CSV・Parquetはディレクトリ
+        fmt: jsonl / csv / parquet
+
+    Returns:
+        テーブルごとの件数
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+    if fmt == 'parquet':
+        _require_pyarrow()
+
+    storage = storage or get_storage()
+    counts = {table: 0 for table in TABLES}
+
+    with storage.snapshot():
+        if fmt == 'jsonl':
+            with _open_text(path, 'w') as f:
+                for table in TABLES:
+                    record_type = _RECORD_TYPES[table]
+                    for rows in storage.iter_rows(table, batch_size):
+                        for row in rows:
+                            f.write(json.dumps({'type': record_type, **row}, ensure_ascii=False) + '\n')
+                        counts[table] += len(rows)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for table in TABLES:
+                writer = _write_csv if fmt == 'csv' else _write_parquet
+                counts[table] = writer(
+                    _table_path(path, table, fmt), table, storage.iter_rows(table, batch_size)
+                )
+
+    logging.info(
+        f"Exported {counts['conversations']} conversations and "
+        f"{counts['messages']} messages to {path} ({fmt})"
+    )
+    return counts
+
+
+def _write_csv(path: str, table: str, batches: Iterator[list[dict]]) -> int:
+    count = 0
+    with _open_text(path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS[table])
+        writer.writeheader()
+        for rows in batches:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def _write_parquet(path: str, table: str, batches: Iterator[list[dict]]) -> int:
+    """バッチごとに1つの行グループとして書き出す"""
+    schema = pyarrow.schema([
+        (column, pyarrow.int64() if column in INTEGER_COLUMNS else pyarrow.string())
+        for column in EXPORT_COLUMNS[table]
+    ])
+    count = 0
+    with parquet.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+            count += len(rows)
+    return count
+
+
+def import_data(
+    path: str,
+    fmt: Optional[str] = None,
+    storage: Optional[ConversationStorage] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> dict[str, int]:
+    """
+    エクスポートしたデータをインポート
+
+    batch_size 行ごとにまとめて1トランザクションで挿入する。
+    保存済みの会話・メッセージ（同じ会話ID・ステータスID）はスキップする。
+
+    Args:
+        path: export_data() で書き出したファイルまたはディレクトリ
+        fmt: jsonl / csv / parquet（省略時は path から判定）
+
+    Returns:
+        テーブルごとの挿入した件数
+    """
+    fmt = fmt or detect_format(path)
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown import format: {fmt}')
+    if fmt == 'parquet':
+        _require_pyarrow()
+
+    storage = storage or get_storage()
+    counts = {table: 0 for table in TABLES}
+
+    if fmt == 'jsonl':
+        batches = _read_jsonl(path, batch_size)
+    else:
+        reader = _read_csv if fmt == 'csv' else _read_parquet
+        batches = (
+            (table, rows)
+            for table in TABLES
+            for rows in reader(_table_path(path, table, fmt), batch_size)
+        )
+
+    for table, rows in batches:
+        counts[table] += storage.insert_rows(table, rows)
+
+    logging.info(
+        f"Imported {counts['conversations']} conversations and "
+        f"{counts['messages']} messages from {path} ({fmt})"
+    )
+    return counts
+
+
+def _read_jsonl(path: str, batch_size: int) -> Iterator[tuple[str, list[dict]]]:
+    """JSONLを (テーブル, 行のリスト) のバッチとして読む（ファイル内の順序を保つ）"""
+    table, rows = None, []
+    with _open_text(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_table = _RECORD_TABLES.get(record.pop('type', None))
+            if record_table is None:
+                logging.warning(f"Skipping unknown record at line {line_number}")
+                continue
+            if rows and (record_table != table or len(rows) >= batch_size):
+                yield table, rows
+                rows = []
+            table = record_table
+            rows.append(record)
+    if rows:
+        yield table, rows
+
+
+def _read_csv(path: str, batch_size: int) -> Iterator[list[dict]]:
+    """CSVをバッチ単位で読む（空の値はNULL、整数のカラムは数値に変換）"""
+    # 長いプロンプトを含むフィールドを読めるように上限を上げる
+    csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+    rows = []
+    with _open_text(path, 'r') as f:
+        for row in csv.DictReader(f):
+            rows.append({column: _csv_value(column, value) for column, value in row.items()})
+            if len(rows) >= batch_size:
+                yield rows
+                rows = []
+    if rows:
+        yield rows
+
+
+def _csv_value(column: str, value: str):
+    if value == '':
+        return '' if column in _NOT_NULL_TEXT_COLUMNS else None
+    return int(value) if column in INTEGER_COLUMNS else value
+
+
+def _read_parquet(path: str, batch_size: int) -> Iterator[list[dict]]:
+    for batch in parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+        yield batch.to_pylist()
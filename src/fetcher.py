@@ -1,12 +1,93 @@
 """Mastodon APIからのデータ取得"""
 import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
 from mastodon import Mastodon
 
+from .config import THREAD_CACHE_TTL, THREAD_CACHE_SIZE
+from .scheduler import get_scheduler, PRIORITY_FETCH
+
+
+class ThreadCache:
+    """
+    取得済みステータスのキャッシュ（TTL・LRU）
+
+    ステータスIDごとにステータス本体を保持し、in_reply_to_id をたどって
+    ルートまでの祖先を組み立てる。途中のステータスが欠けているか
+    期限切れの場合はキャッシュミスとする。
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_size: Optional[int] = None):
+        self.ttl = THREAD_CACHE_TTL if ttl is None else ttl
+        self.max_size = THREAD_CACHE_SIZE if max_size is None else max_size
+        self._entries: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, status_id) -> Optional[object]:
+        """ステータスを取得（期限切れなら削除してNone）"""
+        key = str(status_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, status = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return status
+
+    def get_chain(self, status_id) -> Optional[list]:
+        """
+        ルートから指定したステータスまでの投稿リストを取得
+
+        Returns:
+            ルート→...→指定したステータスのリスト（キャッシュミスならNone）
+        """
+        if self.ttl <= 0:
+            return None
+        chain = []
+        with self._lock:
+            status = self._get(status_id)
+            while status is not None:
+                chain.append(status)
+                parent_id = status.in_reply_to_id
+                if parent_id is None:
+                    chain.reverse()
+                    return chain
+                if len(chain) > len(self._entries):
+                    break  # 循環の防止
+                status = self._get(parent_id)
+        return None
+
+    def remember(self, statuses: list):
+        """ステータスをキャッシュに追加"""
+        if self.ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for status in statuses:
+                key = str(status.id)
+                self._entries[key] = (now, status)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """キャッシュを空にする"""
+        with self._lock:
+            self._entries.clear()
+
+
+# グローバルキャッシュインスタンス
+thread_cache = ThreadCache()
+
 
 def get_thread_context(client: Mastodon, status_id: int) -> dict:
     """スレッドのコンテキスト（祖先と子孫）を取得"""
     try:
-        ctx = client.status_context(status_id)
+        ctx = get_scheduler(client).call(PRIORITY_FETCH, client.status_context, status_id)
         return {
             'ancestors': ctx.get('ancestors', []),
             'descendants': ctx.get('descendants', [])
@@ -17,15 +98,36 @@ def get_thread_context(client: Mastodon, status_id: int) -> dict:
 
 
 def get_full_thread(client: Mastodon, status) -> list:
-    """ステータスを含む完全なスレッドを取得"""
+    """
+    ステータスを含む完全なスレッドを取得
+
+    返信先までの祖先がキャッシュにあれば、APIを呼ばずにキャッシュから組み立てる。
+    メンションは投稿された直後のため、この場合の子孫は空とみなす。
+    """
+    if status.in_reply_to_id is not None:
+        chain = thread_cache.get_chain(status.in_reply_to_id)
+        if chain is not None:
+            logging.info(f"Thread cache hit for status {status.id} ({len(chain)} ancestors)")
+            thread_cache.remember([status])
+            return chain + [status]
+
     ctx = get_thread_context(client, status.id)
-    return ctx['ancestors'] + [status] + ctx['descendants']
+    ancestors = ctx['ancestors']
+    # 返信なのに祖先が空の場合は取得失敗とみなしてキャッシュしない
+    if ancestors or status.in_reply_to_id is None:
+        thread_cache.remember(ancestors + [status])
+    return ancestors + [status] + ctx['descendants']
+
+
+def remember_replies(posted_statuses: list):
+    """ボットが投稿した返信をキャッシュに追加（次の返信でスレッド取得を省略するため）"""
+    thread_cache.remember(posted_statuses)
 
 
 def get_status(client: Mastodon, status_id: int):
     """ステータスを取得"""
     try:
-        return client.status(status_id)
+        return get_scheduler(client).call(PRIORITY_FETCH, client.status, status_id)
     except Exception as e:
         logging.error(f"Failed to get status {status_id}: {e}")
         return None
@@ -34,7 +136,7 @@ def get_status(client: Mastodon, status_id: int):
 def get_account_info(client: Mastodon):
     """認証済みアカウントの情報を取得"""
     try:
-        return client.me()
+        return get_scheduler(client).call(PRIORITY_FETCH, client.me)
     except Exception as e:
         logging.error(f"Failed to get account info: {e}")
         return None
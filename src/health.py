@@ -0,0 +1,113 @@
+"""LLMのウォームアップと死活監視"""
+import logging
+import threading
+from typing import Optional
+
+from .config import OLLAMA_WARMUP, OLLAMA_HEALTH_INTERVAL
+from .llm_interface import OllamaInterface
+
+
+class LLMHealthMonitor:
+    """
+    モデルのウォームアップと定期的な死活監視
+
+    起動時にモデルを読み込んでシステムプロンプトのプリフィルを済ませ、
+    その後は一定間隔でOllamaに問い合わせる。優先するモデル（models の先頭）が
+    メモリから解放されていれば（OLLAMA_WARMUP が有効な場合）再度読み込むため、
+    モデルの読み込み時間がメンションへの返信に含まれない。
+    フォールバックのモデルは再度読み込まない（同時にメモリに載らない場合に、
+    優先するモデルを追い出し合うため）。
+    モデルごとの状態はメモリに読み込まれているかを表し、
+    いずれかのモデルが読み込まれていれば ready とする。
+    """
+
+    def __init__(
+        self,
+        models: list[OllamaInterface],
+        warmup_messages: list[dict],
+        interval: Optional[float] = None,
+        rewarm: Optional[bool] = None
+    ):
+        """
+        Args:
+            models: 監視するモデル
+            warmup_messages: ウォームアップで送るメッセージ
+            interval: 死活監視の間隔（秒、0で無効）
+            rewarm: 解放された優先するモデルを再度読み込むか
+        """
+        self.models = models
+        self.warmup_messages = warmup_messages
+        self.interval = OLLAMA_HEALTH_INTERVAL if interval is None else interval
+        self.rewarm = OLLAMA_WARMUP if rewarm is None else rewarm
+
+        self._lock = threading.Lock()
+        self._ready: dict[str, bool] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        """いずれかのモデルが読み込まれているか"""
+        with self._lock:
+            return any(self._ready.values())
+
+    def status(self) -> dict[str, bool]:
+        """モデルごとの状態（読み込まれているか）"""
+        with self._lock:
+            return dict(self._ready)
+
+    def _set_ready(self, llm: OllamaInterface, ready: bool):
+        with self._lock:
+            previous = self._ready.get(llm.model)
+            self._ready[llm.model] = ready
+        if previous is not None and previous != ready:
+            logging.info(f"Model {llm.model} is {'ready' if ready else 'not ready'}")
+
+    def warmup(self) -> bool:
+        """
+        すべてのモデルをウォームアップ
+
+        同時にメモリに載らない場合も優先するモデルが残るよう、優先順の逆に読み込む。
+        """
+        for llm in reversed(self.models):
+            try:
+                llm.warmup(self.warmup_messages)
+                self._set_ready(llm, True)
+            except Exception as e:
+                logging.error(f"Failed to warm up {llm.model}: {e}")
+                self._set_ready(llm, False)
+        return self.ready
+
+    def check(self) -> bool:
+        """すべてのモデルの状態を確認（優先するモデルが解放されていれば再度ウォームアップ）"""
+        for index, llm in enumerate(self.models):
+            try:
+                loaded = llm.is_loaded()
+                if not loaded and self.rewarm and index == 0:
+                    logging.info(f"Model {llm.model} is not loaded, warming up")
+                    llm.warmup(self.warmup_messages)
+                    loaded = True
+                self._set_ready(llm, loaded)
+            except Exception as e:
+                logging.warning(f"Health check failed for {llm.model}: {e}")
+                self._set_ready(llm, False)
+        return self.ready
+
+    def start(self):
+        """死活監視のスレッドを起動"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='llm-health', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """死活監視を停止"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
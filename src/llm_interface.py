@@ -1,81 +1,295 @@
 """LLM（Ollama）との通信インターフェース"""
 import logging
-from typing import Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
 try:
     import ollama
 except ImportError:
     ollama = None
 
-from .config import OLLAMA_MODEL
+from .config import (
+    OLLAMA_MODEL, OLLAMA_MAX_CONCURRENCY, OLLAMA_KEEP_ALIVE, OLLAMA_TIMEOUT, LLM_LATENCY_EWMA_ALPHA
+)
 from .utils import remove_markdown
+from .metrics import LLM_REQUESTS_TOTAL, record_llm_response, current_timer
+
+# Ollamaの応答エラー（パッケージがない場合はクライアントを渡したときだけ動作する）
+_RESPONSE_ERRORS = (ollama.ResponseError,) if ollama is not None else ()
+
+
+class OllamaBusyError(RuntimeError):
+    """タイムアウトまでに同時リクエスト枠が空かなかった"""
+
+
+def _model_tag(name: str) -> str:
+    """タグを省略したモデル名に :latest を補う"""
+    return name if ':' in name else f'{name}:latest'
 
 
 class OllamaInterface:
-    """Ollamaとの通信を担当"""
+    """
+    Ollamaとの通信を担当
 
-    def __init__(self, model: str = None):
+    システムプロンプトはリクエストごとに渡すため、
+    1つのインスタンスを複数のスレッドから同時に使用できる。
+    """
+
+    def __init__(
+        self,
+        model: str = None,
+        max_concurrency: Optional[int] = None,
+        client=None,
+        timeout: Optional[float] = None
+    ):
+        """
+        Args:
+            model: 使用するモデル名
+            max_concurrency: Ollamaへの同時リクエスト数の上限
+            client: Ollamaクライアント（省略時はollama.Client()）
+            timeout: 枠待ちと応答待ちのタイムアウト秒数（0で無制限）
+        """
         self.model = model or OLLAMA_MODEL
-        self._system_prompt: Optional[str] = None
+        self.max_concurrency = max_concurrency or OLLAMA_MAX_CONCURRENCY
+        self.timeout = OLLAMA_TIMEOUT if timeout is None else timeout
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._client = client
 
-        if ollama is None:
-            logging.error("ollama package not installed. Run: pip install ollama")
+        # ルーティング用の統計（処理中・枠待ちの数と処理時間の移動平均）
+        self._stats_lock = threading.Lock()
+        self._pending = 0
+        self._latency: Optional[float] = None
 
-    def update_system_prompt(self, system_prompt: str) -> bool:
-        """システムプロンプトを設定"""
-        self._system_prompt = system_prompt
-        logging.info(f'Updated system prompt ({len(system_prompt)} chars)')
-        return True
+        if self._client is None:
+            if ollama is None:
+                logging.error("ollama package not installed. Run: pip install ollama")
+            else:
+                self._client = ollama.Client(timeout=self.timeout or None)
 
-    def read_system_prompt(self) -> Optional[str]:
-        """現在のシステムプロンプトを取得"""
-        return self._system_prompt
+    def build_messages(self, user_prompt: str, system_prompt: Optional[str] = None) -> list[dict]:
+        """システムプロンプトとユーザープロンプトからメッセージを構築"""
+        messages = []
 
-    def generate(self, user_prompt: str) -> str:
-        """Ollamaでテキストを生成"""
-        if ollama is None:
-            return 'Error: ollama package not installed.'
+        # システムプロンプトがあれば追加
+        if system_prompt:
+            messages.append({
+                "role": "system",
+                "content": system_prompt
+            })
+
+        # ユーザーメッセージを追加
+        messages.append({
+            "role": "user",
+            "content": user_prompt
+        })
+        return messages
 
+    @property
+    def pending(self) -> int:
+        """処理中と枠待ちのリクエスト数"""
+        with self._stats_lock:
+            return self._pending
+
+    @property
+    def latency(self) -> Optional[float]:
+        """1リクエストの処理時間の指数移動平均（秒、未計測の場合はNone）"""
+        with self._stats_lock:
+            return self._latency
+
+    def _observe_latency(self, seconds: float):
+        """処理時間を指数移動平均に反映"""
+        with self._stats_lock:
+            if self._latency is None:
+                self._latency = seconds
+            else:
+                self._latency += LLM_LATENCY_EWMA_ALPHA * (seconds - self._latency)
+
+    @contextmanager
+    def _slot(self, observe: bool = True):
+        """
+        同時リクエスト枠を確保
+
+        タイムアウトが設定されている場合、時間内に枠が空かなければ OllamaBusyError を送出する。
+        observe が真なら、枠を確保してから解放するまでの時間を処理時間として記録する。
+        """
+        with self._stats_lock:
+            self._pending += 1
         try:
-            # メッセージを構築
-            messages = []
+            if not self._slots.acquire(timeout=self.timeout or None):
+                raise OllamaBusyError(f"{self.model} is busy ({self.max_concurrency} requests in progress)")
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._slots.release()
+                if observe:
+                    self._observe_latency(time.perf_counter() - start)
+        finally:
+            with self._stats_lock:
+                self._pending -= 1
 
-            # システムプロンプトがあれば追加
-            if self._system_prompt:
-                messages.append({
-                    "role": "system",
-                    "content": self._system_prompt
-                })
+    def warmup(self, messages: list[dict]) -> float:
+        """
+        モデルを読み込み、メッセージのプリフィルを済ませておく
 
-            # ユーザーメッセージを追加
-            messages.append({
-                "role": "user",
-                "content": user_prompt
-            })
+        1トークンだけ生成させ、OLLAMA_KEEP_ALIVE の間モデルをメモリに保持させる。
+        読み込みにかかる時間は処理時間の移動平均に含めない。
 
-            logging.info(f"Sending to Ollama ({self.model}): {len(messages)} messages")
+        Returns:
+            かかった秒数（失敗時は例外を送出）
+        """
+        if self._client is None:
+            raise RuntimeError('ollama package not installed.')
 
-            # Ollamaでチャット
-            response = ollama.chat(
+        start = time.perf_counter()
+        with self._slot(observe=False):
+            self._client.chat(
                 model=self.model,
-                messages=messages
+                messages=messages,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                options={'num_predict': 1}
             )
+        elapsed = time.perf_counter() - start
+        logging.info(f"Warmed up {self.model} in {elapsed:.1f}s")
+        return elapsed
+
+    def is_loaded(self) -> bool:
+        """モデルがOllamaのメモリに読み込まれているか確認（接続できない場合は例外を送出）"""
+        if self._client is None:
+            raise RuntimeError('ollama package not installed.')
+
+        wanted = _model_tag(self.model)
+        for entry in self._client.ps()['models']:
+            for field in ('model', 'name'):
+                try:
+                    name = entry[field]
+                except (KeyError, TypeError):
+                    continue
+                if name and _model_tag(name) == wanted:
+                    return True
+        return False
+
+    def request_chat(self, messages: list[dict]) -> str:
+        """
+        メッセージのリストをOllamaに送信してテキストを生成（失敗時は例外を送出）
 
-            # レスポンスからテキストを取得
-            content = response['message']['content']
-            logging.info(f"Ollama response received ({len(content)} chars)")
-            return content
+        Raises:
+            OllamaBusyError: タイムアウトまでに同時リクエスト枠が空かなかった場合
+        """
+        if self._client is None:
+            raise RuntimeError('ollama package not installed.')
 
-        except ollama.ResponseError as e:
+        logging.info(f"Sending to Ollama ({self.model}): {len(messages)} messages")
+        try:
+            # 同時リクエスト数を制限してチャット
+            with self._slot():
+                response = self._client.chat(
+                    model=self.model,
+                    messages=messages,
+                    keep_alive=OLLAMA_KEEP_ALIVE
+                )
+        except Exception:
+            LLM_REQUESTS_TOTAL.inc(model=self.model, result='error')
+            raise
+
+        # レスポンスからテキストを取得
+        content = response['message']['content']
+        stats = record_llm_response(self.model, response, current_timer())
+        LLM_REQUESTS_TOTAL.inc(model=self.model, result='ok')
+        logging.info(
+            f"Ollama response received ({len(content)} chars, "
+            f"{stats.get('prompt_eval_count', '?')} prompt tokens, {stats.get('eval_count', '?')} tokens)"
+        )
+        return content
+
+    def request_chat_stream(self, messages: list[dict]) -> Iterator[str]:
+        """
+        メッセージのリストをOllamaに送信し、生成されたテキストを逐次返す（失敗時は例外を送出）
+
+        ストリームを最後まで読むか閉じるまで同時リクエスト枠を占有する。
+        """
+        if self._client is None:
+            raise RuntimeError('ollama package not installed.')
+
+        received = 0
+        logging.info(f"Streaming from Ollama ({self.model}): {len(messages)} messages")
+        try:
+            with self._slot():
+                stream = self._client.chat(
+                    model=self.model,
+                    messages=messages,
+                    stream=True,
+                    keep_alive=OLLAMA_KEEP_ALIVE
+                )
+                last = None
+                try:
+                    for part in stream:
+                        last = part
+                        content = part['message']['content']
+                        if content:
+                            received += len(content)
+                            yield content
+                finally:
+                    # 途中で閉じられた場合も応答を閉じ、Ollamaの生成を止める
+                    close = getattr(stream, 'close', None)
+                    if close is not None:
+                        close()
+        except Exception:
+            LLM_REQUESTS_TOTAL.inc(model=self.model, result='error')
+            raise
+
+        # トークン数と処理時間は最後のレスポンスに含まれる
+        stats = record_llm_response(self.model, last, current_timer()) if last is not None else {}
+        LLM_REQUESTS_TOTAL.inc(model=self.model, result='ok')
+        logging.info(
+            f"Ollama stream finished ({received} chars, "
+            f"{stats.get('prompt_eval_count', '?')} prompt tokens, {stats.get('eval_count', '?')} tokens)"
+        )
+
+    def chat(self, messages: list[dict]) -> str:
+        """メッセージのリストをOllamaに送信してテキストを生成"""
+        try:
+            return self.request_chat(messages)
+        except _RESPONSE_ERRORS as e:
             logging.error(f'Ollama response error: {e}')
             return 'Error: Ollama response error.'
         except Exception as e:
             logging.error(f'Unexpected error calling Ollama: {e}')
             return f'Error: {str(e)}'
 
-    def generate_clean(self, user_prompt: str) -> str:
+    def chat_stream(self, messages: list[dict]) -> Iterator[str]:
+        """
+        メッセージのリストをOllamaに送信し、生成されたテキストを逐次返す
+
+        ストリームを最後まで読むか閉じるまで同時リクエスト枠を占有する。
+        """
+        received = False
+        try:
+            for content in self.request_chat_stream(messages):
+                received = True
+                yield content
+        except _RESPONSE_ERRORS as e:
+            logging.error(f'Ollama response error: {e}')
+            if not received:
+                yield 'Error: Ollama response error.'
+        except Exception as e:
+            logging.error(f'Unexpected error calling Ollama: {e}')
+            if not received:
+                yield f'Error: {str(e)}'
+
+    def generate_stream(self, user_prompt: str, system_prompt: Optional[str] = None) -> Iterator[str]:
+        """Ollamaでテキストをストリーミング生成"""
+        return self.chat_stream(self.build_messages(user_prompt, system_prompt))
+
+    def generate(self, user_prompt: str, system_prompt: Optional[str] = None) -> str:
+        """Ollamaでテキストを生成"""
+        return self.chat(self.build_messages(user_prompt, system_prompt))
+
+    def generate_clean(self, user_prompt: str, system_prompt: Optional[str] = None) -> str:
         """Ollamaでテキストを生成し、Markdownを除去"""
-        response = self.generate(user_prompt)
+        response = self.generate(user_prompt, system_prompt)
         return remove_markdown(response)
 
 
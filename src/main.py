@@ -1,17 +1,41 @@
 """Keibotエントリーポイント"""
 import logging
 import sys
+import time
+from mastodon import MastodonNetworkError, MastodonServerError
 
-from .config import validate_config
+from .config import (
+    validate_config, STREAM_RECONNECT_DELAY, METRICS_HOST, METRICS_PORT, LOG_FORMAT, OLLAMA_WARMUP
+)
+from .metrics import configure_json_logging, start_metrics_server, set_readiness
 from .bot import create_client, MentionBot
+from .health import LLMHealthMonitor
+from .processor import get_processor
+from .retention import RetentionJob
+from .router import get_router
+from .storage import get_storage
 
 
 def main():
     """ボットを起動"""
+    # ログの形式を設定
+    if LOG_FORMAT == 'json':
+        configure_json_logging()
+
     # 設定を検証
     if not validate_config():
         sys.exit(1)
 
+    # メトリクスを公開
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Failed to start metrics endpoint: {e}")
+
+    # モデルを読み込んでから受付を始める（最初のメンションに読み込み時間を含めない）
+    monitor = start_health_monitor()
+
     # クライアントを作成
     client = create_client()
 
@@ -24,15 +48,70 @@ def main():
 
     # ボットを作成して開始
     bot = MentionBot(client)
-    logging.info('Starting Mastodon mention stream...')
+    bot.start()
+
+    # 古い会話のアーカイブとデータベースの最適化（KEIBOT_RETENTION_DAYS を設定した場合）
+    retention = RetentionJob()
+    retention.start()
 
     try:
-        client.stream_user(bot)
+        run_stream(client, bot)
     except KeyboardInterrupt:
         logging.info('Shutting down bot.')
     except Exception as e:
         logging.error(f'Stream error: {e}')
         raise
+    finally:
+        bot.stop()
+        monitor.stop()
+        retention.stop()
+        get_storage().close()
+
+
+def start_health_monitor() -> LLMHealthMonitor:
+    """モデルのウォームアップと死活監視を開始（状態は /ready に反映）"""
+    monitor = LLMHealthMonitor(get_router().models, get_processor().build_warmup_messages())
+    set_readiness(lambda: monitor.ready)
+
+    if OLLAMA_WARMUP:
+        logging.info('Warming up models...')
+        ready = monitor.warmup()
+    else:
+        ready = monitor.check()
+    if not ready:
+        logging.warning('No model is loaded yet; the first mentions may wait for a model to load or fail until Ollama is available')
+
+    monitor.start()
+    return monitor
+
+
+def run_stream(client, bot: MentionBot):
+    """
+    ストリームを監視（切断されたら再接続）
+
+    接続のたびに、切断中に届いたメンションを通知APIから取得して処理する。
+    取得してから接続するまでの間に届いたメンションは、接続後に再度取得する
+    （MentionBot.expect_stream）。
+    """
+    delay = STREAM_RECONNECT_DELAY
+    while True:
+        try:
+            bot.catch_up()
+        except Exception as e:
+            logging.error(f'Failed to catch up missed mentions: {e}')
+
+        logging.info('Starting Mastodon mention stream...')
+        bot.expect_stream()
+        try:
+            client.stream_user(bot)
+            logging.warning('Stream ended')
+            delay = STREAM_RECONNECT_DELAY
+        except (MastodonNetworkError, MastodonServerError) as e:
+            logging.error(f'Stream disconnected: {e}')
+
+        logging.info(f'Reconnecting in {delay:.0f}s...')
+        time.sleep(delay)
+        delay = min(delay * 2, 300)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,414 @@
+"""処理時間・件数の計測とメトリクスの公開（Prometheusテキスト形式）"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+# 処理時間のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labels: dict) -> str:
+    """ラベルをPrometheusテキスト形式に変換"""
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value: float) -> str:
+    """値をPrometheusテキスト形式に変換"""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """増加のみするカウンター"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        """カウンターを増やす"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """現在の値を取得"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list[str]:
+        """Prometheusテキスト形式の行を返す"""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            labels = _format_labels(dict(zip(self.labelnames, key)))
+            lines.append(f'{self.name}{labels} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """現在値を取得関数から読み出すゲージ"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._func: Optional[Callable[[], float]] = None
+
+    def set_function(self, func: Optional[Callable[[], float]]):
+        """値を返す関数を設定"""
+        self._func = func
+
+    def render(self) -> list[str]:
+        """Prometheusテキスト形式の行を返す"""
+        if self._func is None:
+            return []
+        try:
+            value = self._func()
+        except Exception as e:
+            logging.warning(f"Failed to read gauge {self.name}: {e}")
+            return []
+        return [
+            f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {_format_value(value)}'
+        ]
+
+
+class Histogram:
+    """値の分布を区切りごとの累積件数で記録するヒストグラム"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # ラベル→[区切りごとの件数..., 合計, 件数]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        """値を記録"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def get(self, **labels) -> tuple[float, int]:
+        """記録した値の合計と件数を取得"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            return (entry[-2], entry[-1]) if entry else (0.0, 0)
+
+    def render(self) -> list[str]:
+        """Prometheusテキスト形式の行を返す"""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, list(entry)) for key, entry in self._values.items())
+        for key, entry in items:
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:-2] + [entry[-1]]):
+                bucket_labels = _format_labels({**labels, 'le': _format_value(bound)})
+                lines.append(f'{self.name}_bucket{bucket_labels} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(entry[-2])}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {entry[-1]}')
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスの登録と出力"""
+
+    def __init__(self):
+        self._metrics: list = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        """カウンターを登録"""
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        """ゲージを登録"""
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """ヒストグラムを登録"""
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        """全メトリクスをPrometheusテキスト形式で出力"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# デフォルトのレジストリとメトリクス
+registry = MetricsRegistry()
+
+MENTIONS_TOTAL = registry.counter(
+    'keibot_mentions_total', 'Mentions processed.', ('result',)
+)
+MENTIONS_COALESCED_TOTAL = registry.counter(
+    'keibot_mentions_coalesced_total', 'Queued mentions superseded by a newer mention in the same conversation.'
+)
+SEGMENTS_POSTED_TOTAL = registry.counter(
+    'keibot_segments_posted_total', 'Reply segments posted.'
+)
+LLM_REQUESTS_TOTAL = registry.counter(
+    'keibot_llm_requests_total', 'Requests sent to Ollama.', ('model', 'result')
+)
+LLM_TOKENS_TOTAL = registry.counter(
+    'keibot_llm_tokens_total', 'Tokens reported by Ollama (prompt_eval_count / eval_count).', ('model', 'kind')
+)
+LLM_ROUTED_TOTAL = registry.counter(
+    'keibot_llm_routed_total', 'Model chosen by the router.', ('model', 'reason')
+)
+LLM_FALLBACKS_TOTAL = registry.counter(
+    'keibot_llm_fallbacks_total', 'Failed model requests that fell back to the next model.', ('model', 'reason')
+)
+RESPONSE_CACHE_TOTAL = registry.counter(
+    'keibot_response_cache_total', 'Response cache lookups.', ('result',)
+)
+CONVERSATIONS_ARCHIVED_TOTAL = registry.counter(
+    'keibot_conversations_archived_total', 'Idle conversations moved to the archive database.'
+)
+MENTION_SECONDS = registry.histogram(
+    'keibot_mention_seconds', 'Time from dequeue to finished reply per mention.'
+)
+STAGE_SECONDS = registry.histogram(
+    'keibot_stage_seconds', 'Time spent in each pipeline stage.', ('stage',)
+)
+QUEUE_SIZE = registry.gauge(
+    'keibot_queue_size', 'Mentions waiting in the worker queue.'
+)
+READY = registry.gauge(
+    'keibot_ready', 'Whether at least one model can answer (1) or not (0).'
+)
+
+# 準備完了かを返す関数（/ready で使用）
+_readiness: Optional[Callable[[], bool]] = None
+
+
+def set_readiness(func: Optional[Callable[[], bool]]):
+    """準備完了かを返す関数を設定（/ready とゲージ keibot_ready に反映）"""
+    global _readiness
+    _readiness = func
+    READY.set_function((lambda: 1 if func() else 0) if func else None)
+
+
+def is_ready() -> bool:
+    """準備完了か（関数が設定されていない間は準備中とみなす）"""
+    return bool(_readiness and _readiness())
+
+
+class StageTimer:
+    """
+    メンション1件の処理段階ごとの時間を計測
+
+    計測した時間はヒストグラムに記録し、finish() でまとめてログに出力する。
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """with ブロックの処理時間を段階 name として記録"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        """段階の処理時間を記録（同じ段階は合算）"""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+    def finish(self, result: str, **fields):
+        """全体の処理時間と結果を記録してログに出力"""
+        total = time.perf_counter() - self.started
+        MENTION_SECONDS.observe(total)
+        MENTIONS_TOTAL.inc(result=result)
+
+        summary = ' '.join(f'{name}={seconds:.3f}s' for name, seconds in self.stages.items())
+        logging.info(
+            f"Mention {result} in {total:.3f}s ({summary})",
+            extra={'event': 'mention', 'fields': {
+                'result': result,
+                'total_seconds': round(total, 6),
+                'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                **fields
+            }}
+        )
+
+
+def timed(stage: str, func: Callable) -> Callable:
+    """関数の実行時間を段階 stage として記録するラッパーを返す（バックグラウンド処理用）"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+    return wrapper
+
+
+def _response_field(response, name: str):
+    """Ollamaのレスポンス（dictまたはレスポンスオブジェクト）から値を取得"""
+    try:
+        value = response[name]
+    except (KeyError, TypeError, IndexError):
+        value = getattr(response, name, None)
+    return value
+
+
+def record_llm_response(model: str, response, timer: Optional[StageTimer] = None) -> dict:
+    """
+    Ollamaの最終レスポンスからトークン数と処理時間を記録
+
+    prompt_eval_count / eval_count はトークン数、
+    prompt_eval_duration / eval_duration はナノ秒単位の処理時間（プリフィル・生成）。
+
+    Returns:
+        記録した値
+    """
+    stats = {}
+    for name in ('prompt_eval_count', 'eval_count', 'prompt_eval_duration', 'eval_duration'):
+        value = _response_field(response, name)
+        if value is not None:
+            stats[name] = value
+
+    if 'prompt_eval_count' in stats:
+        LLM_TOKENS_TOTAL.inc(stats['prompt_eval_count'], model=model, kind='prompt')
+    if 'eval_count' in stats:
+        LLM_TOKENS_TOTAL.inc(stats['eval_count'], model=model, kind='completion')
+
+    for name, stage in (('prompt_eval_duration', 'llm_prefill'), ('eval_duration', 'llm_generate')):
+        if name in stats:
+            seconds = stats[name] / 1e9
+            if timer is not None:
+                timer.record(stage, seconds)
+            else:
+                STAGE_SECONDS.observe(seconds, stage=stage)
+    return stats
+
+
+# 現在のスレッドで処理中のメンションの計測（LLM呼び出しから参照する）
+_current = threading.local()
+
+
+@contextmanager
+def track(timer: Optional[StageTimer]):
+    """現在のスレッドの計測を設定（None の間はメンションの計測に含めない）"""
+    previous = getattr(_current, 'timer', None)
+    _current.timer = timer
+    try:
+        yield timer
+    finally:
+        _current.timer = previous
+
+
+def current_timer() -> Optional[StageTimer]:
+    """現在のスレッドで処理中のメンションの計測を取得"""
+    return getattr(_current, 'timer', None)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """ログを1行のJSONとして出力（extra の event / fields を含める）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        event = getattr(record, 'event', None)
+        if event:
+            data['event'] = event
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def configure_json_logging():
+    """ルートロガーの出力をJSON形式に切り替える"""
+    formatter = JsonLogFormatter()
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(formatter)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics、/healthz（プロセスの生存）、/ready（準備完了）を返すHTTPハンドラ"""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            self._send(200, registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/healthz':
+            self._send(200, 'ok\n')
+        elif path == '/ready':
+            if is_ready():
+                self._send(200, 'ready\n')
+            else:
+                self._send(503, 'not ready\n')
+        else:
+            self.send_error(404)
+
+    def _send(self, code: int, text: str, content_type: str = 'text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスログは出力しない
+        pass
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    """メトリクスのHTTPサーバーをバックグラウンドで起動"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logging.info(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -1,9 +1,11 @@
 """Mastodonへの投稿処理"""
 import logging
+import uuid
 from mastodon import Mastodon
-from typing import Optional
+from typing import Iterable, Optional
 
-from .utils import split_into_segments
+from .utils import split_into_segments, SegmentStreamer
+from .scheduler import get_scheduler, PRIORITY_REPLY, PRIORITY_BACKGROUND
 
 
 class MastodonPoster:
@@ -11,6 +13,22 @@ class MastodonPoster:
 
     def __init__(self, client: Mastodon):
         self.client = client
+        self.api = get_scheduler(client)
+
+    def _status_post(self, text: str, in_reply_to_id: Optional[int], visibility: str):
+        """
+        スケジューラ経由でステータスを投稿
+
+        再試行で二重投稿にならないよう、投稿ごとに冪等キーを付ける。
+        """
+        return self.api.call(
+            PRIORITY_REPLY,
+            self.client.status_post,
+            status=text,
+            in_reply_to_id=in_reply_to_id,
+            visibility=visibility,
+            idempotency_key=uuid.uuid4().hex
+        )
 
     def post_status(
         self,
@@ -20,11 +38,7 @@ class MastodonPoster:
     ):
         """単一のステータスを投稿"""
         try:
-            status = self.client.status_post(
-                status=text,
-                in_reply_to_id=in_reply_to_id,
-                visibility=visibility
-            )
+            status = self._status_post(text, in_reply_to_id, visibility)
             logging.info(f"Posted status (ID: {status['id']})")
             return status
         except Exception as e:
@@ -65,11 +79,7 @@ class MastodonPoster:
             logging.info(f"Reply {idx+1}/{total}: {text[:60]}...")
 
             try:
-                status = self.client.status_post(
-                    status=text,
-                    in_reply_to_id=prev_id,
-                    visibility=visibility
-                )
+                status = self._status_post(text, prev_id, visibility)
                 posted_statuses.append(status)
                 prev_id = status['id']
                 logging.info(f"Posted reply {idx+1} (ID: {status['id']}, visibility: {visibility})")
@@ -104,10 +114,87 @@ class MastodonPoster:
         logging.info(f"Posting {len(segments)} segments with visibility: {visibility}")
         return self.post_thread(segments, original_acct, reply_to_id, visibility)
 
+    def post_reply_stream(
+        self,
+        chunks: Iterable[str],
+        original_acct: str,
+        reply_to_id: int,
+        max_len: int = 400,
+        visibility: str = 'public'
+    ) -> tuple[list, str, bool]:
+        """
+        ストリーミング生成されるテキストを、確定したセグメントから順に返信
+
+        全体の件数は生成が終わるまで分からないため、生成中に投稿する
+        セグメントは "1:" のように番号のみを付け、最後にまとめて投稿する
+        セグメントに "3/3:" のように全体の件数を付ける。
+        投稿に失敗した場合は生成を中断し、チャンクのイテレータを閉じる
+        （LLMの同時リクエスト枠をすぐに返すため）。
+
+        Args:
+            chunks: 生成されたテキストのチャンク
+            original_acct: メンションするアカウント
+            reply_to_id: 返信先のステータスID
+            max_len: セグメントの最大長
+            visibility: 公開設定 (public, unlisted, private, direct)
+
+        Returns:
+            (投稿したstatusオブジェクトのリスト, 受け取ったテキスト,
+             最後まで生成してすべて投稿できたか)
+        """
+        streamer = SegmentStreamer(max_len)
+        prev_id = reply_to_id
+        posted_statuses = []
+
+        try:
+            for chunk in chunks:
+                for seg in streamer.feed(chunk):
+                    idx = len(posted_statuses) + 1
+                    status = self._post_segment(
+                        f"@{original_acct} {idx}:\n{seg}", idx, prev_id, visibility
+                    )
+                    if status is None:
+                        return posted_statuses, streamer.text, False
+                    posted_statuses.append(status)
+                    prev_id = status['id']
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+        remaining = streamer.finish()
+        total = len(posted_statuses) + len(remaining)
+        logging.info(f"Stream finished, posting {len(remaining)} remaining segments (total: {total})")
+
+        for seg in remaining:
+            idx = len(posted_statuses) + 1
+            if total > 1:
+                text = f"@{original_acct} {idx}/{total}:\n{seg}"
+            else:
+                text = f"@{original_acct} {seg}"
+            status = self._post_segment(text, idx, prev_id, visibility)
+            if status is None:
+                return posted_statuses, streamer.text, False
+            posted_statuses.append(status)
+            prev_id = status['id']
+
+        return posted_statuses, streamer.text, True
+
+    def _post_segment(self, text: str, idx: int, prev_id: int, visibility: str):
+        """ストリーミング返信の1セグメントを投稿"""
+        logging.info(f"Reply {idx}: {text[:60]}...")
+        try:
+            status = self._status_post(text, prev_id, visibility)
+            logging.info(f"Posted reply {idx} (ID: {status['id']}, visibility: {visibility})")
+            return status
+        except Exception as e:
+            logging.error(f'Failed to post segment {idx}: {e}')
+            return None
+
     def favourite_status(self, status_id: int) -> bool:
         """ステータスをお気に入りに追加"""
         try:
-            self.client.status_favourite(status_id)
+            self.api.call(PRIORITY_BACKGROUND, self.client.status_favourite, status_id)
             logging.info(f"Favourited status (ID: {status_id})")
             return True
         except Exception as e:
@@ -117,7 +204,7 @@ class MastodonPoster:
     def boost_status(self, status_id: int) -> bool:
         """ステータスをブースト"""
         try:
-            self.client.status_reblog(status_id)
+            self.api.call(PRIORITY_BACKGROUND, self.client.status_reblog, status_id)
             logging.info(f"Boosted status (ID: {status_id})")
             return True
         except Exception as e:
@@ -1,11 +1,23 @@
 """プロンプト処理とメッセージ構築"""
 import re
 import logging
+from functools import lru_cache
 from typing import Optional
 
-from .utils import strip_html, extract_custom_prompt
-from .config import DEFAULT_CHARACTER_PROMPT, SYSTEM_PROMPT_TEMPLATE
+from .utils import strip_html, extract_custom_prompt, CUSTOM_PROMPT_PATTERN
+from .config import (
+    DEFAULT_CHARACTER_PROMPT, SYSTEM_PROMPT_TEMPLATE, SUMMARY_SYSTEM_PROMPT,
+    CHAT_REPLY_INSTRUCTION, PROMPT_MAX_CHARS, PROMPT_HEAD_MESSAGES, PROMPT_TAIL_MESSAGES,
+    PROMPT_WINDOW_STRIDE, SUMMARY_BATCH
+)
 from .storage import get_storage
+from .context import ConversationContext
+
+
+# ボットの返信形式 "@user 1/2:" や "@user 1:"（ストリーミング返信）
+_BOT_REPLY_PREFIX_PATTERN = re.compile(r'^@\S+\s+\d+(?:/\d+)?:\s*')
+# 先頭の @mention（複数対応）
+_LEADING_MENTIONS_PATTERN = re.compile(r'^(@\S+\s*)+')
 
 
 def clean_content_for_log(content: str) -> str:
@@ -13,15 +25,33 @@ def clean_content_for_log(content: str) -> str:
     会話ログ用にコンテンツをクリーンアップ
 
     - ユーザー投稿: @mention 部分を除去
-    - ボット投稿: @user 1/2: 形式のプレフィックスを除去
+    - ボット投稿: @user 1/2: や @user 1: 形式のプレフィックスを除去
     """
-    # ボットの返信形式 "@user 1/2:" や "@user 1/1:" を除去
-    content = re.sub(r'^@\S+\s+\d+/\d+:\s*', '', content)
-    # 先頭の @mention を除去（複数対応）
-    content = re.sub(r'^(@\S+\s*)+', '', content)
+    if content.startswith('@'):
+        # ボットの返信形式 "@user 1/2:" や "@user 1:"（ストリーミング返信）を除去
+        content = _BOT_REPLY_PREFIX_PATTERN.sub('', content)
+        # 先頭の @mention を除去（複数対応）
+        content = _LEADING_MENTIONS_PATTERN.sub('', content)
     return content.strip()
 
 
+def remove_custom_prompt(content: str) -> str:
+    """カスタムプロンプト部分（/*...*/、複数行対応）を除去"""
+    if '/*' not in content:
+        return content.strip()
+    return CUSTOM_PROMPT_PATTERN.sub('', content).strip()
+
+
+@lru_cache(maxsize=8192)
+def clean_stored_content(content: str) -> str:
+    """
+    保存済みの投稿を会話ログ用にクリーンアップ
+
+    同じ履歴がメンションのたびに処理されるため、結果をキャッシュする。
+    """
+    return clean_content_for_log(remove_custom_prompt(content))
+
+
 class PromptProcessor:
     """プロンプトの処理と構築を担当"""
 
@@ -31,35 +61,34 @@ class PromptProcessor:
     def determine_active_prompt(
         self,
         text: str,
-        conversation_id: Optional[int] = None
+        context: Optional[ConversationContext] = None
     ) -> tuple[str, Optional[str]]:
         """
         アクティブなプロンプトを決定
 
+        Args:
+            text: メンションのテキスト
+            context: 会話コンテキスト（あれば）
+
         Returns:
             tuple: (active_prompt, custom_prompt_if_new)
         """
         # テキストからカスタムプロンプトを抽出
         custom_prompt = extract_custom_prompt(text)
 
-        # 既存の会話データを取得
-        existing_data = None
-        if conversation_id:
-            existing_data = self.storage.load_conversation(conversation_id)
-
         if custom_prompt:
             # 新しいカスタムプロンプトが見つかった
             logging.info(f"Custom prompt detected: {custom_prompt}")
             return custom_prompt, custom_prompt
-        elif existing_data and existing_data.get("custom_prompt"):
+        elif context and context.custom_prompt:
             # 既存の会話にカスタムプロンプトがある
-            active_prompt = existing_data["custom_prompt"]
+            active_prompt = context.custom_prompt
             logging.info(f"Using existing custom prompt: {active_prompt}")
             return active_prompt, None
-        elif existing_data and existing_data.get("ai_prompt"):
+        elif context and context.ai_prompt:
             # 既存の会話の保存されたプロンプトを使用
             logging.info("Using existing saved prompt")
-            return existing_data["ai_prompt"], None
+            return context.ai_prompt, None
         else:
             # デフォルトのキャラクター設定
             logging.info("Using default character prompt")
@@ -69,56 +98,112 @@ class PromptProcessor:
         """システムプロンプトを構築"""
         return SYSTEM_PROMPT_TEMPLATE + character_prompt
 
-    def build_conversation_prompt(
+    def collect_conversation_turns(
         self,
-        thread_data: list,
-        conversation_id: Optional[int] = None,
+        context: ConversationContext,
         custom_prompt: Optional[str] = None
-    ) -> str:
+    ) -> list[dict]:
         """
-        LLM用の会話プロンプトを構築
-
-        Args:
-            thread_data: 現在のスレッドデータ
-            conversation_id: 既存の会話ID（あれば）
-            custom_prompt: 除去するカスタムプロンプト（あれば）
+        会話の各投稿（アカウント、内容、ボットの返信かどうか）を収集
 
-        Returns:
-            構築されたプロンプト
+        保存済みの履歴を先に並べ、現在のスレッドの未保存の投稿を後ろに追加する。
+        保存済みの部分は毎回同じ内容・順序になる（プロンプトの前方一致を保つため）。
         """
-        conversation_parts = []
-        existing_ids = set()
-
-        # 既存の会話データがあれば取得
-        if conversation_id:
-            existing_data = self.storage.load_conversation(conversation_id)
-            if existing_data and existing_data.get("thread_data"):
-                existing_ids = {status["id"] for status in existing_data["thread_data"]}
-
-                # 既存の会話履歴から会話を構築
-                for thread_status in existing_data["thread_data"]:
-                    acct = thread_status["account"]
-                    content = thread_status["content"]
-                    # カスタムプロンプト部分を除去（複数行対応）
-                    content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL).strip()
-                    # メンション部分を除去
-                    content = clean_content_for_log(content)
-                    if content:
-                        conversation_parts.append(f"{acct}: {content}")
+        turns = []
+        existing_ids = context.known_status_ids
+
+        # 既存の会話履歴から会話を構築
+        for thread_status in context.history:
+            acct = thread_status["account"]
+            # カスタムプロンプトとメンション部分を除去
+            content = clean_stored_content(thread_status["content"])
+            if content:
+                turns.append({
+                    'account': acct,
+                    'content': content,
+                    'is_bot_reply': bool(thread_status.get("is_bot_reply"))
+                })
 
         # 現在のスレッドから新しい投稿を追加
-        for status in thread_data:
+        for status in context.thread_data:
             if str(status.id) not in existing_ids:
                 acct = status['account']['acct'] if isinstance(status, dict) else status.account.acct
                 content = strip_html(status.get('content', '') if isinstance(status, dict) else status.content)
 
                 # カスタムプロンプト部分を除去（複数行対応）
                 if custom_prompt and custom_prompt in content:
-                    content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL).strip()
+                    content = remove_custom_prompt(content)
                 # メンション部分を除去
                 content = clean_content_for_log(content)
                 if content:
-                    conversation_parts.append(f"{acct}: {content}")
+                    turns.append({
+                        'account': acct,
+                        'content': content,
+                        'is_bot_reply': context.bot_acct is not None and acct == context.bot_acct
+                    })
+
+        return turns
+
+    def collect_conversation_parts(
+        self,
+        context: ConversationContext,
+        custom_prompt: Optional[str] = None
+    ) -> list[str]:
+        """会話ログの各行（"アカウント: 内容"）を収集"""
+        return [
+            f"{turn['account']}: {turn['content']}"
+            for turn in self.collect_conversation_turns(context, custom_prompt)
+        ]
+
+    def select_window(self, parts: list[str]) -> tuple[int, int]:
+        """
+        プロンプトに含める範囲を決定
+
+        先頭の PROMPT_HEAD_MESSAGES 件と末尾の PROMPT_TAIL_MESSAGES 件を残し、
+        合計が PROMPT_MAX_CHARS を超える場合は末尾側の古い投稿から落とす
+        （最後の投稿は必ず残す）。省略する場合は PROMPT_WINDOW_STRIDE 件単位で省略する。
+
+        Returns:
+            (head_end, tail_start): parts[:head_end] と parts[tail_start:] を使用する
+        """
+        total = len(parts)
+        head_end = min(PROMPT_HEAD_MESSAGES, total)
+        tail_start = max(head_end, total - PROMPT_TAIL_MESSAGES)
+
+        budget = PROMPT_MAX_CHARS - sum(len(part) + 1 for part in parts[:head_end])
+        tail_chars = sum(len(part) + 1 for part in parts[tail_start:])
+        while tail_start < total - 1 and tail_chars > budget:
+            tail_chars -= len(parts[tail_start]) + 1
+            tail_start += 1
+
+        # 省略範囲の終わりを PROMPT_WINDOW_STRIDE 件単位に切り上げ、
+        # 投稿が増えても数ターンの間はプロンプトの前方一致を保つ
+        if tail_start > head_end and PROMPT_WINDOW_STRIDE > 1:
+            offset = tail_start - head_end
+            offset = -(-offset // PROMPT_WINDOW_STRIDE) * PROMPT_WINDOW_STRIDE
+            tail_start = min(head_end + offset, total - 1)
+
+        return head_end, tail_start
+
+    def build_conversation_prompt(
+        self,
+        context: ConversationContext,
+        custom_prompt: Optional[str] = None
+    ) -> str:
+        """
+        LLM用の会話プロンプトを構築
+
+        長い会話は select_window() で先頭と末尾だけを残し、
+        省略した部分は保存済みの要約（あれば）で補う。
+
+        Args:
+            context: 会話コンテキスト（保存済みの履歴と現在のスレッド）
+            custom_prompt: 除去するカスタムプロンプト（あれば）
+
+        Returns:
+            構築されたプロンプト
+        """
+        conversation_parts = self.collect_conversation_parts(context, custom_prompt)
 
         # 会話プロンプトを構築
         if not conversation_parts:
@@ -126,14 +211,161 @@ class PromptProcessor:
             logging.info("Empty conversation - sending greeting prompt")
             return "【重要】新しい会話が始まりました。キャラクターとして自然に挨拶してください。"
 
-        conversation_text = '\n'.join(conversation_parts)
-        logging.info(f"Built conversation prompt with {len(conversation_parts)} messages")
+        head_end, tail_start = self.select_window(conversation_parts)
+        omitted = tail_start - head_end
+        log_parts = conversation_parts[:head_end]
+        if omitted:
+            log_parts.append(f"（{omitted}件の投稿を省略）")
+        log_parts.extend(conversation_parts[tail_start:])
+
+        conversation_text = '\n'.join(log_parts)
+        logging.info(
+            f"Built conversation prompt with {len(conversation_parts) - omitted} messages"
+            f" ({omitted} omitted, {len(conversation_text)} chars)"
+        )
+
+        summary_text = ''
+        if omitted and context.summary:
+            summary_text = f"""【これまでの会話の要約】
+{context.summary}
 
-        return f"""【会話ログ】
+"""
+
+        return f"""{summary_text}【会話ログ】
 {conversation_text}
 
 【重要】上記の会話に対して、最後の投稿に返信してください。キャラクターとして自然に応答してください。"""
 
+    def build_chat_messages(
+        self,
+        context: ConversationContext,
+        system_prompt: str,
+        custom_prompt: Optional[str] = None
+    ) -> list[dict]:
+        """
+        LLM用のマルチターンのメッセージリストを構築
+
+        ボットの返信は assistant、それ以外の投稿は "アカウント: 内容" 形式の user
+        メッセージとし、返信の指示はシステムプロンプト側に置く。保存済みの履歴は
+        毎回同じメッセージになるため、同じ会話の次の返信ではOllamaがKVキャッシュを
+        再利用できる（前方一致する範囲のプリフィルが不要になる）。
+
+        Args:
+            context: 会話コンテキスト（保存済みの履歴と現在のスレッド）
+            system_prompt: キャラクター設定を含むシステムプロンプト
+            custom_prompt: 除去するカスタムプロンプト（あれば）
+
+        Returns:
+            Ollamaのchat APIに渡すメッセージのリスト
+        """
+        messages = [self.build_chat_system_message(system_prompt)]
+
+        turns = self.collect_conversation_turns(context, custom_prompt)
+        if not turns:
+            # 会話内容が空の場合
+            logging.info("Empty conversation - sending greeting prompt")
+            messages.append({
+                "role": "user",
+                "content": "【重要】新しい会話が始まりました。キャラクターとして自然に挨拶してください。"
+            })
+            return messages
+
+        head_end, tail_start = self.select_window(
+            [f"{turn['account']}: {turn['content']}" for turn in turns]
+        )
+
+        def to_message(turn: dict) -> dict:
+            if turn['is_bot_reply']:
+                return {"role": "assistant", "content": turn['content']}
+            return {"role": "user", "content": f"{turn['account']}: {turn['content']}"}
+
+        messages.extend(to_message(turn) for turn in turns[:head_end])
+        if tail_start > head_end:
+            # 件数を含めない固定の文言にして、省略範囲が変わらない間は前方一致を保つ
+            if context.summary:
+                omitted_text = f"（途中の投稿を省略）\n【これまでの会話の要約】\n{context.summary}"
+            else:
+                omitted_text = "（途中の投稿を省略）"
+            messages.append({"role": "user", "content": omitted_text})
+        messages.extend(to_message(turn) for turn in turns[tail_start:])
+
+        if messages[-1]["role"] != "user":
+            # 最後がボットの返信の場合は返信を促す
+            messages.append({"role": "user", "content": "（続けて返信してください）"})
+
+        logging.info(
+            f"Built chat messages: {len(messages)} messages"
+            f" ({tail_start - head_end} posts omitted)"
+        )
+        return messages
+
+    def build_chat_system_message(self, system_prompt: str) -> dict:
+        """マルチターンのメッセージリストの先頭に置くシステムメッセージを構築"""
+        return {
+            "role": "system",
+            "content": f"{system_prompt}\n\n{CHAT_REPLY_INSTRUCTION}"
+        }
+
+    def build_warmup_messages(self, character_prompt: Optional[str] = None) -> list[dict]:
+        """
+        ウォームアップ用のメッセージリストを構築
+
+        通常の返信と同じシステムメッセージから始めるため、ウォームアップで
+        処理したシステムプロンプトのKVキャッシュを最初のメンションで再利用できる。
+        """
+        system_prompt = self.build_system_prompt(character_prompt or DEFAULT_CHARACTER_PROMPT)
+        return [
+            self.build_chat_system_message(system_prompt),
+            {"role": "user", "content": "（起動確認）"}
+        ]
+
+    def update_summary(
+        self,
+        context: ConversationContext,
+        llm,
+        custom_prompt: Optional[str] = None
+    ) -> bool:
+        """
+        プロンプトから省略される投稿を要約に追加（ローリング要約）
+
+        要約済みの件数から省略範囲の終わりまでの投稿が SUMMARY_BATCH 件
+        たまったら、前回の要約と合わせて要約し直して保存する。
+        前回の要約は保存済みのものを読み直す（バックグラウンドで実行するため、
+        context を読み込んだ後に前のメンションで更新されている場合がある）。
+
+        Args:
+            context: 会話コンテキスト
+            llm: 要約に使うLLMインターフェース
+            custom_prompt: 除去するカスタムプロンプト（あれば）
+
+        Returns:
+            要約を更新したかどうか
+        """
+        parts = self.collect_conversation_parts(context, custom_prompt)
+        head_end, tail_start = self.select_window(parts)
+        summary, summary_message_count = self.storage.get_summary(context.conversation_id)
+        start = max(head_end, summary_message_count)
+        if tail_start - start < SUMMARY_BATCH:
+            return False
+
+        previous = summary or 'なし'
+        new_parts = '\n'.join(parts[start:tail_start])
+        summary = llm.generate(
+            f"""【これまでの要約】
+{previous}
+
+【追加の会話ログ】
+{new_parts}""",
+            system_prompt=SUMMARY_SYSTEM_PROMPT
+        )
+        if summary.startswith('Error:'):
+            logging.error(f"Failed to update summary for conversation {context.conversation_id}")
+            return False
+
+        self.storage.save_summary(context.conversation_id, summary.strip(), tail_start)
+        logging.info(f"Updated summary for conversation {context.conversation_id} (covers {tail_start} messages)")
+        return True
+
 
 # シングルトンインスタンス
 _processor: Optional[PromptProcessor] = None
@@ -0,0 +1,93 @@
+"""同じプロンプトへのLLMの応答キャッシュ"""
+import hashlib
+import logging
+from typing import Optional
+
+from .config import (
+    DEFAULT_CHARACTER_PROMPT, RESPONSE_CACHE_PERSONAS, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE
+)
+from .metrics import RESPONSE_CACHE_TOTAL
+from .storage import ConversationStorage, get_storage
+
+
+def persona_id(character_prompt: str) -> str:
+    """キャラクター設定の識別子（内容のSHA-256の先頭12文字）"""
+    return hashlib.sha256(character_prompt.strip().encode('utf-8')).hexdigest()[:12]
+
+
+class ResponseCache:
+    """
+    モデルとプロンプトが同じリクエストへの応答を再利用するキャッシュ
+
+    キーはモデル名と、空白を正規化したメッセージのリストのハッシュ。
+    キャッシュはデータベースに保存し、有効期間（TTL）と最大件数（LRU）で削除する。
+    使用するキャラクター設定は RESPONSE_CACHE_PERSONAS で指定する
+    （default: デフォルトのキャラクター、all: すべて、それ以外は persona_id()）。
+    """
+
+    def __init__(
+        self,
+        storage: Optional[ConversationStorage] = None,
+        personas: Optional[list[str]] = None,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None
+    ):
+        self.storage = storage or get_storage()
+        self.personas = set(RESPONSE_CACHE_PERSONAS if personas is None else personas)
+        self.ttl = RESPONSE_CACHE_TTL if ttl is None else ttl
+        self.max_entries = RESPONSE_CACHE_SIZE if max_entries is None else max_entries
+
+    @property
+    def enabled(self) -> bool:
+        """いずれかのキャラクター設定でキャッシュを使うか"""
+        return bool(self.personas) and self.max_entries > 0
+
+    def enabled_for(self, character_prompt: str) -> bool:
+        """キャラクター設定でキャッシュを使うか"""
+        if not self.enabled:
+            return False
+        if 'all' in self.personas:
+            return True
+        if 'default' in self.personas and character_prompt == DEFAULT_CHARACTER_PROMPT:
+            return True
+        return persona_id(character_prompt) in self.personas
+
+    @staticmethod
+    def make_key(model: str, messages: list[dict]) -> str:
+        """モデルとメッセージのリストからキーを作成（連続する空白は1つとみなす）"""
+        digest = hashlib.sha256(model.encode('utf-8'))
+        for message in messages:
+            content = ' '.join(message['content'].split())
+            digest.update(b'\x1e' + message['role'].encode('utf-8') + b'\x1f' + content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュした応答を取得"""
+        try:
+            response = self.storage.get_cached_response(key, self.ttl)
+        except Exception as e:
+            logging.error(f"Failed to read response cache: {e}")
+            return None
+        RESPONSE_CACHE_TOTAL.inc(result='hit' if response is not None else 'miss')
+        if response is not None:
+            logging.info(f"Response cache hit ({key[:12]})")
+        return response
+
+    def put(self, key: str, model: str, response: str) -> bool:
+        """応答をキャッシュに保存（エラーの応答は保存しない）"""
+        if not response or response.startswith('Error:'):
+            return True
+        self.storage.put_cached_response(key, model, response, self.ttl, self.max_entries)
+        return True
+
+
+# シングルトンインスタンス
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    """応答キャッシュのシングルトンインスタンスを取得"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
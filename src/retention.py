@@ -0,0 +1,255 @@
+"""会話データの保持期間とアーカイブ"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional
+
+from .config import ARCHIVE_PATH, RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_BATCH_SIZE
+from .metrics import CONVERSATIONS_ARCHIVED_TOTAL
+from .storage import ConversationStorage, get_storage
+
+
+class ArchiveStorage:
+    """
+    アーカイブした会話を保存する別のSQLiteデータベース
+
+    会話とメッセージの行を会話ごとに1つのJSONにまとめ、zlibで圧縮して保存する。
+    ボットは読み込まないため、会話データのデータベースとは別のファイルにする。
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or ARCHIVE_PATH
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._init_db()
+
+    @contextmanager
+    def _get_connection(self):
+        """データベース接続のコンテキストマネージャー（使用頻度が低いため毎回接続する）"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        """データベースとテーブルを初期化"""
+        with self._get_connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS archived_conversations (
+                    id INTEGER PRIMARY KEY,
+                    root_status_id TEXT,
+                    message_count INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    archived_at TEXT NOT NULL
+                )
+            ''')
+
+    def save(self, records: list[dict]):
+        """
+        会話をまとめて1トランザクションで保存（同じ会話IDは置き換える）
+
+        Args:
+            records: ConversationStorage.get_conversation_rows() の戻り値のリスト
+        """
+        now = datetime.now().isoformat()
+        rows = []
+        for record in records:
+            conversation = record['conversation']
+            data = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            rows.append((
+                conversation['id'],
+                conversation['root_status_id'],
+                len(record['messages']),
+                zlib.compress(data),
+                conversation['created_at'],
+                conversation['updated_at'],
+                now
+            ))
+
+        with self._get_connection() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO archived_conversations
+                (id, root_status_id, message_count, data, created_at, updated_at, archived_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    def delete(self, conversation_ids: list[int]):
+        """会話を削除"""
+        with self._get_connection() as conn:
+            conn.executemany(
+                'DELETE FROM archived_conversations WHERE id = ?',
+                [(conversation_id,) for conversation_id in conversation_ids]
+            )
+
+    def load(self, conversation_id: int) -> Optional[dict]:
+        """アーカイブした会話を ConversationStorage.load_conversation() と同じ形式で読み込み"""
+        with self._get_connection() as conn:
+            row = conn.execute(
+                'SELECT data, archived_at FROM archived_conversations WHERE id = ?',
+                (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        record = json.loads(zlib.decompress(row['data']).decode('utf-8'))
+        conversation = record['conversation']
+        return {
+            'conversation_id': conversation['id'],
+            'custom_prompt': conversation['custom_prompt'],
+            'ai_prompt': conversation['ai_prompt'],
+            'latest_ai_response': conversation['latest_ai_response'],
+            'created_at': conversation['created_at'],
+            'updated_at': conversation['updated_at'],
+            'summary': conversation['summary'],
+            'summary_message_count': conversation['summary_message_count'] or 0,
+            'archived_at': row['archived_at'],
+            'thread_data': [
+                {
+                    'id': msg['status_id'],
+                    'account': msg['account'],
+                    'content': msg['content'],
+                    'url': msg['url'],
+                    'is_bot_reply': bool(msg['is_bot_reply']),
+                    'created_at': msg['created_at']
+                }
+                for msg in record['messages']
+            ]
+        }
+
+    def count(self) -> int:
+        """アーカイブした会話の数"""
+        with self._get_connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM archived_conversations').fetchone()[0]
+
+
+class RetentionJob:
+    """
+    古い会話のアーカイブとデータベースの最適化を定期的に実行
+
+    最後の更新から retention_days 日が経った会話をアーカイブに移して
+    会話データのデータベースから削除し、空いたページの解放（incremental_vacuum）と
+    統計情報の更新（ANALYZE）を行う。会話データのデータベースを小さく保ち、
+    ページキャッシュに収まるようにする。
+    """
+
+    def __init__(
+        self,
+        storage: Optional[ConversationStorage] = None,
+        archive: Optional[ArchiveStorage] = None,
+        retention_days: Optional[float] = None,
+        interval: Optional[float] = None,
+        batch_size: int = RETENTION_BATCH_SIZE
+    ):
+        """
+        Args:
+            retention_days: 会話を保持する日数（0でアーカイブしない）
+            interval: 実行する間隔（秒、0で定期実行しない）
+            batch_size: 1トランザクションでアーカイブする会話数
+        """
+        self.storage = storage or get_storage()
+        self._archive = archive
+        self.retention_days = RETENTION_DAYS if retention_days is None else retention_days
+        self.interval = RETENTION_INTERVAL if interval is None else interval
+        self.batch_size = batch_size
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def archive(self) -> ArchiveStorage:
+        """アーカイブ（最初に使うときにファイルを作成）"""
+        if self._archive is None:
+            self._archive = ArchiveStorage()
+        return self._archive
+
+    def archive_idle(self) -> int:
+        """
+        保持期間を過ぎた会話をアーカイブに移す
+
+        アーカイブへの保存が完了してから削除するため、途中で停止しても会話は失われない。
+        アーカイブ中に新しい返信があった会話は削除せず、アーカイブからも取り除く。
+
+        Returns:
+            アーカイブした会話数
+        """
+        if self.retention_days <= 0:
+            return 0
+
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).isoformat()
+        total = 0
+        while not self._stop.is_set():
+            conversation_ids = self.storage.find_idle_conversations(cutoff, self.batch_size)
+            if not conversation_ids:
+                break
+
+            records = [self.storage.get_conversation_rows(cid) for cid in conversation_ids]
+            records = [record for record in records if record is not None]
+            self.archive.save(records)
+
+            deleted = self.storage.delete_conversations([
+                (record['conversation']['id'], record['conversation']['updated_at'])
+                for record in records
+            ])
+            deleted_ids = set(deleted)
+            stale = [record['conversation']['id'] for record in records
+                     if record['conversation']['id'] not in deleted_ids]
+            if stale:
+                self.archive.delete(stale)
+
+            total += len(deleted)
+            CONVERSATIONS_ARCHIVED_TOTAL.inc(len(deleted))
+            if not deleted:
+                break
+
+        if total:
+            logging.info(f"Archived {total} conversations idle for {self.retention_days:g} days")
+        return total
+
+    def run_once(self) -> int:
+        """アーカイブと最適化を1回実行（アーカイブした会話数を返す）"""
+        archived = self.archive_idle()
+        try:
+            freed = self.storage.compact()
+            if freed:
+                logging.info(f"Released {freed} free pages from the conversation database")
+        except sqlite3.Error as e:
+            logging.error(f"Failed to compact the conversation database: {e}")
+        return archived
+
+    def start(self):
+        """定期実行のスレッドを起動"""
+        if self.retention_days <= 0 or self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """定期実行を停止"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Retention job failed: {e}")
+            if self._stop.wait(self.interval):
+                break
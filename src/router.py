@@ -0,0 +1,169 @@
+"""LLMモデルの振り分けとフォールバック"""
+import logging
+import threading
+from typing import Iterator, Optional
+
+from .config import OLLAMA_FALLBACK_MODELS, OLLAMA_LATENCY_SLO
+from .llm_interface import OllamaInterface, get_llm
+from .metrics import LLM_ROUTED_TOTAL, LLM_FALLBACKS_TOTAL
+from .utils import remove_markdown
+
+
+class ModelRouter:
+    """
+    リクエストごとにモデルを選び、失敗時は次のモデルにフォールバックする
+
+    モデルは優先順（大きいモデルから）に並べる。各モデルの処理時間の移動平均と
+    処理中・枠待ちのリクエスト数から応答までの時間を見積もり、目標秒数（SLO）に
+    収まる最初のモデルを使う。どのモデルも収まらない場合は見込みが最短のモデルを使う。
+    選んだモデルがタイムアウトやエラーになった場合は、残りのモデルを優先順に試す。
+
+    OllamaInterface と同じメソッドを持つため、そのまま置き換えて使える。
+    実際に応答したモデルは呼び出したスレッドごとに answered_model で取得できる。
+    """
+
+    def __init__(self, models: list[OllamaInterface], latency_slo: Optional[float] = None):
+        """
+        Args:
+            models: 優先順のモデル
+            latency_slo: 応答までの目標秒数（0で見積もりによる振り分けをしない）
+        """
+        if not models:
+            raise ValueError('ModelRouter requires at least one model')
+        self.models = models
+        self.latency_slo = OLLAMA_LATENCY_SLO if latency_slo is None else latency_slo
+        self._local = threading.local()
+
+    @property
+    def model(self) -> str:
+        """優先するモデル名"""
+        return self.models[0].model
+
+    @property
+    def answered_model(self) -> Optional[str]:
+        """このスレッドの直前の chat() / chat_stream() で応答したモデル名（すべて失敗した場合はNone）"""
+        return getattr(self._local, 'answered_model', None)
+
+    @staticmethod
+    def estimate(llm: OllamaInterface) -> float:
+        """
+        モデルの応答までの時間を見積もる（秒）
+
+        空き枠があれば処理時間の移動平均、なければ前に並んでいる
+        リクエストの分だけ待ち時間を加える。未計測のモデルは0とする。
+        """
+        latency = llm.latency
+        if latency is None:
+            return 0.0
+        ahead = llm.pending - llm.max_concurrency + 1
+        return latency * (1 + max(0, ahead) / llm.max_concurrency)
+
+    def select(self) -> list[OllamaInterface]:
+        """リクエストに使うモデルを、試す順に並べて返す"""
+        chosen = self.models[0]
+        reason = 'primary'
+
+        if self.latency_slo > 0 and len(self.models) > 1:
+            estimates = [(self.estimate(llm), llm) for llm in self.models]
+            within = [llm for estimate, llm in estimates if estimate <= self.latency_slo]
+            if within:
+                chosen = within[0]
+            else:
+                chosen = min(estimates, key=lambda item: item[0])[1]
+
+            if chosen is not self.models[0]:
+                reason = 'slo'
+                logging.info(
+                    f"Routing to {chosen.model}: {self.models[0].model} estimated "
+                    f"{estimates[0][0]:.1f}s > SLO {self.latency_slo:.1f}s"
+                )
+
+        LLM_ROUTED_TOTAL.inc(model=chosen.model, reason=reason)
+        return [chosen] + [llm for llm in self.models if llm is not chosen]
+
+    def _fallback(self, llm: OllamaInterface, error: Exception, remaining: int):
+        """フォールバックを記録"""
+        LLM_FALLBACKS_TOTAL.inc(model=llm.model, reason=type(error).__name__)
+        if remaining:
+            logging.warning(f"Model {llm.model} failed, falling back: {error}")
+        else:
+            logging.error(f"Model {llm.model} failed: {error}")
+
+    def build_messages(self, user_prompt: str, system_prompt: Optional[str] = None) -> list[dict]:
+        """システムプロンプトとユーザープロンプトからメッセージを構築"""
+        return self.models[0].build_messages(user_prompt, system_prompt)
+
+    def chat(self, messages: list[dict]) -> str:
+        """メッセージのリストを選んだモデルに送信してテキストを生成"""
+        candidates = self.select()
+        self._local.answered_model = None
+        error: Optional[Exception] = None
+        for index, llm in enumerate(candidates):
+            try:
+                response = llm.request_chat(messages)
+                self._local.answered_model = llm.model
+                return response
+            except Exception as e:
+                error = e
+                self._fallback(llm, e, len(candidates) - index - 1)
+        return f'Error: {str(error)}'
+
+    def chat_stream(self, messages: list[dict]) -> Iterator[str]:
+        """
+        メッセージのリストを選んだモデルに送信し、生成されたテキストを逐次返す
+
+        フォールバックするのは最初のテキストを受け取る前に失敗した場合のみ。
+        途中で失敗した場合は、応答が欠けているため answered_model をNoneにする。
+        """
+        candidates = self.select()
+        self._local.answered_model = None
+        error: Optional[Exception] = None
+        for index, llm in enumerate(candidates):
+            received = False
+            stream = llm.request_chat_stream(messages)
+            try:
+                for content in stream:
+                    if not received:
+                        received = True
+                        self._local.answered_model = llm.model
+                    yield content
+                return
+            except Exception as e:
+                if received:
+                    logging.error(f"Model {llm.model} failed while streaming: {e}")
+                    self._local.answered_model = None
+                    return
+                error = e
+                self._fallback(llm, e, len(candidates) - index - 1)
+            finally:
+                # 呼び出し側が途中で閉じた場合も、モデルの同時リクエスト枠をすぐに返す
+                stream.close()
+        yield f'Error: {str(error)}'
+
+    def generate_stream(self, user_prompt: str, system_prompt: Optional[str] = None) -> Iterator[str]:
+        """テキストをストリーミング生成"""
+        return self.chat_stream(self.build_messages(user_prompt, system_prompt))
+
+    def generate(self, user_prompt: str, system_prompt: Optional[str] = None) -> str:
+        """テキストを生成"""
+        return self.chat(self.build_messages(user_prompt, system_prompt))
+
+    def generate_clean(self, user_prompt: str, system_prompt: Optional[str] = None) -> str:
+        """テキストを生成し、Markdownを除去"""
+        return remove_markdown(self.generate(user_prompt, system_prompt))
+
+
+# シングルトンインスタンス
+_router: Optional[ModelRouter] = None
+
+
+def get_router() -> ModelRouter:
+    """モデルルーターのシングルトンインスタンスを取得（OLLAMA_MODEL + OLLAMA_FALLBACK_MODELS）"""
+    global _router
+    if _router is None:
+        primary = get_llm()
+        models = [primary] + [
+            OllamaInterface(model) for model in OLLAMA_FALLBACK_MODELS if model != primary.model
+        ]
+        _router = ModelRouter(models)
+    return _router
@@ -0,0 +1,137 @@
+"""Mastodon API呼び出しのスケジューリング（レート制限対応）"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+import weakref
+from typing import Callable, Optional
+from mastodon import Mastodon, MastodonRatelimitError, MastodonNetworkError, MastodonServerError
+
+from .config import API_MAX_RETRIES, API_BACKOFF_BASE, API_RATELIMIT_RESERVE
+
+# 優先度（小さいほど優先）
+PRIORITY_REPLY = 0      # 返信の投稿
+PRIORITY_FETCH = 1      # スレッドなどの取得
+PRIORITY_BACKGROUND = 2  # お気に入り・ブーストなど
+
+
+class ApiScheduler:
+    """
+    Mastodon API呼び出しのスケジューラ
+
+    Mastodon.pyがレスポンスヘッダーから更新する ratelimit_remaining /
+    ratelimit_reset を見て呼び出しを待たせる。残り回数が少なくなると
+    優先度の低い呼び出しから待機させ、返信の投稿を優先する。
+    レート制限やネットワーク・サーバーエラーはバックオフして再試行する。
+    """
+
+    def __init__(
+        self,
+        client: Mastodon,
+        max_retries: Optional[int] = None,
+        backoff_base: Optional[float] = None,
+        reserve: Optional[int] = None
+    ):
+        """
+        Args:
+            client: Mastodonクライアント
+            max_retries: 再試行の最大回数
+            backoff_base: バックオフの基準秒数（再試行ごとに2倍）
+            reserve: 優先度の低い呼び出しのために残しておく回数
+        """
+        self.client = client
+        self.max_retries = API_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = API_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.reserve = API_RATELIMIT_RESERVE if reserve is None else reserve
+
+        self._cond = threading.Condition()
+        self._waiting: list[tuple[int, int]] = []  # (priority, seq) のヒープ
+        self._seq = itertools.count()
+
+    def call(self, priority: int, func: Callable, *args, **kwargs):
+        """
+        APIを呼び出す（順番が来るまで待機し、失敗時は再試行）
+
+        Args:
+            priority: 優先度（PRIORITY_*）
+            func: 呼び出すクライアントのメソッド
+
+        Returns:
+            APIの戻り値（再試行しても失敗した場合は最後の例外を送出）
+        """
+        name = getattr(func, '__name__', 'api')
+        attempt = 0
+        while True:
+            self._acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except MastodonRatelimitError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = max(self._seconds_until_reset(), self._backoff(attempt))
+                logging.warning(f"Rate limited on {name}, retrying in {delay:.1f}s: {e}")
+            except (MastodonNetworkError, MastodonServerError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logging.warning(f"API error on {name}, retrying in {delay:.1f}s: {e}")
+            attempt += 1
+            time.sleep(delay)
+
+    def _acquire(self, priority: int):
+        """優先度順に、レート制限に余裕ができるまで待機"""
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            self._cond.notify_all()
+            while True:
+                if self._waiting[0] == ticket:
+                    wait = self._wait_time(priority)
+                    if wait <= 0:
+                        heapq.heappop(self._waiting)
+                        self._cond.notify_all()
+                        return
+                    logging.info(f"Rate limit low, delaying priority {priority} call for {wait:.1f}s")
+                    # より優先度の高い呼び出しが来たら起こされる
+                    self._cond.wait(min(wait, 5.0))
+                else:
+                    self._cond.wait()
+
+    def _wait_time(self, priority: int) -> float:
+        """この優先度の呼び出しを開始するまでに待つ秒数"""
+        remaining = getattr(self.client, 'ratelimit_remaining', None)
+        if remaining is None:
+            return 0.0
+        # 返信は残り回数を使い切るまで、それ以外は予備を残して待機
+        threshold = 0 if priority <= PRIORITY_REPLY else self.reserve * priority
+        if remaining > threshold:
+            return 0.0
+        return self._seconds_until_reset()
+
+    def _seconds_until_reset(self) -> float:
+        """レート制限がリセットされるまでの秒数"""
+        reset = getattr(self.client, 'ratelimit_reset', None)
+        if not reset:
+            return 0.0
+        return max(0.0, float(reset) - time.time())
+
+    def _backoff(self, attempt: int) -> float:
+        """指数バックオフ（ジッター付き）の待ち時間"""
+        return self.backoff_base * (2 ** attempt) * (0.5 + random.random() / 2)
+
+
+# クライアントごとのスケジューラ
+_schedulers: "weakref.WeakKeyDictionary[Mastodon, ApiScheduler]" = weakref.WeakKeyDictionary()
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(client: Mastodon) -> ApiScheduler:
+    """クライアントに対応するスケジューラを取得（なければ作成）"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(client)
+        if scheduler is None:
+            scheduler = ApiScheduler(client)
+            _schedulers[client] = scheduler
+        return scheduler
@@ -0,0 +1,131 @@
+"""返信の生成に必要ない処理（お気に入り・保存など）のバックグラウンド実行"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Hashable, Optional
+
+from .config import SIDE_EFFECT_MAX_RETRIES, API_BACKOFF_BASE
+
+
+class SideEffectExecutor:
+    """
+    副作用をバックグラウンドのスレッドで投入順に実行
+
+    タスクが例外を送出するか False を返した場合は、バックオフして再試行する
+    （少なくとも1回の実行を保証するため、タスクは冪等である必要がある）。
+    キーを付けたタスクは wait_for() で完了を待てるため、同じ会話の次の
+    メンションは前回の保存が終わってから読み込みを始められる。
+    """
+
+    def __init__(
+        self,
+        name: str = 'side-effects',
+        max_retries: Optional[int] = None,
+        backoff_base: Optional[float] = None
+    ):
+        """
+        Args:
+            name: スレッド名
+            max_retries: 再試行の最大回数
+            backoff_base: 再試行の待ち時間の基準秒数（再試行ごとに2倍）
+        """
+        self.name = name
+        self.max_retries = SIDE_EFFECT_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = API_BACKOFF_BASE if backoff_base is None else backoff_base
+
+        self._cond = threading.Condition()
+        self._tasks: deque = deque()
+        self._pending: dict[Hashable, int] = {}  # キーごとの未完了タスク数
+        self._unfinished = 0
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """バックグラウンドスレッドを起動"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, name: str, func: Callable, *args, key: Hashable = None, **kwargs):
+        """
+        タスクを投入
+
+        Args:
+            name: ログ用のタスク名
+            func: 実行する関数
+            key: 完了待ちに使うキー（同じ会話の処理キーなど）
+        """
+        with self._cond:
+            if self._thread is None or self._stopping:
+                # 起動していない場合はその場で実行
+                run_inline = True
+            else:
+                run_inline = False
+                self._tasks.append((name, func, args, kwargs, key))
+                self._unfinished += 1
+                if key is not None:
+                    self._pending[key] = self._pending.get(key, 0) + 1
+                self._cond.notify_all()
+        if run_inline:
+            self._execute(name, func, args, kwargs)
+
+    def wait_for(self, key: Hashable, timeout: Optional[float] = None) -> bool:
+        """キーを付けたタスクがすべて完了するまで待機"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending.get(key), timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """投入済みのタスクがすべて完了するまで待機"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """残りのタスクを実行してから停止"""
+        if not self.flush(timeout):
+            logging.error(f"{self.name}: not flushed before shutdown ({self._unfinished} remaining)")
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        """バックグラウンドスレッドのメインループ"""
+        while True:
+            with self._cond:
+                while not self._tasks and not self._stopping:
+                    self._cond.wait()
+                if not self._tasks:
+                    return
+                name, func, args, kwargs, key = self._tasks.popleft()
+
+            self._execute(name, func, args, kwargs)
+
+            with self._cond:
+                self._unfinished -= 1
+                if key is not None:
+                    self._pending[key] -= 1
+                    if not self._pending[key]:
+                        del self._pending[key]
+                self._cond.notify_all()
+
+    def _execute(self, name: str, func: Callable, args: tuple, kwargs: dict) -> bool:
+        """タスクを実行（失敗時は再試行）"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                if func(*args, **kwargs) is not False:
+                    return True
+                error = 'returned False'
+            except Exception as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.backoff_base * (2 ** attempt)
+                logging.warning(f"Side effect {name} failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        logging.error(f"Side effect {name} failed after {self.max_retries + 1} attempts: {error}")
+        return False
@@ -3,37 +3,151 @@ import os
 import sqlite3
 import json
 import logging
-from datetime import datetime
-from typing import Optional
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, Optional
 from contextlib import contextmanager
 
-from .config import DATA_DIR
+from .config import DATA_DIR, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE
 from .utils import strip_html
+from .context import ConversationContext
+
+# エクスポート・インポートするカラム（集計のカラムはインポート時にトリガーで再計算する）
+EXPORT_COLUMNS = {
+    'conversations': (
+        'id', 'custom_prompt', 'ai_prompt', 'latest_ai_response', 'summary',
+        'summary_message_count', 'root_status_id', 'created_at', 'updated_at'
+    ),
+    'messages': (
+        'conversation_id', 'status_id', 'account', 'content', 'url',
+        'in_reply_to_id', 'is_bot_reply', 'created_at'
+    ),
+}
 
 
 class ConversationStorage:
     """SQLiteを使用した会話データストレージ"""
 
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, read_only: bool = False):
+        """
+        Args:
+            db_path: データベースのパス（省略時は DATA_DIR/conversations.db）
+            read_only: 読み込み専用で開く（テーブルの作成、マイグレーション、
+                データベースに記録されるPRAGMAの変更を行わない）
+        """
         if db_path is None:
-            os.makedirs(DATA_DIR, exist_ok=True)
+            if not read_only:
+                os.makedirs(DATA_DIR, exist_ok=True)
             db_path = os.path.join(DATA_DIR, 'conversations.db')
+        if read_only and not os.path.exists(db_path):
+            raise FileNotFoundError(f'Database not found: {db_path}')
         self.db_path = db_path
-        self._init_db()
+        self.read_only = read_only
+        self._local = threading.local()  # スレッドごとの接続とリクエストキャッシュ
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        if read_only:
+            self._check_schema()
+        else:
+            self._init_db()
 
     @contextmanager
-    def _get_connection(self):
-        """データベース接続のコンテキストマネージャー"""
-        conn = sqlite3.connect(self.db_path)
+    def request_scope(self):
+        """
+        リクエスト（メンション1件の処理）単位のキャッシュスコープ
+
+        スコープ内では同じ会話の読み込み結果を再利用し、
+        書き込み時には該当する会話のキャッシュを破棄する。
+        """
+        previous = getattr(self._local, 'cache', None)
+        self._local.cache = {}
+        try:
+            yield
+        finally:
+            self._local.cache = previous
+
+    def _cache_get(self, conversation_id: int):
+        """リクエストキャッシュから会話データを取得（(hit, value)を返す）"""
+        cache = getattr(self._local, 'cache', None)
+        if cache is not None and conversation_id in cache:
+            return True, cache[conversation_id]
+        return False, None
+
+    def _cache_put(self, conversation_id: int, data: Optional[dict]):
+        """リクエストキャッシュに会話データを保存"""
+        cache = getattr(self._local, 'cache', None)
+        if cache is not None:
+            cache[conversation_id] = data
+
+    def _cache_invalidate(self, conversation_id: int):
+        """リクエストキャッシュから会話データを破棄"""
+        cache = getattr(self._local, 'cache', None)
+        if cache is not None:
+            cache.pop(conversation_id, None)
+
+    def _connect(self) -> sqlite3.Connection:
+        """新しいデータベース接続を作成してPRAGMAを設定"""
+        conn = sqlite3.connect(
+            # 読み込み専用は URI の mode=ro で開く（書き込みはエラーになる）
+            f'{Path(self.db_path).resolve().as_uri()}?mode=ro' if self.read_only else self.db_path,
+            timeout=30,
+            check_same_thread=False,  # close()を別スレッドから呼べるようにする
+            cached_statements=256,
+            uri=self.read_only
+        )
         conn.row_factory = sqlite3.Row
+        if not self.read_only:
+            # 削除で空いたページを少しずつ解放できるようにする（新しいデータベースのみ。
+            # 既存のデータベースは VACUUM を実行すると有効になる）
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            # WALモード: 読み込み（view_data.pyなど）が書き込みをブロックしない
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        # 以下は接続ごとの設定（データベースには記録されない）
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    @contextmanager
+    def _get_connection(self):
+        """
+        データベース接続のコンテキストマネージャー
+
+        接続はスレッドごとに1つ作成して使い回す（プリペアドステートメントも
+        接続ごとにキャッシュされる）。ネストした場合は最も外側で commit する。
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._connections_lock:
+                self._connections.append(conn)
+
+        self._local.depth += 1
         try:
             yield conn
-            conn.commit()
+            if self._local.depth == 1:
+                conn.commit()
         except Exception:
-            conn.rollback()
+            if self._local.depth == 1:
+                conn.rollback()
             raise
         finally:
-            conn.close()
+            self._local.depth -= 1
+
+    def close(self):
+        """全スレッドのデータベース接続を閉じる"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logging.error(f"Failed to close database connection: {e}")
+        self._local = threading.local()
 
     def _init_db(self):
         """データベースとテーブルを初期化"""
@@ -67,16 +181,245 @@ class ConversationStorage:
                 )
             ''')
 
-            # インデックス作成
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_messages_conversation
-                ON messages(conversation_id)
-            ''')
+            # インデックス作成（会話IDのインデックスはマイグレーションで作成）
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_messages_status
                 ON messages(status_id)
             ''')
 
+            # ボットの状態（通知カーソルなど）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+
+            # LLMの応答キャッシュ（モデルとプロンプトのハッシュがキー）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    hits INTEGER DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    last_used_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+                ON response_cache(last_used_at)
+            ''')
+
+            # 後から追加したカラムとインデックス
+            self._migrate(conn)
+
+            self.search_enabled = self._init_search_index(cursor)
+
+    def _check_schema(self):
+        """
+        読み込み専用で開いたデータベースのスキーマを確認
+
+        マイグレーションは適用できないため、古いスキーマの場合はエラーにする。
+        """
+        with self._get_connection() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            latest = self.MIGRATIONS[-1][0]
+            if version < latest:
+                raise RuntimeError(
+                    f'Database schema version {version} is older than {latest}; '
+                    f'start the bot or run a write command once to migrate it'
+                )
+            try:
+                for fts in ('messages_fts', 'conversations_fts'):
+                    conn.execute(f'SELECT 1 FROM {fts} LIMIT 0')
+                self.search_enabled = True
+            except sqlite3.OperationalError:
+                self.search_enabled = False
+
+    def _init_search_index(self, cursor) -> bool:
+        """
+        全文検索のインデックス（FTS5）を作成（作成できた場合はTrue）
+
+        messages.content と conversations.custom_prompt を外部コンテンツとして参照し、
+        トリガーで同期する。日本語は単語で区切られていないため trigram トークナイザーを使う。
+        既存のデータベースでは作成時に一度だけインデックスを再構築する。
+        """
+        indexes = (
+            ('messages_fts', 'messages', 'content'),
+            ('conversations_fts', 'conversations', 'custom_prompt'),
+        )
+        try:
+            for fts, table, column in indexes:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+                created = cursor.fetchone() is None
+
+                cursor.execute(f'''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                        {column}, content='{table}', content_rowid='id', tokenize='trigram'
+                    )
+                ''')
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                        INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column});
+                    END
+                ''')
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                        INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                    END
+                ''')
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} ON {table}
+                    WHEN old.{column} IS NOT new.{column} BEGIN
+                        INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                        INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column});
+                    END
+                ''')
+
+                if created:
+                    cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+                    logging.info(f"Built full-text search index {fts}")
+            return True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Full-text search is unavailable: {e}")
+            return False
+
+    def _ensure_column(self, cursor, table: str, column: str, definition: str) -> bool:
+        """既存のデータベースにカラムがなければ追加（追加した場合はTrue）"""
+        cursor.execute(f'PRAGMA table_xinfo({table})')  # 生成カラムも含める
+        if column not in {row['name'] for row in cursor.fetchall()}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            logging.info(f"Added column {table}.{column}")
+            return True
+        return False
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """
+        スキーマのマイグレーションを適用
+
+        適用済みのバージョンを PRAGMA user_version に記録し、それより新しい
+        マイグレーションを順に1つずつのトランザクションで適用する。途中で失敗した
+        マイグレーションはロールバックされ、次の起動時に再度適用される。
+        バージョンを記録する前に作成したデータベースはバージョン0となるため、
+        バージョン1〜3は既存のカラムやインデックスがあっても適用できるようにしている。
+        """
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        latest = self.MIGRATIONS[-1][0]
+        if version > latest:
+            logging.warning(f"Database schema version {version} is newer than supported ({latest})")
+            return
+
+        for target, description, migration in self.MIGRATIONS:
+            if target <= version:
+                continue
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # 別のプロセスが先に適用していればスキップ
+                if conn.execute('PRAGMA user_version').fetchone()[0] >= target:
+                    conn.commit()
+                    continue
+                migration(self, conn.cursor())
+                conn.execute(f'PRAGMA user_version = {target}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logging.info(f"Applied schema migration {target}: {description}")
+
+    def _migration_summary(self, cursor):
+        """会話の要約"""
+        self._ensure_column(cursor, 'conversations', 'summary', 'TEXT')
+        self._ensure_column(cursor, 'conversations', 'summary_message_count', 'INTEGER DEFAULT 0')
+
+    def _migration_thread_root(self, cursor):
+        """返信先のカラムと、スレッドの起点から会話を引くためのカラムとインデックス"""
+        self._ensure_column(cursor, 'messages', 'in_reply_to_id', 'TEXT')
+        if self._ensure_column(cursor, 'conversations', 'root_status_id', 'TEXT'):
+            # 既存の会話は最初に保存したメッセージをスレッドの起点とする
+            cursor.execute('''
+                UPDATE conversations SET root_status_id = (
+                    SELECT status_id FROM messages
+                    WHERE messages.conversation_id = conversations.id
+                    ORDER BY messages.id LIMIT 1
+                )
+            ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conversations_root
+            ON conversations(root_status_id)
+        ''')
+
+    def _migration_conversation_aggregates(self, cursor):
+        """会話一覧用の集計（メッセージの挿入・削除時にトリガーで更新）と更新日時のインデックス"""
+        added_count = self._ensure_column(cursor, 'conversations', 'message_count', 'INTEGER DEFAULT 0')
+        added_last = self._ensure_column(cursor, 'conversations', 'last_message_at', 'TEXT')
+        if added_count or added_last:
+            cursor.execute('''
+                UPDATE conversations SET
+                    message_count = (
+                        SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id
+                    ),
+                    last_message_at = (
+                        SELECT MAX(created_at) FROM messages WHERE messages.conversation_id = conversations.id
+                    )
+            ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_count_insert AFTER INSERT ON messages BEGIN
+                UPDATE conversations SET
+                    message_count = message_count + 1,
+                    last_message_at = CASE
+                        WHEN last_message_at IS NULL OR new.created_at > last_message_at
+                        THEN COALESCE(new.created_at, last_message_at) ELSE last_message_at END
+                WHERE id = new.conversation_id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_count_delete AFTER DELETE ON messages BEGIN
+                UPDATE conversations SET message_count = message_count - 1
+                WHERE id = old.conversation_id;
+            END
+        ''')
+        # 会話一覧を更新日時の新しい順にページ送りするためのインデックス
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conversations_updated
+            ON conversations(updated_at, id)
+        ''')
+
+    def _migration_status_order(self, cursor):
+        """
+        会話内のメッセージを投稿順に読むためのインデックス
+
+        MastodonのステータスIDは投稿順に増える数値のため、数値に変換した
+        status_seq（生成カラム）で並べる（created_at は空の場合がある）。
+        (conversation_id, status_seq) のインデックスで会話の範囲を読むだけで
+        並べ替えが不要になる。会話IDだけのインデックスはこれで代替できるため削除する。
+        """
+        self._ensure_column(
+            cursor, 'messages', 'status_seq',
+            'INTEGER GENERATED ALWAYS AS (CAST(status_id AS INTEGER)) VIRTUAL'
+        )
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation_seq
+            ON messages(conversation_id, status_seq)
+        ''')
+        cursor.execute('DROP INDEX IF EXISTS idx_messages_conversation')
+
+    def _migration_drop_reply_index(self, cursor):
+        """返信先のインデックスを削除（返信先で検索するクエリがなく、挿入のたびに更新されるだけのため）"""
+        cursor.execute('DROP INDEX IF EXISTS idx_messages_in_reply_to')
+
+    # (バージョン, 説明, マイグレーション)。追加するときは末尾にバージョンを1つ増やして追加する
+    MIGRATIONS = (
+        (1, 'conversation summary', _migration_summary),
+        (2, 'thread root lookups', _migration_thread_root),
+        (3, 'conversation aggregates', _migration_conversation_aggregates),
+        (4, 'message ordering by status ID', _migration_status_order),
+        (5, 'drop unused reply index', _migration_drop_reply_index),
+    )
+
     def save_conversation(
         self,
         conversation_id: int,
@@ -85,63 +428,111 @@ class ConversationStorage:
         ai_prompt: str,
         ai_response: str,
         custom_prompt: str = None,
-        bot_reply_ids: set = None
+        bot_reply_ids: set = None,
+        known_status_ids: Optional[set] = None
     ):
-        """会話データを保存（更新）"""
+        """
+        会話データを保存（更新）
+
+        Args:
+            known_status_ids: 保存済みのステータスID（会話コンテキストから渡す）。
+                省略時はデータベースから取得する。これに含まれない投稿だけを挿入する。
+        """
         now = datetime.now().isoformat()
         bot_reply_ids = bot_reply_ids or set()
 
+        # スレッドの起点（祖先を取得できた場合のみ）
+        root_status_id = None
+        if thread_data and thread_data[0].in_reply_to_id is None:
+            root_status_id = str(thread_data[0].id)
+
         with self._get_connection() as conn:
             cursor = conn.cursor()
 
-            # 会話が存在するか確認
-            cursor.execute('SELECT id FROM conversations WHERE id = ?', (conversation_id,))
-            exists = cursor.fetchone() is not None
-
-            if exists:
-                # 更新
-                if custom_prompt:
-                    cursor.execute('''
-                        UPDATE conversations
-                        SET custom_prompt = ?, ai_prompt = ?, latest_ai_response = ?, updated_at = ?
-                        WHERE id = ?
-                    ''', (custom_prompt, ai_prompt, ai_response, now, conversation_id))
-                else:
-                    cursor.execute('''
-                        UPDATE conversations
-                        SET latest_ai_response = ?, updated_at = ?
-                        WHERE id = ?
-                    ''', (ai_response, now, conversation_id))
-            else:
-                # 新規作成
-                cursor.execute('''
-                    INSERT INTO conversations (id, custom_prompt, ai_prompt, latest_ai_response, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (conversation_id, custom_prompt, ai_prompt, ai_response, now, now))
+            # 会話を作成、既存ならカスタムプロンプトがある場合のみプロンプトも更新
+            cursor.execute('''
+                INSERT INTO conversations
+                (id, custom_prompt, ai_prompt, latest_ai_response, root_status_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    custom_prompt = COALESCE(excluded.custom_prompt, conversations.custom_prompt),
+                    ai_prompt = CASE WHEN excluded.custom_prompt IS NOT NULL
+                                     THEN excluded.ai_prompt ELSE conversations.ai_prompt END,
+                    latest_ai_response = excluded.latest_ai_response,
+                    root_status_id = COALESCE(conversations.root_status_id, excluded.root_status_id),
+                    updated_at = excluded.updated_at
+            ''', (conversation_id, custom_prompt or None, ai_prompt, ai_response, root_status_id, now, now))
+
+            if known_status_ids is None:
+                cursor.execute(
+                    'SELECT status_id FROM messages WHERE conversation_id = ?',
+                    (conversation_id,)
+                )
+                known_status_ids = {row['status_id'] for row in cursor.fetchall()}
 
-            # メッセージを保存
+            # 未保存のメッセージだけをまとめて挿入
+            rows = {}
             for status in thread_data:
                 status_id = str(status.id)
-                is_bot_reply = 1 if status_id in bot_reply_ids else 0
-
+                if status_id in known_status_ids or status_id in rows:
+                    continue
                 try:
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO messages
-                        (conversation_id, status_id, account, content, url, is_bot_reply, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (
+                    rows[status_id] = (
                         conversation_id,
                         status_id,
                         status.account.acct,
                         strip_html(status.content),
                         status.url,
-                        is_bot_reply,
+                        str(status.in_reply_to_id) if status.in_reply_to_id is not None else None,
+                        1 if status_id in bot_reply_ids else 0,
                         status.created_at.isoformat() if status.created_at else None
-                    ))
+                    )
                 except Exception as e:
                     logging.error(f"Failed to save message {status_id}: {e}")
 
-        logging.info(f"Saved/Updated conversation {conversation_id}")
+            if rows:
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO messages
+                    (conversation_id, status_id, account, content, url, in_reply_to_id, is_bot_reply, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', list(rows.values()))
+
+        self._cache_invalidate(conversation_id)
+        logging.info(f"Saved/Updated conversation {conversation_id} ({len(rows)} new messages)")
+
+    def is_status_known(self, status_id: str) -> bool:
+        """ステータスが保存済みか確認（status_id のインデックスで1件だけ検索）"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM messages WHERE status_id = ?', (status_id,))
+            return cursor.fetchone() is not None
+
+    def get_state(self, key: str) -> Optional[str]:
+        """ボットの状態を取得"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            return row['value'] if row else None
+
+    def set_state(self, key: str, value: str):
+        """ボットの状態を保存"""
+        with self._get_connection() as conn:
+            conn.execute('''
+                INSERT INTO bot_state (key, value, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+            ''', (key, value, datetime.now().isoformat()))
+
+    def advance_state(self, key: str, value: int) -> bool:
+        """数値の状態を、現在の値より大きい場合だけ更新（カーソル用）"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO bot_state (key, value, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                WHERE CAST(excluded.value AS INTEGER) > CAST(bot_state.value AS INTEGER)
+            ''', (key, str(value), datetime.now().isoformat()))
+            return cursor.rowcount > 0
 
     def find_conversation_by_status(self, status_id: str) -> Optional[int]:
         """ステータスIDから会話IDを検索"""
@@ -153,13 +544,43 @@ class ConversationStorage:
             row = cursor.fetchone()
             return row['conversation_id'] if row else None
 
+    def find_conversation_by_root(self, root_status_id: str) -> Optional[int]:
+        """スレッドの起点のステータスIDから会話IDを検索"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id FROM conversations WHERE root_status_id = ?
+                ORDER BY updated_at DESC LIMIT 1
+            ''', (root_status_id,))
+            row = cursor.fetchone()
+            return row['id'] if row else None
+
+    def resolve_conversation(self, status) -> Optional[int]:
+        """
+        スレッドを取得せずにメンションの会話IDを検索
+
+        返信先が保存済みであれば、その会話とする（インデックスで1件検索）。
+        """
+        if status.in_reply_to_id is None:
+            return None
+        return self.find_conversation_by_status(str(status.in_reply_to_id))
+
     def find_existing_conversation(self, thread_data: list) -> Optional[int]:
-        """スレッド内の投稿から既存の会話IDを検索"""
+        """
+        スレッド内の投稿から既存の会話IDを検索
+
+        スレッドの起点で検索し、見つからなければスレッド内のいずれかの投稿で検索する。
+        """
         status_ids = [str(status.id) for status in thread_data]
 
         if not status_ids:
             return None
 
+        if thread_data[0].in_reply_to_id is None:
+            conversation_id = self.find_conversation_by_root(status_ids[0])
+            if conversation_id:
+                return conversation_id
+
         with self._get_connection() as conn:
             cursor = conn.cursor()
             placeholders = ','.join(['?' for _ in status_ids])
@@ -171,8 +592,32 @@ class ConversationStorage:
             row = cursor.fetchone()
             return row['conversation_id'] if row else None
 
+    def load_context(
+        self,
+        conversation_id: int,
+        thread_data: list,
+        bot_acct: Optional[str] = None
+    ) -> ConversationContext:
+        """会話データを1度だけ読み込み、会話コンテキストを作成"""
+        return ConversationContext(
+            conversation_id,
+            thread_data,
+            self.load_conversation(conversation_id),
+            bot_acct
+        )
+
     def load_conversation(self, conversation_id: int) -> Optional[dict]:
-        """会話データを読み込み"""
+        """会話データを読み込み（リクエストスコープ内ではキャッシュを利用）"""
+        hit, data = self._cache_get(conversation_id)
+        if hit:
+            return data
+
+        data = self._load_conversation(conversation_id)
+        self._cache_put(conversation_id, data)
+        return data
+
+    def _load_conversation(self, conversation_id: int) -> Optional[dict]:
+        """データベースから会話データを読み込み"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
 
@@ -187,7 +632,7 @@ class ConversationStorage:
             cursor.execute('''
                 SELECT * FROM messages
                 WHERE conversation_id = ?
-                ORDER BY created_at ASC
+                ORDER BY status_seq, id
             ''', (conversation_id,))
             messages = cursor.fetchall()
 
@@ -198,6 +643,8 @@ class ConversationStorage:
                 'latest_ai_response': conv_row['latest_ai_response'],
                 'created_at': conv_row['created_at'],
                 'updated_at': conv_row['updated_at'],
+                'summary': conv_row['summary'],
+                'summary_message_count': conv_row['summary_message_count'] or 0,
                 'thread_data': [
                     {
                         'id': msg['status_id'],
@@ -221,11 +668,98 @@ class ConversationStorage:
                 WHERE id = ?
             ''', (custom_prompt, datetime.now().isoformat(), conversation_id))
 
+            self._cache_invalidate(conversation_id)
             if cursor.rowcount > 0:
                 logging.info(f"Updated custom prompt for conversation {conversation_id}")
                 return True
             return False
 
+    def get_summary(self, conversation_id: int) -> tuple[Optional[str], int]:
+        """会話の要約と要約に含めた投稿数を取得（会話がなければ (None, 0)）"""
+        with self._get_connection() as conn:
+            row = conn.execute(
+                'SELECT summary, summary_message_count FROM conversations WHERE id = ?',
+                (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return None, 0
+        return row['summary'], row['summary_message_count'] or 0
+
+    def save_summary(self, conversation_id: int, summary: str, message_count: int) -> bool:
+        """
+        会話の要約を保存
+
+        Args:
+            summary: 要約
+            message_count: 要約に含めた投稿数（会話ログの先頭からの件数）
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE conversations
+                SET summary = ?, summary_message_count = ?
+                WHERE id = ?
+            ''', (summary, message_count, conversation_id))
+
+            self._cache_invalidate(conversation_id)
+            return cursor.rowcount > 0
+
+    def get_cached_response(self, key: str, ttl: float) -> Optional[str]:
+        """
+        キャッシュした応答を取得（期限切れの場合は削除してNone）
+
+        Args:
+            key: キャッシュのキー
+            ttl: 有効期間（秒、0で無期限）
+        """
+        now = datetime.now()
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT response, created_at FROM response_cache WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+
+            if ttl > 0 and row['created_at'] < (now - timedelta(seconds=ttl)).isoformat():
+                cursor.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                return None
+
+            cursor.execute('''
+                UPDATE response_cache SET hits = hits + 1, last_used_at = ? WHERE key = ?
+            ''', (now.isoformat(), key))
+            return row['response']
+
+    def put_cached_response(self, key: str, model: str, response: str, ttl: float, max_entries: int):
+        """
+        応答をキャッシュに保存し、期限切れと上限を超えた古いエントリを削除
+
+        Args:
+            ttl: 有効期間（秒、0で無期限）
+            max_entries: 保持する最大件数（最後に使われた順に残す）
+        """
+        now = datetime.now()
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO response_cache (key, model, response, hits, created_at, last_used_at)
+                VALUES (?, ?, ?, 0, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    response = excluded.response,
+                    created_at = excluded.created_at,
+                    last_used_at = excluded.last_used_at
+            ''', (key, model, response, now.isoformat(), now.isoformat()))
+
+            if ttl > 0:
+                cursor.execute(
+                    'DELETE FROM response_cache WHERE created_at < ?',
+                    ((now - timedelta(seconds=ttl)).isoformat(),)
+                )
+            cursor.execute('''
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,))
+
     def get_conversation_messages(self, conversation_id: int) -> list[dict]:
         """会話のメッセージ一覧を取得"""
         with self._get_connection() as conn:
@@ -233,7 +767,7 @@ class ConversationStorage:
             cursor.execute('''
                 SELECT * FROM messages
                 WHERE conversation_id = ?
-                ORDER BY created_at ASC
+                ORDER BY status_seq, id
             ''', (conversation_id,))
 
             return [
@@ -248,24 +782,313 @@ class ConversationStorage:
             ]
 
     def get_all_conversations(self, limit: int = 100) -> list[dict]:
-        """全会話の一覧を取得"""
+        """全会話の一覧を取得（更新日時の新しい順に先頭から limit 件）"""
+        return self.get_conversations_page(limit)[0]
+
+    def get_conversations_page(
+        self,
+        limit: int = 100,
+        cursor: Optional[str] = None
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        会話の一覧を更新日時の新しい順にページ単位で取得（キーセットページネーション）
+
+        (updated_at, id) のインデックスを前回の最後の会話の位置から読むため、
+        何ページ目でも読み飛ばす行がない。
+
+        Args:
+            limit: 取得する件数
+            cursor: 前のページで返されたカーソル（省略時は先頭から）
+
+        Returns:
+            (会話のリスト, 次のページのカーソル)。最後のページではカーソルはNone。
+        """
+        with self._get_connection() as conn:
+            db_cursor = conn.cursor()
+            if cursor is None:
+                db_cursor.execute('''
+                    SELECT id, custom_prompt, message_count, last_message_at, created_at, updated_at
+                    FROM conversations
+                    ORDER BY updated_at DESC, id DESC
+                    LIMIT ?
+                ''', (limit + 1,))
+            else:
+                updated_at, conversation_id = self._parse_page_cursor(cursor)
+                db_cursor.execute('''
+                    SELECT id, custom_prompt, message_count, last_message_at, created_at, updated_at
+                    FROM conversations
+                    WHERE (updated_at, id) < (?, ?)
+                    ORDER BY updated_at DESC, id DESC
+                    LIMIT ?
+                ''', (updated_at, conversation_id, limit + 1))
+            rows = db_cursor.fetchall()
+
+        conversations = [
+            {
+                'id': row['id'],
+                'custom_prompt': row['custom_prompt'],
+                'message_count': row['message_count'] or 0,
+                'last_message_at': row['last_message_at'],
+                'created_at': row['created_at'],
+                'updated_at': row['updated_at']
+            }
+            for row in rows[:limit]
+        ]
+
+        next_cursor = None
+        if len(rows) > limit and conversations:
+            last = conversations[-1]
+            next_cursor = f"{last['updated_at']},{last['id']}"
+        return conversations, next_cursor
+
+    @staticmethod
+    def _parse_page_cursor(cursor: str) -> tuple[str, int]:
+        """ページのカーソル（"更新日時,会話ID"）を分解"""
+        updated_at, separator, conversation_id = cursor.rpartition(',')
+        if not separator or not conversation_id.isdigit():
+            raise ValueError(f'Invalid page cursor: {cursor}')
+        return updated_at, int(conversation_id)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        読み込みのスナップショット
+
+        ブロック内の読み込みは1つのトランザクションで行うため、
+        ボットが書き込み中でも開始時点のデータを一貫して参照できる（WALモード）。
+        """
+        with self._get_connection() as conn:
+            if not conn.in_transaction:
+                conn.execute('BEGIN')
+            yield
+
+    def iter_rows(self, table: str, batch_size: int = 1000) -> Iterator[list[dict]]:
+        """
+        テーブルの行を挿入順にバッチ単位で返す（EXPORT_COLUMNS のカラムのみ）
+
+        主キーによるキーセットで読むため、テーブルの大きさによらずメモリ使用量は一定。
+        """
+        columns = EXPORT_COLUMNS[table]
+        last_id = None
+        while True:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if last_id is None:
+                    cursor.execute(f'''
+                        SELECT id AS _rowid, {', '.join(columns)} FROM {table}
+                        ORDER BY id LIMIT ?
+                    ''', (batch_size,))
+                else:
+                    cursor.execute(f'''
+                        SELECT id AS _rowid, {', '.join(columns)} FROM {table}
+                        WHERE id > ? ORDER BY id LIMIT ?
+                    ''', (last_id, batch_size))
+                rows = cursor.fetchall()
+
+            if not rows:
+                return
+            last_id = rows[-1]['_rowid']
+            yield [{column: row[column] for column in columns} for row in rows]
+
+    def insert_rows(self, table: str, rows: list[dict]) -> int:
+        """
+        行をまとめて1トランザクションで挿入（既存の会話・メッセージは変更しない）
+
+        Returns:
+            挿入した件数
+        """
+        columns = EXPORT_COLUMNS[table]
+        placeholders = ', '.join('?' for _ in columns)
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(f'''
+                INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})
+            ''', [tuple(row.get(column) for column in columns) for row in rows])
+            return cursor.rowcount
+
+    def find_idle_conversations(self, before: str, limit: int = 100) -> list[int]:
+        """更新日時が before より前の会話IDを古い順に取得（更新日時のインデックスを使用）"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT id, custom_prompt, created_at, updated_at,
-                       (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id) as message_count
-                FROM conversations
-                ORDER BY updated_at DESC
-                LIMIT ?
-            ''', (limit,))
+                SELECT id FROM conversations WHERE updated_at < ?
+                ORDER BY updated_at, id LIMIT ?
+            ''', (before, limit))
+            return [row['id'] for row in cursor.fetchall()]
+
+    def get_conversation_rows(self, conversation_id: int) -> Optional[dict]:
+        """
+        会話とメッセージの行を取得（EXPORT_COLUMNS のカラムのみ、アーカイブ用）
+
+        Returns:
+            {'conversation': 会話の行, 'messages': メッセージの行のリスト}
+        """
+        conversation_columns = EXPORT_COLUMNS['conversations']
+        message_columns = EXPORT_COLUMNS['messages']
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(conversation_columns)} FROM conversations WHERE id = ?",
+                (conversation_id,)
+            )
+            conv_row = cursor.fetchone()
+            if conv_row is None:
+                return None
+
+            cursor.execute(f'''
+                SELECT {', '.join(message_columns)} FROM messages
+                WHERE conversation_id = ?
+                ORDER BY status_seq, id
+            ''', (conversation_id,))
+            return {
+                'conversation': {column: conv_row[column] for column in conversation_columns},
+                'messages': [
+                    {column: row[column] for column in message_columns}
+                    for row in cursor.fetchall()
+                ]
+            }
+
+    def delete_conversations(self, conversations: list[tuple[int, str]]) -> list[int]:
+        """
+        会話とメッセージを1トランザクションで削除
+
+        読み込んだ後に更新された会話（新しい返信があった会話）は削除しない。
+
+        Args:
+            conversations: (会話ID, 読み込んだときの更新日時) のリスト
+
+        Returns:
+            削除した会話IDのリスト
+        """
+        deleted = []
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            for conversation_id, updated_at in conversations:
+                cursor.execute(
+                    'DELETE FROM conversations WHERE id = ? AND updated_at = ?',
+                    (conversation_id, updated_at)
+                )
+                if cursor.rowcount > 0:
+                    cursor.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+                    deleted.append(conversation_id)
+
+        for conversation_id in deleted:
+            self._cache_invalidate(conversation_id)
+        return deleted
+
+    def compact(self, step_pages: int = 1000, analysis_limit: int = 1000) -> int:
+        """
+        空いたページの解放と統計情報の更新
+
+        incremental_vacuum は step_pages ページずつ別のトランザクションで実行するため、
+        ボットの書き込みを長くブロックしない。ANALYZE は analysis_limit 行の
+        サンプルで行う（auto_vacuum が INCREMENTAL でないデータベースではページを解放しない）。
+
+        Returns:
+            解放したページ数
+        """
+        freed = 0
+        with self._get_connection() as conn:
+            incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        while incremental:
+            with self._get_connection() as conn:
+                before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if before == 0:
+                    break
+                conn.execute(f'PRAGMA incremental_vacuum({int(step_pages)})').fetchall()
+                after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if after >= before:
+                break
+            freed += before - after
+
+        with self._get_connection() as conn:
+            conn.execute(f'PRAGMA analysis_limit={int(analysis_limit)}')
+            conn.execute('ANALYZE')
+        return freed
+
+    def vacuum(self):
+        """
+        データベース全体を再構築（auto_vacuum を INCREMENTAL にする）
+
+        既存のデータベースで compact() がページを解放できるようにするために1度だけ実行する。
+        実行中は書き込みがブロックされ、一時的にデータベースと同じサイズの空き容量が必要。
+        """
+        with self._get_connection() as conn:
+            conn.commit()
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> list[dict]:
+        """
+        メッセージとカスタムプロンプトを全文検索
+
+        空白で区切った語をすべて含むものを関連度（bm25）の高い順に返す。
+        trigram トークナイザーは3文字未満の語をインデックスで検索できないため、
+        その場合（および全文検索が使えない場合）は LIKE で検索して新しい順に返す。
+
+        Args:
+            query: 検索語
+            limit: 取得する件数
+            offset: 先頭から読み飛ばす件数（ページ送り用）
+
+        Returns:
+            conversation_id, kind（message / custom_prompt）, status_id, account,
+            snippet（一致箇所を [] で囲んだ抜粋）, created_at, rank を持つ辞書のリスト
+        """
+        terms = query.split()
+        if not terms:
+            return []
+
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            if self.search_enabled and all(len(term) >= 3 for term in terms):
+                match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+                cursor.execute('''
+                    SELECT * FROM (
+                        SELECT m.conversation_id, 'message' AS kind, m.status_id, m.account,
+                               snippet(messages_fts, 0, '[', ']', '…', 24) AS snippet,
+                               m.created_at, bm25(messages_fts) AS rank
+                        FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                        WHERE messages_fts MATCH ?
+                        UNION ALL
+                        SELECT c.id, 'custom_prompt', NULL, NULL,
+                               snippet(conversations_fts, 0, '[', ']', '…', 24),
+                               c.updated_at, bm25(conversations_fts)
+                        FROM conversations_fts JOIN conversations c ON c.id = conversations_fts.rowid
+                        WHERE conversations_fts MATCH ?
+                    )
+                    ORDER BY rank, created_at DESC
+                    LIMIT ? OFFSET ?
+                ''', (match, match, limit, offset))
+            else:
+                patterns = [
+                    '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                    for term in terms
+                ]
+                message_where = ' AND '.join(["content LIKE ? ESCAPE '\\'"] * len(terms))
+                prompt_where = ' AND '.join(["custom_prompt LIKE ? ESCAPE '\\'"] * len(terms))
+                cursor.execute(f'''
+                    SELECT * FROM (
+                        SELECT conversation_id, 'message' AS kind, status_id, account,
+                               content AS snippet, created_at, 0 AS rank
+                        FROM messages WHERE {message_where}
+                        UNION ALL
+                        SELECT id, 'custom_prompt', NULL, NULL, custom_prompt, updated_at, 0
+                        FROM conversations WHERE {prompt_where}
+                    )
+                    ORDER BY created_at DESC
+                    LIMIT ? OFFSET ?
+                ''', patterns + patterns + [limit, offset])
 
             return [
                 {
-                    'id': row['id'],
-                    'custom_prompt': row['custom_prompt'],
-                    'message_count': row['message_count'],
+                    'conversation_id': row['conversation_id'],
+                    'kind': row['kind'],
+                    'status_id': row['status_id'],
+                    'account': row['account'],
+                    'snippet': row['snippet'],
                     'created_at': row['created_at'],
-                    'updated_at': row['updated_at']
+                    'rank': row['rank']
                 }
                 for row in cursor.fetchall()
             ]
@@ -1,12 +1,31 @@
 """ユーティリティ関数"""
 import re
 import time
+import threading
 from datetime import datetime
+from html import unescape
+
+
+# HTMLの変換パターン
+_HTML_BREAK_PATTERN = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_HTML_PARAGRAPH_PATTERN = re.compile(r'</p>\s*<p[^>]*>', re.IGNORECASE)
+_HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+# カスタムプロンプト /*...*/ のパターン
+CUSTOM_PROMPT_PATTERN = re.compile(r'/\*(.*?)\*/', re.DOTALL)
 
 
 def strip_html(html: str) -> str:
-    """HTMLタグを除去"""
-    return re.sub(r'<[^>]+>', '', html)
+    """HTMLをテキストに変換（<br>を改行、段落の区切りを空行にし、タグ除去と文字参照のデコードを行う）"""
+    if '<' in html:
+        if '<br' in html or '<BR' in html:
+            html = _HTML_BREAK_PATTERN.sub('\n', html)
+        if '</p>' in html or '</P>' in html:
+            html = _HTML_PARAGRAPH_PATTERN.sub('\n\n', html)
+        html = _HTML_TAG_PATTERN.sub('', html)
+    if '&' in html:
+        html = unescape(html)
+    return html
 
 
 def extract_custom_prompt(text: str) -> str | None:
@@ -20,79 +39,98 @@ def extract_custom_prompt(text: str) -> str | None:
     */
     """
     # re.DOTALL で . が改行にもマッチ、.*? で最短マッチ
-    match = re.search(r'/\*(.*?)\*/', text, re.DOTALL)
+    match = CUSTOM_PROMPT_PATTERN.search(text)
     if match:
         return match.group(1).strip()
     return None
 
 
-def remove_markdown(text: str) -> str:
-    """Markdownフォーマットを除去"""
-    plain_text = text
-
+# Markdown除去のパイプライン: (パターン, 置換, 対象の文字列)
+# 対象の文字列のいずれも含まれないテキストにはそのパスを適用しない（結果は変わらない）
+_MARKDOWN_PASSES = [
     # 0. WebFetchToolの出力やAPIレスポンスを削除
-    plain_text = re.sub(r'\[WebFetchTool\].*?(?=\n[^\[\s]|\Z)', '', plain_text, flags=re.DOTALL)
-
+    (re.compile(r'\[WebFetchTool\].*?(?=\n[^\[\s]|\Z)', re.DOTALL), '', ('[WebFetchTool]',)),
     # 0.5. Google CLI credentials メッセージを削除
-    plain_text = re.sub(r'Loaded cached credentials\..*?\n?', '', plain_text, flags=re.MULTILINE)
-
+    (re.compile(r'Loaded cached credentials\..*?\n?', re.MULTILINE), '', ('Loaded cached credentials.',)),
     # 1. JSONブロックを削除 (より厳密に)
-    plain_text = re.sub(r'\{.*?\}', '', plain_text, flags=re.DOTALL)
-
-    # 2. JSON残りカスを削除
-    plain_text = re.sub(r'^[}\]\s]*$', '', plain_text, flags=re.MULTILINE)
-    plain_text = re.sub(r'^\s*[":,\[\]{}]\s*$', '', plain_text, flags=re.MULTILINE)
-
+    (re.compile(r'\{.*?\}', re.DOTALL), '', ('{',)),
+    # 2. JSON残りカスを削除（空白だけの行にも作用するため常に適用）
+    (re.compile(r'^[}\]\s]*$', re.MULTILINE), '', None),
+    (re.compile(r'^\s*[":,\[\]{}]\s*$', re.MULTILINE), '', ('"', ':', ',', '[', ']', '{', '}')),
     # 3. コロンで始まる行を削除 (JSONの残りカス)
-    plain_text = re.sub(r'^\s*":\s*', '', plain_text, flags=re.MULTILINE)
-
+    (re.compile(r'^\s*":\s*', re.MULTILINE), '', ('":',)),
     # 4. コードブロックを削除 (```で囲まれた部分)
-    plain_text = re.sub(r'```.*?```', '', plain_text, flags=re.DOTALL)
-
+    (re.compile(r'```.*?```', re.DOTALL), '', ('```',)),
     # 5. 見出しを削除 (#)
-    plain_text = re.sub(r'^#+\s*(.*)$', r'\1', plain_text, flags=re.MULTILINE)
-
+    (re.compile(r'^#+\s*(.*)$', re.MULTILINE), r'\1', ('#',)),
     # 6. 太字と斜体を削除 (内容のみ残す)
-    plain_text = re.sub(r'\*\*([^\*]+)\*\*', r'\1', plain_text)  # **太字**
-    plain_text = re.sub(r'__([^_]+)__', r'\1', plain_text)  # __太字__
-    plain_text = re.sub(r'\*([^\*]+)\*', r'\1', plain_text)  # *斜体*
-    plain_text = re.sub(r'_([^_]+)_', r'\1', plain_text)  # _斜体_
-
+    (re.compile(r'\*\*([^\*]+)\*\*'), r'\1', ('**',)),  # **太字**
+    (re.compile(r'__([^_]+)__'), r'\1', ('__',)),  # __太字__
+    (re.compile(r'\*([^\*]+)\*'), r'\1', ('*',)),  # *斜体*
+    (re.compile(r'_([^_]+)_'), r'\1', ('_',)),  # _斜体_
     # 7. リンクを削除 (リンクテキストのみ残す)
-    plain_text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', plain_text)
-
+    (re.compile(r'\[([^\]]+)\]\([^\)]+\)'), r'\1', ('](',)),
     # 8. 引用符を削除 (>)
-    plain_text = re.sub(r'^>\s*', '', plain_text, flags=re.MULTILINE)
-
+    (re.compile(r'^>\s*', re.MULTILINE), '', ('>',)),
     # 9. インラインコードを削除 (`)
-    plain_text = re.sub(r'`([^`]+)`', r'\1', plain_text)
-
+    (re.compile(r'`([^`]+)`'), r'\1', ('`',)),
     # 10. 水平線 (---, ***, ___) を削除
-    plain_text = re.sub(r'^[-\*_]{3,}\s*$', '', plain_text, flags=re.MULTILINE)
-
+    (re.compile(r'^[-\*_]{3,}\s*$', re.MULTILINE), '', ('-', '*', '_')),
     # 11. 余分な空行を整理
-    plain_text = re.sub(r'\n\n+', '\n\n', plain_text).strip()
+    (re.compile(r'\n\n+'), '\n\n', ('\n\n',)),
+]
+
+
+def remove_markdown(text: str) -> str:
+    """Markdownフォーマットを除去"""
+    plain_text = text
 
-    return plain_text
+    for pattern, replacement, triggers in _MARKDOWN_PASSES:
+        if triggers is None or any(t in plain_text for t in triggers):
+            plain_text = pattern.sub(replacement, plain_text)
 
+    return plain_text.strip()
 
-def split_into_segments(text: str, max_len: int = 400) -> list[str]:
-    """テキストを文で区切り、max_lenに収まるセグメントに分割"""
-    # Split into sentences (supports Japanese and English punctuation)
-    sentences = re.split(r'(?<=[。.！？!?])\s*', text)
+
+# 文の区切り（日本語と英語の句読点）
+_SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[。.！？!?])\s*')
+
+
+def _pack_sentences(text: str, limit: int) -> tuple[list[str], str, int]:
+    """
+    文を先頭から順にlimitに収まるように詰める
+
+    Returns:
+        (確定したセグメント, 最後のセグメント（後続の文で伸びる可能性がある）,
+         確定したセグメントの text 上の終了位置（直後の空白を含む）)
+    """
     segments = []
     current = ''
-    limit = max_len - 100  # より余裕をもたせる
+    current_end = 0  # current の直前までの確定位置
+    sentence_start = 0
+
+    # 文末の後の空白は文に含めない（split と同じ区切り方）
+    boundaries = [(m.start(), m.end()) for m in _SENTENCE_SPLIT_PATTERN.finditer(text)]
+    boundaries.append((len(text), len(text)))
+    for sentence_end, next_start in boundaries:
+        sentence = text[sentence_start:sentence_end]
+        if sentence:
+            prospect = f"{current}{sentence}" if current else sentence
+            if len(prospect) > limit and current:
+                segments.append(current)
+                current_end = sentence_start
+                current = sentence
+            else:
+                current = prospect
+        sentence_start = next_start
+
+    return segments, current, current_end
 
-    for sentence in sentences:
-        if not sentence:
-            continue
-        prospect = f"{current}{sentence}" if current else sentence
-        if len(prospect) > limit and current:
-            segments.append(current)
-            current = sentence
-        else:
-            current = prospect
+
+def split_into_segments(text: str, max_len: int = 400) -> list[str]:
+    """テキストを文で区切り、max_lenに収まるセグメントに分割"""
+    limit = max_len - 100  # より余裕をもたせる
+    segments, current, _ = _pack_sentences(text, limit)
 
     # If current is still longer than limit, force split by character limit
     if current and len(current) > limit:
@@ -107,6 +145,67 @@ def split_into_segments(text: str, max_len: int = 400) -> list[str]:
     return [seg.strip() for seg in segments]
 
 
+class SegmentStreamer:
+    """
+    ストリーミングで届くテキストを逐次Markdown除去・分割する
+
+    文末の位置で、閉じていないMarkdown記法（コードブロック、JSON、
+    強調、リンクなど）がなければそこまでを確定させ、後続のテキストで
+    変わらないセグメント（文を詰め終えたもの）から返す。文字数での強制分割は
+    後続のテキストで区切りが変わるため、finish() まで行わない。
+    返したテキストはMarkdown除去後の文字位置で記録し、finish() では
+    残りの部分だけを分割するため、返した結果をつなげると全体を
+    split_into_segments() で分割した結果と一致する。
+    """
+
+    # 確定位置の候補となる文字（split_into_segments() の文の区切りと同じ）
+    BOUNDARY_CHARS = '。.！？!?'
+
+    def __init__(self, max_len: int = 400):
+        self.max_len = max_len
+        self.text = ''  # これまでに受け取った生テキスト
+        self.consumed = 0  # 返したセグメントのMarkdown除去後の終了位置
+
+    def feed(self, chunk: str) -> list[str]:
+        """テキストを追加し、新たに確定したセグメントを返す"""
+        start = len(self.text)
+        self.text += chunk
+        if not any(c in self.BOUNDARY_CHARS for c in chunk):
+            return []
+
+        # 今回のチャンク内で最も後ろにある安全な確定位置を探す
+        for pos in range(len(self.text), start, -1):
+            if self.text[pos - 1] in self.BOUNDARY_CHARS and self._is_closed(self.text[:pos]):
+                rest = remove_markdown(self.text[:pos])[self.consumed:]
+                # 最後のセグメントは後続のテキストで伸びる可能性があるため保留
+                segments, _, end = _pack_sentences(rest, self.max_len - 100)
+                self.consumed += end
+                return [seg.strip() for seg in segments if seg.strip()]
+        return []
+
+    def finish(self) -> list[str]:
+        """ストリーム終了時に残りのセグメントを返す"""
+        rest = remove_markdown(self.text)[self.consumed:]
+        self.consumed += len(rest)
+        return [seg for seg in split_into_segments(rest, self.max_len) if seg]
+
+    @staticmethod
+    def _is_closed(text: str) -> bool:
+        """閉じていないMarkdown記法がないか判定"""
+        if text.count('```') % 2:
+            return False
+        if text.rfind('{') > text.rfind('}'):
+            return False
+        if text.rfind('[') > text.rfind(']') or text.rfind('(') > text.rfind(')'):
+            return False
+        # 太字（** / __）と斜体（* / _）はそれぞれ対になっているか
+        for marker in ('*', '_'):
+            bold = text.count(marker * 2)
+            if bold % 2 or (text.count(marker) - bold * 2) % 2:
+                return False
+        return text.count('`') % 2 == 0
+
+
 class SnowflakeGenerator:
     """Snowflake ID generator (Twitter-style 64bit)"""
 
@@ -117,8 +216,14 @@ class SnowflakeGenerator:
         self.last_timestamp = -1
         # Custom epoch (2025-01-01 00:00:00 UTC in milliseconds)
         self.epoch = int(datetime(2025, 1, 1).timestamp() * 1000)
+        self._lock = threading.Lock()
 
     def generate(self) -> int:
+        # 複数のワーカーから呼ばれるためロックで保護
+        with self._lock:
+            return self._generate()
+
+    def _generate(self) -> int:
         timestamp = int(time.time() * 1000)
 
         if timestamp < self.last_timestamp:
@@ -0,0 +1,199 @@
+"""メンション処理のワーカープール"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Hashable, Optional
+
+from .config import WORKER_COUNT, WORKER_QUEUE_SIZE, COALESCE_WINDOW
+
+# デバウンスで待つ最大時間（最初のタスクの投入から、待機時間の何倍まで待つか）
+MAX_DEBOUNCE_FACTOR = 3
+
+
+class MentionWorkerPool:
+    """
+    キー単位で順序を保証するワーカープール
+
+    同じキー（会話）のタスクは投入順に1つずつ処理し、
+    異なるキーのタスクは複数のワーカーで並列に処理する。
+
+    merge を指定すると、同じキーのタスクが待機中（前のタスクの処理中を含む）に
+    投入されたタスクを待機中のタスクとまとめる。coalesce_window を指定すると、
+    キーの最後のタスクの投入からその秒数だけ処理を待ち、その間に届いた
+    タスクもまとめる（デバウンス）。
+    """
+
+    def __init__(
+        self,
+        handler: Callable,
+        num_workers: Optional[int] = None,
+        max_queue_size: Optional[int] = None,
+        merge: Optional[Callable[[tuple, tuple], Optional[tuple]]] = None,
+        coalesce_window: Optional[float] = None
+    ):
+        """
+        Args:
+            handler: タスクを処理する関数（handler(key, *args) の形で呼ばれる）
+            num_workers: ワーカースレッド数
+            max_queue_size: 待機できるタスクの最大数
+            merge: 待機中のタスクの引数と新しいタスクの引数から、まとめたタスクの
+                引数を返す関数（まとめない場合はNoneを返す）
+            coalesce_window: 同じキーのタスクをまとめるために待つ秒数（mergeを指定した場合のみ）
+        """
+        self.handler = handler
+        self.num_workers = num_workers or WORKER_COUNT
+        self.max_queue_size = max_queue_size or WORKER_QUEUE_SIZE
+        self.merge = merge
+        self.coalesce_window = COALESCE_WINDOW if coalesce_window is None else coalesce_window
+
+        self._cond = threading.Condition()
+        self._pending: dict[Hashable, deque] = {}  # キーごとの待機タスク
+        self._ready: deque = deque()  # 実行可能なキー（処理中でないもの）
+        self._running: set = set()  # 処理中のキー
+        self._not_before: dict[Hashable, tuple[float, float]] = {}  # キー→(最初の投入時刻, 処理を始める時刻)
+        self._size = 0
+        self._stopping = False
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        """ワーカースレッドを起動"""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.num_workers):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"mention-worker-{i+1}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        logging.info(f"Started {self.num_workers} mention workers (queue size: {self.max_queue_size})")
+
+    def submit(self, key: Hashable, *args) -> bool:
+        """
+        タスクを投入
+
+        キューが満杯の場合は空きができるまで待機する。
+
+        Returns:
+            投入できたかどうか（停止中はFalse）
+        """
+        with self._cond:
+            if self._size >= self.max_queue_size and not self._stopping:
+                logging.warning(f"Mention queue full ({self._size}), waiting for a free slot")
+            while self._size >= self.max_queue_size and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                logging.error(f"Worker pool is stopping, dropped task for {key}")
+                return False
+
+            tasks = self._pending.setdefault(key, deque())
+            if self.merge is not None and self.coalesce_window > 0:
+                self._debounce(key)
+
+            merged = self.merge(tasks[-1], args) if self.merge is not None and tasks else None
+            if merged is not None:
+                # 待機中のタスクとまとめる（待機数は増えない）
+                tasks[-1] = merged
+                self._cond.notify_all()
+                logging.info(f"Coalesced mention for {key} into the queued one (queued: {self._size})")
+                return True
+
+            tasks.append(args)
+            self._size += 1
+            # 処理中でなく、まだ実行待ちに入っていないキーだけを追加
+            if key not in self._running and len(tasks) == 1:
+                self._ready.append(key)
+            self._cond.notify_all()
+            logging.info(f"Queued mention for {key} (queued: {self._size})")
+            return True
+
+    def _debounce(self, key: Hashable):
+        """キーの処理開始を遅らせる（最初の投入から最大 MAX_DEBOUNCE_FACTOR 倍まで）"""
+        now = time.monotonic()
+        first, _ = self._not_before.get(key, (now, now))
+        limit = first + self.coalesce_window * MAX_DEBOUNCE_FACTOR
+        self._not_before[key] = (first, min(now + self.coalesce_window, limit))
+
+    def qsize(self) -> int:
+        """待機中のタスク数を取得"""
+        with self._cond:
+            return self._size
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """
+        ワーカーを停止
+
+        待機中のタスクを処理し終えてから停止する。
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(timeout)
+        with self._cond:
+            self._threads = [t for t in self._threads if t.is_alive()]
+        logging.info("Mention workers stopped")
+
+    def _take_ready_key(self) -> tuple[Optional[Hashable], Optional[float]]:
+        """
+        処理を始められるキーを実行待ちから取り出す
+
+        Returns:
+            (キー, None)、またはデバウンス中のキーしかない場合は (None, 次に始められるまでの秒数)
+        """
+        now = time.monotonic()
+        wait = None
+        for key in self._ready:
+            not_before = self._not_before.get(key)
+            if not_before is None or self._stopping or not_before[1] <= now:
+                self._ready.remove(key)
+                self._not_before.pop(key, None)
+                return key, None
+            remaining = not_before[1] - now
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _next_task(self):
+        """次に実行するタスクを取り出す（停止時はNone）"""
+        with self._cond:
+            while True:
+                key, wait = self._take_ready_key()
+                if key is not None:
+                    break
+                if self._stopping and not self._ready:
+                    return None
+                self._cond.wait(wait)
+            args = self._pending[key].popleft()
+            self._running.add(key)
+            self._size -= 1
+            self._cond.notify_all()
+            return key, args
+
+    def _finish_task(self, key: Hashable):
+        """タスク完了後、同じキーの次のタスクを実行可能にする"""
+        with self._cond:
+            self._running.discard(key)
+            if self._pending.get(key):
+                self._ready.append(key)
+            else:
+                self._pending.pop(key, None)
+            self._cond.notify_all()
+
+    def _worker_loop(self):
+        """ワーカースレッドのメインループ"""
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            key, args = task
+            try:
+                self.handler(key, *args)
+            except Exception as e:
+                logging.error(f"Unhandled error in mention worker: {e}", exc_info=True)
+            finally:
+                self._finish_task(key)
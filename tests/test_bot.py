@@ -0,0 +1,175 @@
+"""MentionBot のテスト（Mastodonとワーカーは偽物を使う）"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import src.bot as bot_module
+import src.storage as storage_module
+from src.bot import NOTIFICATION_CURSOR_KEY, MentionBot
+from src.storage import ConversationStorage
+
+
+class FakeClient:
+    """通知APIだけを持つクライアント"""
+
+    def __init__(self):
+        self.server_notifications = []
+
+    def me(self):
+        return SimpleNamespace(acct='bot')
+
+    def notifications(self, min_id=None, limit=40, **kwargs):
+        found = sorted(
+            (n for n in self.server_notifications if min_id is None or int(n.id) > int(min_id)),
+            key=lambda n: int(n.id),
+            reverse=min_id is None
+        )
+        return found[:limit]
+
+
+class FakeWorkers:
+    """投入されたタスクを記録するだけのワーカープール"""
+
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, key, *args):
+        self.tasks.append((key, *args))
+        return True
+
+
+def mention(notification_id: int, status_id: int) -> SimpleNamespace:
+    status = SimpleNamespace(
+        id=status_id,
+        account=SimpleNamespace(acct='user'),
+        content=f'<p>@bot hello {status_id}</p>',
+        in_reply_to_id=None,
+        visibility='public'
+    )
+    return SimpleNamespace(id=str(notification_id), type='mention', status=status)
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    storage = ConversationStorage(str(tmp_path / 'conversations.db'))
+    # get_storage() を使う他のモジュールも一時ディレクトリのデータベースを使う
+    monkeypatch.setattr(storage_module, '_storage', storage)
+    monkeypatch.setattr(bot_module, 'get_response_cache', lambda: None)
+    mention_bot = MentionBot(FakeClient())
+    mention_bot.workers = FakeWorkers()
+    yield mention_bot
+    storage.close()
+
+
+def queued_notifications(bot) -> list[int]:
+    return [n for task in bot.workers.tasks for n in task[4]]
+
+
+def finish(bot, notification_id: int):
+    bot._notification_done(notification_id)
+
+
+def cursor(bot) -> int:
+    return int(bot.storage.get_state(NOTIFICATION_CURSOR_KEY))
+
+
+def test_mention_between_catch_up_and_stream_connect_is_not_lost(bot):
+    bot.storage.set_state(NOTIFICATION_CURSOR_KEY, '100')
+    bot.client.server_notifications.append(mention(101, 1001))
+
+    # 起動時（接続前）の取りこぼしの確認
+    bot.catch_up()
+    bot.expect_stream()
+    assert queued_notifications(bot) == [101]
+
+    # 確認してからストリームが接続されるまでに届いたメンション（ストリームには流れない）
+    bot.client.server_notifications.append(mention(102, 1002))
+
+    # 接続後にストリームで届いたメンションの処理が先に終わっても、カーソルは102を越えない
+    streamed = mention(103, 1003)
+    bot.client.server_notifications.append(streamed)
+    bot.on_notification(streamed)
+    finish(bot, 101)
+    finish(bot, 103)
+    assert cursor(bot) < 102
+
+    # 最初のハートビートで再確認する
+    bot.handle_heartbeat()
+    deadline = time.monotonic() + 5
+    while 102 not in queued_notifications(bot) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(queued_notifications(bot)) == [101, 102, 103]
+
+    finish(bot, 102)
+    deadline = time.monotonic() + 5
+    while cursor(bot) != 103 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cursor(bot) == 103
+
+
+def test_catch_up_skips_already_queued_mentions(bot):
+    bot.storage.set_state(NOTIFICATION_CURSOR_KEY, '100')
+    first = mention(101, 1001)
+    bot.client.server_notifications.append(first)
+    bot.on_notification(first)
+    bot.catch_up()
+    assert queued_notifications(bot) == [101]
+
+
+def test_failed_submit_does_not_hold_the_cursor(bot):
+    bot.storage.set_state(NOTIFICATION_CURSOR_KEY, '100')
+
+    def fail(key, *args):
+        raise RuntimeError('queue closed')
+
+    bot.workers.submit = fail
+    bot.on_notification(mention(101, 1001))
+    assert not bot._inflight_notifications
+
+    # 後続のメンションの完了でカーソルが進む
+    bot.workers = FakeWorkers()
+    bot.on_notification(mention(102, 1002))
+    finish(bot, 102)
+    assert cursor(bot) == 102
+
+
+def test_stopped_pool_leaves_mention_for_next_catch_up(bot):
+    bot.storage.set_state(NOTIFICATION_CURSOR_KEY, '100')
+    bot.client.server_notifications.append(mention(101, 1001))
+    bot.workers.submit = lambda key, *args: False
+    bot.catch_up()
+    assert not bot._inflight_notifications
+
+    # 次の確認で受け付け直す
+    bot.workers = FakeWorkers()
+    bot.catch_up()
+    assert queued_notifications(bot) == [101]
+
+
+def test_summary_update_runs_after_save_without_blocking(bot):
+    saved = threading.Event()
+    order = []
+
+    class FakeProcessor:
+        def update_summary(self, context, llm, custom_prompt):
+            order.append(('summary', saved.is_set()))
+
+    bot.processor = FakeProcessor()
+    bot.storage_writes.start()
+    bot.summaries.start()
+    try:
+        bot.storage_writes.submit('save', lambda: saved.wait(5) and order.append(('save', True)), key='k')
+        # 要約の投入はすぐに戻り、保存が終わってから要約を更新する
+        begin = time.monotonic()
+        bot.summaries.submit('update_summary', bot._update_summary, 'k', None, None, key='k')
+        assert time.monotonic() - begin < 1
+        assert order == []
+        saved.set()
+        assert bot.summaries.wait_for('k', timeout=5) is True
+        assert order == [('save', True), ('summary', True)]
+    finally:
+        saved.set()
+        bot.summaries.shutdown(timeout=5)
+        bot.storage_writes.shutdown(timeout=5)
@@ -0,0 +1,53 @@
+"""LLMHealthMonitor のテスト"""
+from src.health import LLMHealthMonitor
+
+
+class FakeModel:
+    """ウォームアップと読み込み状態を記録するモデル"""
+
+    def __init__(self, model: str, loaded: bool = False, reachable: bool = True):
+        self.model = model
+        self.loaded = loaded
+        self.reachable = reachable
+        self.warmups = 0
+
+    def is_loaded(self) -> bool:
+        if not self.reachable:
+            raise ConnectionError('ollama is down')
+        return self.loaded
+
+    def warmup(self, messages):
+        self.warmups += 1
+        self.loaded = True
+        return 0.0
+
+
+def test_warmup_loads_primary_last():
+    order = []
+    models = [FakeModel('large'), FakeModel('small')]
+    for model in models:
+        model.warmup = lambda messages, model=model: order.append(model.model)
+    LLMHealthMonitor(models, [], interval=0).warmup()
+    assert order == ['small', 'large']
+
+
+def test_check_rewarms_only_primary():
+    primary, fallback = FakeModel('large'), FakeModel('small')
+    monitor = LLMHealthMonitor([primary, fallback], [], interval=0, rewarm=True)
+    assert monitor.check() is True
+    assert primary.warmups == 1
+    assert fallback.warmups == 0
+    assert monitor.status() == {'large': True, 'small': False}
+
+
+def test_unloaded_models_are_not_ready_without_rewarm():
+    primary = FakeModel('large')
+    monitor = LLMHealthMonitor([primary], [], interval=0, rewarm=False)
+    assert monitor.check() is False
+    assert primary.warmups == 0
+
+    primary.loaded = True
+    assert monitor.check() is True
+
+    primary.reachable = False
+    assert monitor.check() is False
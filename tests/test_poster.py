@@ -0,0 +1,69 @@
+"""MastodonPoster のテスト"""
+from src.poster import MastodonPoster
+from src.utils import split_into_segments
+
+
+class FakeClient:
+    """status_post を記録し、fail_at 回目の投稿で失敗するクライアント"""
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.posts = []
+
+    def status_post(self, status, in_reply_to_id=None, visibility='public', idempotency_key=None):
+        if len(self.posts) + 1 == self.fail_at:
+            raise RuntimeError('post failed')
+        self.posts.append(status)
+        return {'id': len(self.posts)}
+
+
+class Chunks:
+    """閉じられたかを記録するチャンクのイテレータ"""
+
+    def __init__(self, text: str, size: int = 20):
+        self.parts = [text[i:i + size] for i in range(0, len(text), size)]
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.read >= len(self.parts):
+            raise StopIteration
+        self.read += 1
+        return self.parts[self.read - 1]
+
+    def close(self):
+        self.closed = True
+
+
+TEXT = ('あ' * 150 + '。') * 8
+
+
+def test_stream_completed():
+    client = FakeClient()
+    chunks = Chunks(TEXT)
+    posted, text, completed = MastodonPoster(client).post_reply_stream(chunks, 'user', 1)
+    assert completed is True
+    assert text == TEXT
+    assert len(posted) == len(client.posts) == len(split_into_segments(TEXT))
+    assert chunks.closed
+
+
+def test_stream_post_failure_closes_chunks():
+    client = FakeClient(fail_at=2)
+    chunks = Chunks(TEXT)
+    posted, text, completed = MastodonPoster(client).post_reply_stream(chunks, 'user', 1)
+    assert completed is False
+    assert len(posted) == 1
+    # 投稿に失敗した時点で生成を中断する
+    assert chunks.read < len(chunks.parts)
+    assert chunks.closed
+
+
+def test_stream_failure_in_remaining_segments():
+    client = FakeClient(fail_at=2)
+    posted, _, completed = MastodonPoster(client).post_reply_stream(iter(['あ' * 100 + '。'] * 5), 'user', 1)
+    assert completed is False
+    assert len(posted) == 1
@@ -0,0 +1,53 @@
+"""ModelRouter のテスト"""
+from src.router import ModelRouter
+
+
+class FakeModel:
+    """OllamaInterface の代わりに使うモデル"""
+
+    def __init__(self, model: str, fail: bool = False):
+        self.model = model
+        self.fail = fail
+        self.latency = None
+        self.pending = 0
+        self.max_concurrency = 1
+        self.open_streams = 0
+
+    def request_chat(self, messages):
+        if self.fail:
+            raise RuntimeError('unavailable')
+        return f'{self.model} reply'
+
+    def request_chat_stream(self, messages):
+        if self.fail:
+            raise RuntimeError('unavailable')
+        self.open_streams += 1
+        try:
+            for i in range(100):
+                yield f'{i}.'
+        finally:
+            self.open_streams -= 1
+
+
+def test_answered_model_after_fallback():
+    router = ModelRouter([FakeModel('large', fail=True), FakeModel('small')], latency_slo=0)
+    assert router.chat([]) == 'small reply'
+    assert router.answered_model == 'small'
+    assert list(router.chat_stream([]))[:2] == ['0.', '1.']
+    assert router.answered_model == 'small'
+
+
+def test_answered_model_none_when_all_fail():
+    router = ModelRouter([FakeModel('large', fail=True)], latency_slo=0)
+    assert router.chat([]).startswith('Error:')
+    assert router.answered_model is None
+
+
+def test_closing_stream_releases_model():
+    model = FakeModel('large')
+    router = ModelRouter([model], latency_slo=0)
+    stream = router.chat_stream([])
+    assert next(stream) == '0.'
+    assert model.open_streams == 1
+    stream.close()
+    assert model.open_streams == 0
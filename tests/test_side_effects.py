@@ -0,0 +1,83 @@
+"""SideEffectExecutor のテスト"""
+import threading
+import time
+
+import src.side_effects as side_effects
+from src.side_effects import SideEffectExecutor
+
+
+def _flaky(failures: int, result_on_failure=None):
+    """最初の failures 回は失敗するタスク（result_on_failure がNoneなら例外、それ以外はその値を返す）"""
+    calls = []
+
+    def task(value):
+        calls.append(value)
+        if len(calls) <= failures:
+            if result_on_failure is None:
+                raise RuntimeError('temporary failure')
+            return result_on_failure
+        return True
+
+    return task, calls
+
+
+def test_retries_with_exponential_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(side_effects.time, 'sleep', delays.append)
+    task, calls = _flaky(2)
+
+    executor = SideEffectExecutor('test', max_retries=3, backoff_base=0.5)
+    executor.submit('flaky', task, 'x')
+
+    assert calls == ['x', 'x', 'x']
+    assert delays == [0.5, 1.0]
+
+
+def test_false_result_is_retried_until_limit(monkeypatch):
+    delays = []
+    monkeypatch.setattr(side_effects.time, 'sleep', delays.append)
+    task, calls = _flaky(10, result_on_failure=False)
+
+    executor = SideEffectExecutor('test', max_retries=2, backoff_base=1)
+    executor.submit('always_false', task, 'x')
+
+    assert len(calls) == 3
+    assert delays == [1, 2]
+
+
+def test_wait_for_key():
+    release = threading.Event()
+    done = []
+    executor = SideEffectExecutor('test', max_retries=0)
+    executor.start()
+    try:
+        executor.submit('save', lambda: release.wait(5) and done.append('a'), key='a')
+        executor.submit('other', lambda: done.append('b'))
+
+        assert executor.wait_for('a', timeout=0.05) is False
+        assert executor.wait_for('unknown', timeout=0) is True
+        release.set()
+        assert executor.wait_for('a', timeout=5) is True
+        assert done[0] == 'a'
+    finally:
+        release.set()
+        executor.shutdown(timeout=5)
+
+
+def test_shutdown_flushes_pending_tasks():
+    done = []
+
+    def task(value):
+        time.sleep(0.005)
+        done.append(value)
+
+    executor = SideEffectExecutor('test', max_retries=0)
+    executor.start()
+    for value in range(10):
+        executor.submit('task', task, value, key=value % 2)
+    executor.shutdown(timeout=10)
+    assert done == list(range(10))
+
+    # 停止後に投入したタスクはその場で実行する
+    executor.submit('late', done.append, 'late')
+    assert done[-1] == 'late'
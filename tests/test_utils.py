@@ -0,0 +1,70 @@
+"""utils のテスト"""
+from src.utils import SegmentStreamer, remove_markdown, split_into_segments
+
+
+def _stream(text: str, chunk_size: int, max_len: int = 400) -> list[str]:
+    """text を chunk_size 文字ずつ SegmentStreamer に渡し、返されたセグメントを集める"""
+    streamer = SegmentStreamer(max_len)
+    segments = []
+    for i in range(0, len(text), chunk_size):
+        segments.extend(streamer.feed(text[i:i + chunk_size]))
+    segments.extend(streamer.finish())
+    assert streamer.text == text
+    return segments
+
+
+def _expected(text: str, max_len: int = 400) -> list[str]:
+    return [seg for seg in split_into_segments(remove_markdown(text), max_len) if seg]
+
+
+def test_split_into_segments_packs_sentences():
+    text = 'あ' * 200 + '。' + 'い' * 200 + '。 ' + 'う' * 50 + '！'
+    assert split_into_segments(text) == ['あ' * 200 + '。', 'い' * 200 + '。' + 'う' * 50 + '！']
+
+
+def test_split_into_segments_force_splits_last_segment():
+    assert split_into_segments('あ' * 700) == ['あ' * 300, 'あ' * 300, 'あ' * 100]
+
+
+def test_stream_long_line_before_newline():
+    text = 'あ' * 350 + '\n' + 'い' * 50 + '。' + 'う' * 100 + '。'
+    for chunk_size in (1, 7, 64, len(text)):
+        assert _stream(text, chunk_size) == _expected(text)
+
+
+def test_stream_bullet_list():
+    lines = [f'- 項目{i}: ' + '説明' * 8 for i in range(20)]
+    text = '\n'.join(lines) + '\nまとめると以上です。よろしくね！'
+    expected = _expected(text)
+    for chunk_size in (1, 5, 33):
+        segments = _stream(text, chunk_size)
+        assert segments == expected
+        assert ''.join(segments) == ''.join(expected)
+
+
+def test_stream_newline_heavy_markdown():
+    paragraphs = []
+    for i in range(30):
+        paragraphs.append(f'## 見出し{i}\n\n**ポイント{i}**は次の通り。\n- 一つ目\n- 二つ目です。\n')
+        if i % 7 == 0:
+            paragraphs.append('```\ncode. block!\n```\n')
+    text = '\n'.join(paragraphs) + '以上！'
+    for chunk_size in (1, 3, 20, 100):
+        assert _stream(text, chunk_size) == _expected(text)
+
+
+def test_stream_emits_segments_before_finish():
+    text = ('あ' * 150 + '。') * 6
+    streamer = SegmentStreamer()
+    early = []
+    for i in range(0, len(text), 10):
+        early.extend(streamer.feed(text[i:i + 10]))
+    assert early
+    assert early + streamer.finish() == _expected(text)
+
+
+def test_stream_waits_for_closed_markup():
+    text = ('詳しくは[公式サイト](https://example.com/docs.html)を参照。**重要.** ' * 12
+            + '`a.b` と `c!` です。')
+    for chunk_size in (1, 4, 50):
+        assert _stream(text, chunk_size) == _expected(text)
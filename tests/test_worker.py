@@ -0,0 +1,122 @@
+"""MentionWorkerPool のテスト"""
+import threading
+import time
+
+from src.worker import MAX_DEBOUNCE_FACTOR, MentionWorkerPool
+
+
+def _merge(queued: tuple, new: tuple) -> tuple:
+    """待機中のタスクに新しいタスクの値をつなげる"""
+    return (queued[0] + new[0],)
+
+
+def test_same_key_runs_in_order_and_never_concurrently():
+    lock = threading.Lock()
+    running = set()
+    overlaps = []
+    seen: dict[str, list[int]] = {}
+
+    def handler(key, value):
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+        time.sleep(0.002)
+        with lock:
+            running.discard(key)
+            seen.setdefault(key, []).append(value)
+
+    pool = MentionWorkerPool(handler, num_workers=4, max_queue_size=100)
+    pool.start()
+    for i in range(20):
+        for key in ('a', 'b', 'c'):
+            pool.submit(key, i)
+    pool.shutdown(timeout=10)
+
+    assert overlaps == []
+    assert seen == {key: list(range(20)) for key in ('a', 'b', 'c')}
+
+
+def test_merge_into_queued_task_while_key_is_running():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def handler(key, values):
+        calls.append((key, values))
+        if values == [1]:
+            started.set()
+            release.wait(5)
+
+    pool = MentionWorkerPool(handler, num_workers=2, merge=_merge, coalesce_window=0)
+    pool.start()
+    pool.submit('a', [1])
+    assert started.wait(5)
+
+    # 処理中のタスクとはまとめず、待機中のタスクにまとめる
+    pool.submit('a', [2])
+    pool.submit('a', [3])
+    pool.submit('b', [4])
+    release.set()
+    pool.shutdown(timeout=10)
+
+    assert [values for key, values in calls if key == 'a'] == [[1], [2, 3]]
+    assert ('b', [4]) in calls
+
+
+def test_merge_declined_keeps_tasks_separate():
+    calls = []
+    pool = MentionWorkerPool(
+        lambda key, value: calls.append(value), num_workers=1,
+        merge=lambda queued, new: None, coalesce_window=0
+    )
+    for value in range(3):
+        pool.submit('a', value)
+    assert pool.qsize() == 3
+    pool.start()
+    pool.shutdown(timeout=10)
+    assert calls == [0, 1, 2]
+
+
+def test_debounce_is_capped():
+    window = 0.1
+    started = []
+    calls = []
+
+    def handler(key, values):
+        started.append(time.monotonic())
+        calls.append(values)
+
+    pool = MentionWorkerPool(handler, num_workers=1, merge=_merge, coalesce_window=window)
+    pool.start()
+    first = time.monotonic()
+    # 待機時間より短い間隔で投入し続けても、最初の投入から上限までに処理を始める
+    value = 0
+    while time.monotonic() - first < window * MAX_DEBOUNCE_FACTOR * 2:
+        pool.submit('a', [value])
+        value += 1
+        time.sleep(window / 4)
+    pool.shutdown(timeout=10)
+
+    assert window <= started[0] - first < window * (MAX_DEBOUNCE_FACTOR + 1.5)
+    assert len(calls[0]) > 1
+    assert sorted(v for values in calls for v in values) == list(range(value))
+
+
+def test_shutdown_drains_queued_tasks():
+    calls = []
+
+    def handler(key, value):
+        time.sleep(0.01)
+        calls.append(value)
+
+    pool = MentionWorkerPool(handler, num_workers=1, merge=_merge, coalesce_window=10)
+    pool.start()
+    for key in ('a', 'b', 'c'):
+        pool.submit(key, [key])
+    # 停止時はデバウンスを待たずに残りのタスクを処理する
+    begin = time.monotonic()
+    pool.shutdown(timeout=10)
+    assert time.monotonic() - begin < 5
+    assert sorted(calls) == [['a'], ['b'], ['c']]
+    assert pool.submit('d', ['d']) is False
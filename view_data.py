@@ -4,14 +4,39 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from src.storage import get_storage
+from src.storage import ConversationStorage, get_storage
+from src.export import EXPORT_FORMATS, export_data, import_data
+from src.retention import ArchiveStorage, RetentionJob
+from src.config import ARCHIVE_PATH
 from datetime import datetime
 
+LIST_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 20
 
-def list_conversations():
-    """全会話の一覧を表示"""
-    storage = get_storage()
-    conversations = storage.get_all_conversations()
+_read_only_storage = None
+
+
+def get_read_only_storage() -> ConversationStorage:
+    """
+    表示用に読み込み専用でストレージを開く
+
+    ボットの実行中でもデータベースを変更しないよう、マイグレーションや
+    PRAGMAの書き込みは行わない（書き込むコマンドは get_storage() を使う）。
+    """
+    global _read_only_storage
+    if _read_only_storage is None:
+        try:
+            _read_only_storage = ConversationStorage(read_only=True)
+        except (FileNotFoundError, RuntimeError) as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+    return _read_only_storage
+
+
+def list_conversations(cursor: str = None):
+    """会話の一覧を更新日時の新しい順に1ページ分表示"""
+    storage = get_read_only_storage()
+    conversations, next_cursor = storage.get_conversations_page(LIST_PAGE_SIZE, cursor)
 
     if not conversations:
         print("会話データがありません。")
@@ -28,13 +53,20 @@ def list_conversations():
             print(f"カスタムプロンプト: {conv['custom_prompt'][:50]}...")
         print(f"作成: {conv['created_at']}")
         print(f"更新: {conv['updated_at']}")
+        if conv['last_message_at']:
+            print(f"最後の投稿: {conv['last_message_at']}")
         print("-" * 80)
 
+    if next_cursor:
+        print(f"次のページ: python3 view_data.py list \"{next_cursor}\"")
+
 
 def show_conversation(conversation_id: int):
     """特定の会話の詳細を表示"""
-    storage = get_storage()
+    storage = get_read_only_storage()
     conv = storage.load_conversation(conversation_id)
+    if not conv and os.path.exists(ARCHIVE_PATH):
+        conv = ArchiveStorage().load(conversation_id)
 
     if not conv:
         print(f"会話ID {conversation_id} が見つかりません。")
@@ -45,6 +77,8 @@ def show_conversation(conversation_id: int):
     print(f"{'='*80}")
     print(f"作成: {conv['created_at']}")
     print(f"更新: {conv['updated_at']}")
+    if conv.get('archived_at'):
+        print(f"アーカイブ: {conv['archived_at']}")
 
     if conv['custom_prompt']:
         print(f"\nカスタムプロンプト:")
@@ -69,18 +103,58 @@ def show_conversation(conversation_id: int):
         print()
 
 
+def search_conversations(query: str, page: int = 1):
+    """メッセージとカスタムプロンプトを検索して表示"""
+    storage = get_read_only_storage()
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    # 次のページがあるかを確認するため1件多く取得
+    results = storage.search(query, limit=SEARCH_PAGE_SIZE + 1, offset=offset)
+    has_next = len(results) > SEARCH_PAGE_SIZE
+    results = results[:SEARCH_PAGE_SIZE]
+
+    if not results:
+        print(f"「{query}」に一致するデータがありません。")
+        return
+
+    print(f"\n{'='*80}")
+    print(f"検索結果: 「{query}」 (ページ {page}、{offset + 1}〜{offset + len(results)} 件目)")
+    print(f"{'='*80}\n")
+
+    for result in results:
+        if result['kind'] == 'custom_prompt':
+            print(f"会話ID: {result['conversation_id']} [カスタムプロンプト]")
+        else:
+            print(f"会話ID: {result['conversation_id']}  {result['account']} ({result['status_id']})")
+        snippet = ' '.join(result['snippet'].split())
+        print(f"   {snippet[:100]}{'...' if len(snippet) > 100 else ''}")
+        print(f"   {result['created_at']}")
+        print()
+
+    if has_next:
+        print(f"次のページ: python3 view_data.py search \"{query}\" {page + 1}")
+
+
 def main():
     if len(sys.argv) < 2:
         print("使用方法:")
-        print("  python3 view_data.py list              - 全会話の一覧")
+        print("  python3 view_data.py list [カーソル]   - 全会話の一覧（50件ずつ）")
         print("  python3 view_data.py show <会話ID>    - 特定の会話の詳細")
         print("  python3 view_data.py latest            - 最新の会話の詳細")
+        print("  python3 view_data.py search <検索語> [ページ] - メッセージとカスタムプロンプトの検索")
+        print("  python3 view_data.py export <パス> [jsonl|csv|parquet] - 会話データのエクスポート")
+        print("  python3 view_data.py import <パス> [jsonl|csv|parquet] - 会話データのインポート")
+        print("  python3 view_data.py archive <日数>    - 指定した日数更新のない会話をアーカイブに移す")
+        print("  python3 view_data.py vacuum            - データベースを再構築（ボットの停止中に実行）")
         sys.exit(1)
 
     command = sys.argv[1]
 
     if command == "list":
-        list_conversations()
+        try:
+            list_conversations(sys.argv[2] if len(sys.argv) > 2 else None)
+        except ValueError as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
     elif command == "show":
         if len(sys.argv) < 3:
             print("エラー: 会話IDを指定してください")
@@ -88,12 +162,45 @@ def main():
         conversation_id = int(sys.argv[2])
         show_conversation(conversation_id)
     elif command == "latest":
-        storage = get_storage()
+        storage = get_read_only_storage()
         conversations = storage.get_all_conversations(limit=1)
         if conversations:
             show_conversation(conversations[0]['id'])
         else:
             print("会話データがありません。")
+    elif command == "search":
+        if len(sys.argv) < 3:
+            print("エラー: 検索語を指定してください")
+            sys.exit(1)
+        page = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        search_conversations(sys.argv[2], max(1, page))
+    elif command in ("export", "import"):
+        if len(sys.argv) < 3:
+            print("エラー: パスを指定してください")
+            sys.exit(1)
+        fmt = sys.argv[3] if len(sys.argv) > 3 else None
+        if fmt is not None and fmt not in EXPORT_FORMATS:
+            print(f"エラー: 形式は {' / '.join(EXPORT_FORMATS)} のいずれかを指定してください")
+            sys.exit(1)
+        try:
+            if command == "export":
+                counts = export_data(sys.argv[2], fmt or 'jsonl')
+                print(f"エクスポートしました: 会話 {counts['conversations']} 件、メッセージ {counts['messages']} 件")
+            else:
+                counts = import_data(sys.argv[2], fmt)
+                print(f"インポートしました: 会話 {counts['conversations']} 件、メッセージ {counts['messages']} 件")
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+    elif command == "archive":
+        if len(sys.argv) < 3:
+            print("エラー: 日数を指定してください")
+            sys.exit(1)
+        archived = RetentionJob(retention_days=float(sys.argv[2])).run_once()
+        print(f"アーカイブしました: 会話 {archived} 件")
+    elif command == "vacuum":
+        get_storage().vacuum()
+        print("データベースを再構築しました。")
     else:
         print(f"不明なコマンド: {command}")
         sys.exit(1)